@@ -1,6 +1,9 @@
 from general_files.utils.others.stanford_nlp.stanfordnlp import StanfordCoreNLP
 import spacy
 import os
+import shutil
+from multiprocessing import Pool
+import torch
 from tqdm import tqdm
 import general_files.utils.common_util as utils
 from general_files.utils.common_util import Result, print_error_info
@@ -42,7 +45,6 @@ class Processor(BaseProcessor):
                     "input_ids": batch["history"],
                     "labels": batch["response"],
                 },
-                padding="max_length",
                 max_length=self.config.encoder_max_length,
                 truncation=True,
                 only_input_ids=True,
@@ -68,6 +70,8 @@ class Processor(BaseProcessor):
     def preprocess_data(self, data_path):
         """
         原始数据集转换为Query生成模型训练所需的格式
+        对话按 preprocess_shard_size 切分为若干分片，由 preprocess_num_workers 个进程并行处理，
+        每个分片处理完成后单独保存，中断后重新运行会跳过已完成的分片
         """
         all_data = {
             "train": read_by(
@@ -80,11 +84,6 @@ class Processor(BaseProcessor):
                 self.public_dataset_path + f"/test_{self.config.dataset_split}_split.json", data_name="测试集"
             ),
         }
-        processed_data = {
-            "train": [],
-            "valid": [],
-            "test": [],
-        }
 
         process_flow = [
             "clean_text",
@@ -92,107 +91,117 @@ class Processor(BaseProcessor):
         ]
 
         ###############################################
-        # 读取预处理进度
+        # 切分分片，跳过已完成的分片
         ###############################################
-        data_ckpt_path = data_path + "_ckpt"
-        if os.path.exists(data_ckpt_path + ".pt"):
-            data_ckpt = read_by(data_ckpt_path + ".pt", data_name="数据集预处理ckpt")
-            sents_static = data_ckpt.sents_static
-            processed_data = data_ckpt["processed_data"]
-        else:
-            sents_static = Result(
-                responses=[],
-                knowledges=[],
-            )
-            data_ckpt = Result(
-                stage=["train", "valid", "test"],
-                start_index=0,
-                processed_data=processed_data,
-                sents_static=sents_static,
-            )
+        shard_size = self.config.get("preprocess_shard_size") or 200
+        # 分片目录包含数据划分与分片大小，修改二者后不会误用之前的分片
+        chunk_root = data_path + "_chunks"
+        chunk_path = f"{chunk_root}/{self.config.dataset_split}_shard{shard_size}"
+        os.makedirs(chunk_path, exist_ok=True)
+        shards = []
+        for stage in ["train", "valid", "test"]:
+            for start_index in range(0, len(all_data[stage]), shard_size):
+                shard_file = f"{chunk_path}/{stage}_{start_index // shard_size:05d}.pt"
+                shards.append((shard_file, start_index, all_data[stage][start_index: start_index + shard_size], process_flow))
+        todo_shards = [shard for shard in shards if not os.path.exists(shard[0])]
+        log.info(f"共 {len(shards)} 个分片，已完成 {len(shards) - len(todo_shards)} 个")
 
+        ###############################################
+        # 多进程处理
+        ###############################################
         error_count = 0
-        for stage in data_ckpt.stage:
-            data = all_data[stage][data_ckpt.start_index :]
-            for i, item in enumerate(tqdm(data, desc=f"预处理{stage}数据集")):
-                utterances = []
-                dialog_history = []
-                for dialog_idx, dialog in enumerate(item["dialog"]):
-                    ###############################################
-                    # 格式化原数据结构
-                    ###############################################
-                    response = dialog["text"]
-                    if len(dialog_history) < 1:
-                        dialog_history.append("__topic__:" + item["chosen_topic"])
-                    history = dialog_history.copy()
-                    dialog_history.append(response)
-                    speaker = (
-                        "Wizard" if "Wizard" in dialog["speaker"] else "Apprentice"
-                    )
-                    is_wizard = True if speaker == "Wizard" else False
-                    if is_wizard:
-                        if len(list(dialog["checked_sentence"].values())) < 1:
-                            topic = list(dialog["checked_passage"].values())[0]
-                            passage = [topic]
-                            for p in dialog["retrieved_passages"]:
-                                if topic in p:
-                                    passage = p[topic]
-                            knowledge = passage[0]
-                        else:
-                            knowledge = list(dialog["checked_sentence"].values())[0]
-                    else:
-                        continue
-                                        
-
-                    ###############################################
-                    # 封装新的数据结构
-                    ###############################################
-                    uttr = Result(
-                        history=history,
-                        knowledge=knowledge,
-                        response=response,
-                    )
-                    ###############################################
-                    # 数据预处理
-                    ###############################################
-                    try:
-                        uttr = data_method_caller(process_flow, uttr)
-                    except Exception as e:
-                        print_error_info(e)
-                        error_count += 1
-                        continue
-
-                    utterances.append(uttr)
-
-                    sents_static.get("responses").append(uttr['response'])
-                    sents_static.get("knowledges").append(uttr['knowledge'])
-
-                processed_data[stage].append(
-                    {"dialog_idx": i, "utterances": utterances}
-                )
-
-                ###############################################
-                # 保存数据集预处理进度
-                ###############################################
-                if i != 0 and i % 200 == 0:
-                    current_stage = data_ckpt.stage[data_ckpt.stage.index(stage):]
-                    data_ckpt.merge_or_update(
-                        Result(
-                            stage=current_stage,
-                            start_index=i,
-                            processed_data=processed_data,
-                            sents_static=sents_static,
-                        )
-                    )
-                    save_as(data_ckpt, data_ckpt_path, data_name="数据集预处理ckpt")
-
-            data_ckpt["start_index"] = 0
+        num_workers = min(self.config.get("preprocess_num_workers") or os.cpu_count(), max(len(todo_shards), 1))
+        with Pool(num_workers) as pool:
+            for shard_error_count in tqdm(pool.imap_unordered(process_dialog_shard, todo_shards),
+                                          total=len(todo_shards), desc="预处理数据集"):
+                error_count += shard_error_count
+
+        ###############################################
+        # 按顺序合并分片
+        ###############################################
+        processed_data = {
+            "train": [],
+            "valid": [],
+            "test": [],
+        }
+        for shard_file, _, _, _ in shards:
+            stage = shard_file.split("/")[-1].split("_")[0]
+            processed_data[stage].extend(torch.load(shard_file))
 
         save_as(processed_data, data_path, data_name="预处理数据集")
 
-        os.remove(data_ckpt_path + ".pt")
-        print(f"预处理完成，共有{error_count}条数据出错")
-        
-        nlp_model.close()
-        
+        shutil.rmtree(chunk_root)
+        print(f"预处理完成，本次共有{error_count}条数据出错")
+
         return processed_data
+
+
+def process_dialog(item, dialog_idx, process_flow):
+    """
+    处理一段对话，返回处理后的对话与出错的语句数
+    """
+    error_count = 0
+    utterances = []
+    dialog_history = []
+    for dialog in item["dialog"]:
+        ###############################################
+        # 格式化原数据结构
+        ###############################################
+        response = dialog["text"]
+        if len(dialog_history) < 1:
+            dialog_history.append("__topic__:" + item["chosen_topic"])
+        history = dialog_history.copy()
+        dialog_history.append(response)
+        speaker = (
+            "Wizard" if "Wizard" in dialog["speaker"] else "Apprentice"
+        )
+        is_wizard = True if speaker == "Wizard" else False
+        if is_wizard:
+            if len(list(dialog["checked_sentence"].values())) < 1:
+                topic = list(dialog["checked_passage"].values())[0]
+                passage = [topic]
+                for p in dialog["retrieved_passages"]:
+                    if topic in p:
+                        passage = p[topic]
+                knowledge = passage[0]
+            else:
+                knowledge = list(dialog["checked_sentence"].values())[0]
+        else:
+            continue
+
+        ###############################################
+        # 封装新的数据结构
+        ###############################################
+        uttr = Result(
+            history=history,
+            knowledge=knowledge,
+            response=response,
+        )
+        ###############################################
+        # 数据预处理
+        ###############################################
+        try:
+            uttr = data_method_caller(process_flow, uttr)
+        except Exception as e:
+            print_error_info(e)
+            error_count += 1
+            continue
+
+        utterances.append(uttr)
+    return {"dialog_idx": dialog_idx, "utterances": utterances}, error_count
+
+
+def process_dialog_shard(shard):
+    """
+    在子进程中处理一个分片，先写入临时文件再重命名，保证分片文件要么完整要么不存在
+    """
+    shard_file, start_index, dialogs, process_flow = shard
+    error_count = 0
+    processed_dialogs = []
+    for i, item in enumerate(dialogs):
+        processed_dialog, dialog_error_count = process_dialog(item, start_index + i, process_flow)
+        processed_dialogs.append(processed_dialog)
+        error_count += dialog_error_count
+    torch.save(processed_dialogs, shard_file + ".tmp")
+    os.replace(shard_file + ".tmp", shard_file)
+    return error_count
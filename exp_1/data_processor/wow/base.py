@@ -86,7 +86,6 @@ class Processor(BasicProcessor):
                     "decoder_knowledge": batch["knowledge"],
                     "decoder_history": batch["history"],
                 },
-                padding="max_length",
                 max_length=self.config.encoder_max_length,
                 truncation=True,
                 only_input_ids=True,
@@ -54,6 +54,9 @@ class ModelNet(BasePLModel):
                 **other_features  # 如果有其他特征参数，建议加decoder前缀，保持框架一致性
                 ):
         result = Result()
+        if past_result is not None:
+            # 生成时复用上一步缓存的 encoder_outputs 与 past_key_values，只解码最新的 token
+            return self.generate_step(input_ids, other_features.pop("decoder_input_ids", None), past_result, **other_features)
         other_features['decoder_stage'] = self.stage
         outputs = self.backbone(input_ids=input_ids,
                                 output_hidden_states=True,
@@ -73,5 +76,10 @@ class ModelNet(BasePLModel):
                 result.merge_or_update(model_result)
         return result
 
+    def generate_step(self, input_ids, decoder_input_ids=None, past_result=None, **other_features):
+        # 自定义模型需要额外的特征参数
+        other_features['decoder_stage'] = 'test'
+        return self.cached_backbone_step(input_ids, decoder_input_ids, past_result, **other_features)
+
 
    
\ No newline at end of file
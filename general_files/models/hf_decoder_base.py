@@ -25,6 +25,11 @@ class ModelNet(BasePLModel):
                 self.backbone.state_dict()[
                     name][:] += (torch.rand(para.size()) - 0.5) * config.noise_lambda * torch.std(para)
 
+        if self.config.get('pack_sequences') and not self.supports_block_attention_mask():
+            # 不支持块对角注意力时，打包的多段对话之间会互相可见
+            raise ValueError(f"{self.backbone.__class__.__name__} 不支持 3 维 attention_mask，"
+                             f"无法隔离打包样本中的不同对话，请将 pack_sequences 设为 False！")
+
     def forward(self,
                 # batch, seq_len
                 input_ids,
@@ -35,14 +40,23 @@ class ModelNet(BasePLModel):
                 **other_features  # 如果有其他特征参数，建议加decoder前缀，保持框架一致性
                 ):
         result = Result()
+        if past_result is not None:
+            # 生成时复用上一步缓存的 encoder_outputs 与 past_key_values，只解码最新的 token
+            return self.generate_step(input_ids, other_features.pop("decoder_input_ids", None), past_result, **other_features)
+        attention_mask = input_ids.ne(self.tokenizer.pad_token_id)
+        packed_features = dict()
+        if other_features.get('segment_ids') is not None:
+            # 打包训练：每段对话重新计数 position_ids，并使用块对角注意力
+            packed_features['position_ids'] = other_features['position_ids']
+            attention_mask = self.get_packed_attention_mask(input_ids, other_features['segment_ids'])
         outputs = self.backbone(input_ids=input_ids,
                                 output_hidden_states=True,
                                 output_attentions=True,
                                 labels=torch.where(
                                     labels == self.tokenizer.pad_token_id, -100, labels) if labels is not None else None,
-                                attention_mask=input_ids.ne(
-                                    self.tokenizer.pad_token_id),
+                                attention_mask=attention_mask,
                                 use_cache=True,
+                                **packed_features,
                                 )
         result.add(logits=outputs['logits'])
         if self.stage != "test":
@@ -50,9 +64,4 @@ class ModelNet(BasePLModel):
             result.add(loss=outputs['loss'], lm_loss=outputs['loss'])
         return result
 
-    def generate_step(self, input_ids, decoder_input_ids, past_result, **other_features):
-        return self(input_ids,
-                    past_result=past_result,
-                    **other_features)
-
    
\ No newline at end of file
@@ -42,6 +42,9 @@ class ModelNet(BasePLModel):
         **other_features  # 如果有其他特征参数，建议加decoder前缀，保持框架一致性
     ):
         result = Result()
+        if past_result is not None:
+            # 生成时复用上一步缓存的 encoder_outputs 与 past_key_values，只解码最新的 token
+            return self.generate_step(input_ids, other_features.pop("decoder_input_ids", None), past_result, **other_features)
         outputs = self.backbone(
             input_ids=input_ids,
             labels=torch.where(labels == self.tokenizer.pad_token_id, -100, labels)
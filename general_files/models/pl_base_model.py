@@ -1,4 +1,5 @@
 import math
+import inspect
 from typing import Any, List
 import pytorch_lightning as pl
 import torch
@@ -26,6 +27,7 @@ from transformers.optimization import (
     get_polynomial_decay_schedule_with_warmup,
 )
 from general_files.utils.common_util import Result
+from general_files.utils.data_util import pad_batch_columns
 
 
 # update this and the import above to support new schedulers from transformers.optimization
@@ -99,15 +101,107 @@ class BasePLModel(pl.LightningModule):
 
     def prepare_other_features_for_generation(self, batch):
         ignore_keys = ['input_ids', 'labels', 'decoder_input_ids']
-        other_features = dict()
-        for key in batch.keys():
-            if key not in ignore_keys:
-                try:
-                    other_features[key] = torch.LongTensor(batch[key]).to(self.device)
-                except ValueError as e:
-                    other_features[key] = batch[key]
+        other_features = pad_batch_columns(
+            {key: batch[key] for key in batch.keys() if key not in ignore_keys},
+            pad_token_id=self.tokenizer.pad_token_id,
+            pad_to_multiple_of=self.config.get("pad_to_multiple_of"),
+        )
+        for key, value in other_features.items():
+            if isinstance(value, torch.Tensor):
+                other_features[key] = value.to(self.device)
         return other_features
 
+    def get_decoder_start_ids(self, input_ids):
+        """
+        获取解码器的起始输入，仅 encoder-decoder 模型需要，decoder-only 模型返回 None
+        :param input_ids: batch_size, seq_len
+        :return: batch_size, 1
+        """
+        if not self.backbone.config.is_encoder_decoder:
+            return None
+        start_token_id = self.backbone.config.decoder_start_token_id
+        if start_token_id is None:
+            start_token_id = self.tokenizer.bos_token_id
+        return torch.full((input_ids.size(0), 1), start_token_id, dtype=torch.long, device=input_ids.device)
+
+    def generate_step(self, input_ids, decoder_input_ids=None, past_result=None, **other_features):
+        """
+        增量解码的单步前向
+        首步编码输入并返回 encoder_outputs、past_key_values，之后每步复用 past_result 中的缓存，解码器只输入最新的 token
+        :param input_ids: batch_size, seq_len  decoder-only 模型中为包含已生成部分的完整序列
+        :param decoder_input_ids: batch_size, generated_len  decoder-only 模型为 None
+        :param past_result: 上一步 generate_step 的返回值
+        :return: Result(logits, past_key_values, encoder_outputs)
+        """
+        return self.cached_backbone_step(input_ids, decoder_input_ids, past_result,
+                                         **self.get_backbone_features(other_features))
+
+    def get_backbone_features(self, features):
+        """
+        只保留 backbone.forward 能够接收的特征，自定义 backbone（接收 **kwargs）则全部保留
+        """
+        parameters = inspect.signature(self.backbone.forward).parameters
+        if any(p.kind == inspect.Parameter.VAR_KEYWORD for p in parameters.values()):
+            return features
+        return {key: value for key, value in features.items() if key in parameters}
+
+    def cached_backbone_step(self, input_ids, decoder_input_ids=None, past_result=None, **backbone_kwargs):
+        result = Result()
+        # decoder-only 模型的输入随生成增长，attention_mask 始终根据当前输入重新计算
+        given_attention_mask = backbone_kwargs.pop("attention_mask", None)
+        attention_mask = input_ids.ne(self.tokenizer.pad_token_id)
+        past_key_values = past_result.past_key_values if past_result is not None else None
+        if self.backbone.config.is_encoder_decoder:
+            if given_attention_mask is not None:
+                attention_mask = given_attention_mask
+            if past_result is None:
+                encoder_outputs = self.backbone.get_encoder()(input_ids=input_ids,
+                                                              attention_mask=attention_mask,
+                                                              return_dict=True)
+                step_input_ids = decoder_input_ids
+            else:
+                encoder_outputs = past_result.encoder_outputs
+                step_input_ids = decoder_input_ids[:, -1:]
+            outputs = self.backbone(encoder_outputs=encoder_outputs,
+                                    attention_mask=attention_mask,
+                                    decoder_input_ids=step_input_ids,
+                                    past_key_values=past_key_values,
+                                    use_cache=True,
+                                    return_dict=True,
+                                    **backbone_kwargs)
+        else:
+            encoder_outputs = None
+            # 由 HF 模型根据 attention_mask 计算 position_ids，并在有缓存时只保留最后一个 token
+            model_inputs = self.backbone.prepare_inputs_for_generation(input_ids,
+                                                                       past=past_key_values,
+                                                                       attention_mask=attention_mask,
+                                                                       use_cache=True,
+                                                                       **backbone_kwargs)
+            # prepare_inputs_for_generation 已按缓存截取过的特征（如 token_type_ids）不再覆盖
+            model_inputs.update({k: v for k, v in backbone_kwargs.items() if k not in model_inputs})
+            outputs = self.backbone(**model_inputs, return_dict=True)
+        result.add(logits=outputs["logits"],
+                   past_key_values=outputs["past_key_values"],
+                   encoder_outputs=encoder_outputs)
+        return result
+
+    @staticmethod
+    def select_rows(value, row_index):
+        """
+        按 batch 维度选取指定的行，用于生成时移除已经结束的样本
+        支持张量以及由 tuple、dict（包括 Result、ModelOutput）嵌套组成的缓存，list 视为逐行的原始特征
+        :param row_index: 一维 LongTensor
+        """
+        if isinstance(value, torch.Tensor):
+            return value.index_select(0, row_index.to(value.device))
+        if isinstance(value, dict):
+            return value.__class__(**{k: BasePLModel.select_rows(v, row_index) for k, v in value.items()})
+        if isinstance(value, tuple):
+            return tuple(BasePLModel.select_rows(v, row_index) for v in value)
+        if isinstance(value, list):
+            return [value[i] for i in row_index.tolist()]
+        return value
+
     def get_lr_scheduler(self):
         get_schedule_func = arg_to_scheduler[self.config.scheduler]
         total_steps = self.total_steps()
@@ -163,12 +257,15 @@ class BasePLModel(pl.LightningModule):
         return (self.config.dataset_size / effective_batch_size) * self.config.max_epochs
 
     def NLLLoss(self, logits, labels):
-        loss_fct = torch.nn.NLLLoss(ignore_index=self.tokenizer.pad_token_id)
+        # labels 中的 pad_token_id 与动态补齐使用的 -100 都不计算损失
+        loss_fct = torch.nn.NLLLoss(ignore_index=-100)
+        labels = labels.masked_fill(labels.eq(self.tokenizer.pad_token_id), -100)
         loss = loss_fct(logits.view(-1, logits.shape[-1]), labels.view(-1))
         return loss
 
     def CrossEntropyLoss(self, logits, labels):
-        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=self.tokenizer.pad_token_id)
+        loss_fct = torch.nn.CrossEntropyLoss(ignore_index=-100)
+        labels = labels.masked_fill(labels.eq(self.tokenizer.pad_token_id), -100)
         loss = loss_fct(logits.view(-1, logits.shape[-1]), labels.view(-1))
         return loss
 
@@ -215,6 +312,40 @@ class BasePLModel(pl.LightningModule):
         subsequent_mask = torch.triu(torch.ones((len_s, len_s), device=sequence.device), diagonal=1).bool()
         return subsequent_mask
 
+    def get_packed_attention_mask(self, input_ids, segment_ids):
+        """
+        获取打包样本的块对角因果注意力mask，每个位置只能看到同一段对话中不晚于自己的非pad token
+        :param input_ids: batch_size, seq_len
+        :param segment_ids: batch_size, seq_len
+        :return: batch_size, seq_len, seq_len  1为可见
+        """
+        same_segment = segment_ids.unsqueeze(-1).eq(segment_ids.unsqueeze(1))
+        causal = ~self.get_subsequent_mask(input_ids)
+        not_pad = input_ids.ne(self.tokenizer.pad_token_id).unsqueeze(1)
+        return (same_segment & causal & not_pad).long()
+
+    @torch.no_grad()
+    def supports_block_attention_mask(self):
+        """
+        探测 backbone 是否支持 3 维（batch_size, seq_len, seq_len）的 attention_mask：
+        两个 token 互相不可见且位置都为 0 时，第二个 token 的输出应与其单独输入时完全一致
+        GPT-2 等只支持 2 维 mask 的模型会报错或得到不一致的结果
+        """
+        was_training = self.backbone.training
+        self.backbone.eval()
+        input_ids = torch.tensor([[1, 2]], device=self.device)
+        try:
+            block_logits = self.backbone(input_ids=input_ids,
+                                         attention_mask=torch.eye(2, dtype=torch.long, device=self.device).unsqueeze(0),
+                                         position_ids=torch.zeros_like(input_ids))["logits"][0, 1]
+            single_logits = self.backbone(input_ids=input_ids[:, 1:],
+                                          position_ids=torch.zeros_like(input_ids[:, 1:]))["logits"][0, 0]
+        except Exception:
+            return False
+        finally:
+            self.backbone.train(was_training)
+        return torch.allclose(block_logits, single_logits, atol=1e-4)
+
     def get_pad_and_subsequent_mask(self, src, tgt):
         """
         获取pad mask和tgt的subsequent mask, src的注意力mask为全1
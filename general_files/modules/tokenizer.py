@@ -1,10 +1,12 @@
 
 import os
 import sys
+import torch
 import torch.nn as nn
 from transformers import BertTokenizer, AutoTokenizer
 from general_files.utils import common_util as utils
 from general_files.utils.common_util import Result
+from general_files.utils.data_util import pad_sequences
 from general_files.utils.others.data_processor.processor import get_data_processor
 
 
@@ -132,6 +134,11 @@ class Tokenizer(nn.Module):
         self.sep_token = '<sep>'
         self.decode_dict = {k: v for v, k in self.word_dict.items()}
 
+    def get_vocab(self):
+        if self.tokenizer is not None:
+            return self.tokenizer.get_vocab()
+        return self.word_dict
+
     def set_special_token(self, bos_token=None, eos_token=None, sep_token=None, pad_token=None):
         if bos_token:
             self.bos_token = bos_token
@@ -196,110 +203,121 @@ class Tokenizer(nn.Module):
                 padding='do_not_pad',
                 max_length=-1,
                 only_input_ids=False,
-                return_offsets_mapping=True,
+                return_offsets_mapping=False,
                 add_special_tokens=True,
                 truncation=False,
                 *args, **kwargs):
         if self.tokenizer:
             if max_length < 0:
                 max_length = None
+            tokenize_kwargs = dict(max_length=max_length,
+                                   truncation=truncation,
+                                   add_special_tokens=add_special_tokens,
+                                   return_offsets_mapping=return_offsets_mapping,
+                                   **kwargs)
             if isinstance(inputs, list):
-                results = ()
-                for inp in inputs:
-                    if isinstance(inp[0], list):
-                        tokenized_inputs = [self.tokenizer(i,
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data if i != [] else [] for i in inp]
-                        if only_input_ids:
-                            tokenized_inputs = [ti['input_ids'] if ti != [] else [] for ti in tokenized_inputs]
-                    else:
-                        tokenized_inputs = self.tokenizer(inp,
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data
-                        if only_input_ids:
-                            tokenized_inputs = tokenized_inputs['input_ids']
-                    results += (tokenized_inputs,)
-                return results
+                return self.batch_encode(inputs, padding=padding, only_input_ids=only_input_ids, **tokenize_kwargs)
 
             elif isinstance(inputs, dict):
                 results = Result()
-                for key in inputs.keys():
-                    if isinstance(inputs[key][0], list):
-                        tokenized_inputs = [self.tokenizer(inp,
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data if inp != [] else [] for inp in inputs[key]]
-                        if only_input_ids:
-                            tokenized_inputs = [ti['input_ids'] if ti != [] else [] for ti in tokenized_inputs]
-                    else:
-                        tokenized_inputs = self.tokenizer(inputs[key],
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data
-                        if only_input_ids:
-                            tokenized_inputs = tokenized_inputs['input_ids']
+                tokenized_columns = self.batch_encode(list(inputs.values()), padding=padding,
+                                                      only_input_ids=only_input_ids, **tokenize_kwargs)
+                for key, tokenized_inputs in zip(inputs.keys(), tokenized_columns):
                     results[key] = tokenized_inputs
                 return results
             else:
                 raise Exception(
                     f"Tokenizer.forward(): 不支持的输入类型！期望获取dict或list类型，但是获取的是{str(type(inputs))}")
 
+    def batch_encode(self, columns, padding='do_not_pad', only_input_ids=False, **kwargs):
+        """
+        将多列输入展平为一个句子列表，只调用一次 HF tokenizer 批量编码，再按记录的下标切回原来的结构
+        :param columns: [column]，column 为 [str] 或嵌套的 [[str]]
+        :return: tuple，与 columns 一一对应；嵌套列的每一行单独返回编码结果，空行返回 []
+        """
+        texts = []
+        column_spans = []
+        for column in columns:
+            if len(column) > 0 and isinstance(column[0], list):
+                row_spans = []
+                for row in column:
+                    row_spans.append((len(texts), len(texts) + len(row)))
+                    texts.extend(row)
+                column_spans.append(row_spans)
+            else:
+                column_spans.append((len(texts), len(texts) + len(column)))
+                texts.extend(column)
+
+        # 补齐到最长依赖于每次调用的 batch，因此先不补齐，再在原来的每一组内补齐
+        pad_to_longest = padding is True or padding == 'longest'
+        encoded = self.tokenizer(texts, padding=False if pad_to_longest else padding, **kwargs).data if texts else dict()
+
+        def take(start, end):
+            if start == end:
+                return [] if only_input_ids else {k: [] for k in encoded}
+            if only_input_ids:
+                group = {'input_ids': encoded['input_ids'][start:end]}
+            else:
+                group = {k: v[start:end] for k, v in encoded.items()}
+            if pad_to_longest:
+                group = self.tokenizer.pad(group, padding='longest').data
+            return group['input_ids'] if only_input_ids else group
+
+        results = ()
+        for spans in column_spans:
+            if isinstance(spans, list):
+                results += ([take(*span) if span[1] > span[0] else [] for span in spans],)
+            else:
+                results += (take(*spans),)
+        return results
+
     def pad(self, inputs,
             pad_token=None,
             max_length=-1,
             truncation=False,
+            return_tensors=None,
+            return_attention_mask=False,
+            return_lengths=False,
             *args, **kwargs):
+        """
+        max_length 小于 0 时每组输入各自补齐到自己的最大长度
+        return_tensors 为 'np' 或 'pt' 时返回对应的数组，否则返回 list
+        dict 输入额外返回的 attention_mask 与 lengths 以 `{key}_attention_mask`、`{key}_lengths` 为键；
+        list 输入则在每个元素中返回 (ids, attention_mask, lengths)
+        """
         if not pad_token:
             pad_token = self.pad_token
         pad_id = self.convert_tokens_to_ids(pad_token)
+
+        def pad_one(input_to_pad):
+            outputs = pad_sequences(input_to_pad, pad_id,
+                                    max_length=max_length if max_length >= 0 else None,
+                                    truncation=truncation,
+                                    return_attention_mask=return_attention_mask,
+                                    return_lengths=return_lengths)
+            outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+            if return_tensors == 'pt':
+                outputs = tuple(torch.from_numpy(o) for o in outputs)
+            elif return_tensors != 'np':
+                outputs = tuple(o.tolist() for o in outputs)
+            return outputs
+
         if isinstance(inputs, list):
             results = []
             for input_to_pad in inputs:
-                if max_length < 0:
-                    max_length = max([len(inp) for inp in input_to_pad])
-                result = []
-                for item in input_to_pad:
-                    pad_len = max_length - len(item)
-                    if pad_len > 0:
-                        pad_item = item + [pad_id] * pad_len
-                    elif truncation:
-                        pad_item = item[:max_length]
-                    else:
-                        pad_item = item
-                    result.append(pad_item)
-                results.append(result)
+                outputs = pad_one(input_to_pad)
+                results.append(outputs if len(outputs) > 1 else outputs[0])
             return results
 
         elif isinstance(inputs, dict):
             results = Result()
             for key in inputs.keys():
-                if max_length < 0:
-                    max_length = max([len(inp) for inp in inputs[key]])
-                result = []
-                for item in inputs[key]:
-                    pad_len = max_length - len(item)
-                    if pad_len > 0:
-                        pad_item = item + [pad_id] * pad_len
-                    elif truncation:
-                        pad_item = item[:max_length]
-                    else:
-                        pad_item = item
-                    result.append(pad_item)
-                results[key] = result
+                outputs = list(pad_one(inputs[key]))
+                results[key] = outputs.pop(0)
+                if return_attention_mask:
+                    results[f"{key}_attention_mask"] = outputs.pop(0)
+                if return_lengths:
+                    results[f"{key}_lengths"] = outputs.pop(0)
             return results
 
         else:
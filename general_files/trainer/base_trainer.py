@@ -89,7 +89,12 @@ class ModelTrainer:
         )
 
     def collate_fn(self, batch):
-        return dict_list_to_tensor(batch)
+        # 动态 padding，只补齐到当前 batch 的最大长度
+        return dict_list_to_tensor(
+            batch,
+            pad_token_id=self.tokenizer.pad_token_id,
+            pad_to_multiple_of=self.config.get("pad_to_multiple_of"),
+        )
 
     def train(self):
         if self.config.pl_train_args.auto_lr_find:
@@ -30,6 +30,9 @@ from general_files.utils.data_util import (
     read_by,
     print_dataset_overview,
     print_sample_data,
+    get_dataset_cache_path,
+    save_dataset_cache,
+    load_dataset_cache,
 )
 from typing import Optional, List
 from pytorch_lightning.loggers import CometLogger
@@ -45,6 +48,7 @@ import functools
 import json
 import socket
 import time
+import threading
 import hmac
 import hashlib
 import base64
@@ -237,53 +241,43 @@ def init_context(config, as_pipeline=False, init_data=True):
     ###############################################
     if init_data:
         log.info(f"初始化数据集...: {config.dataset}")
+        if config.stage in ["test"] and not config.eval_bad_case_analysis:
+            only_test = True
+        else:
+            only_test = False
+        dataset_cache_path = get_dataset_cache_path(config, tokenizer, only_test)
         if (
-            os.path.exists(config.result_path + "/preprocess_dataset.pt")
+            os.path.exists(dataset_cache_path)
             and not config.force_reload_data
             and not config.fast_run
         ):
-            log.info(
-                f"发现缓存数据集，准备加载...: {config.result_path}/preprocess_dataset.pt"
-            )
+            log.info(f"发现缓存数据集，准备加载...: {dataset_cache_path}")
             (
                 train_data_tokenized,
                 valid_data_tokenized,
                 test_data_tokenized,
-                raw_data,
-            ) = read_by(
-                config.result_path + "/preprocess_dataset.pt", data_name="数据集缓存"
-            )
+                *raw_data,
+            ) = load_dataset_cache(dataset_cache_path)
+            raw_data = tuple(raw_data)
             print_dataset_overview(
                 train_data_tokenized, valid_data_tokenized, test_data_tokenized
             )
         else:
-            if config.stage in ["test"] and not config.eval_bad_case_analysis:
-                only_test = True
-            else:
-                only_test = False
             (
                 train_data_tokenized,
                 valid_data_tokenized,
                 test_data_tokenized,
                 raw_data,
             ) = get_tokenized_data(config=config, tokenizer=tokenizer, only_test=only_test)
-            if config.eval_bad_case_analysis:
-                log.info(f"使用验证集作为测试集，进行Bad case生成分析！")
-                test_data_tokenized = valid_data_tokenized
-            if not config.fast_run and config.stage in ["train", "finetune", "pretrain"]:
-                log.info(
-                    f"保存数据集缓存...: {config.result_path}/preprocess_dataset.pt"
-                )
-                save_as(
-                    (
-                        train_data_tokenized,
-                        valid_data_tokenized,
-                        test_data_tokenized,
-                        raw_data,
-                    ),
-                    config.result_path + "/preprocess_dataset",
-                    data_name="数据集缓存",
+            if not config.fast_run:
+                log.info(f"保存数据集缓存...: {dataset_cache_path}")
+                save_dataset_cache(
+                    (train_data_tokenized, valid_data_tokenized, test_data_tokenized) + tuple(raw_data),
+                    dataset_cache_path,
                 )
+        if config.eval_bad_case_analysis:
+            log.info(f"使用验证集作为测试集，进行Bad case生成分析！")
+            test_data_tokenized = valid_data_tokenized
 
     if not as_pipeline:
         config.vocab_size = len(tokenizer)
@@ -312,20 +306,12 @@ def init_context(config, as_pipeline=False, init_data=True):
             ckpt_path = config.ckpt_path
         # pytorch lightning框架在测试和微调时加载模型权重
         log.info(f"加载来自 {ckpt_path} 的权重！")
-        if ".ckpt" in ckpt_path:
-            model = model.load_from_checkpoint(
-                ckpt_path,
-                config=config,
-                tokenizer=tokenizer,
-                strict=False,
-            )
-        else:
-            model = model.load_from_checkpoint(
-                ckpt_path + "/best_model.ckpt",
-                config=config,
-                tokenizer=tokenizer,
-                strict=False,
-            )
+        model = model.load_from_checkpoint(
+            get_ckpt_file(ckpt_path),
+            config=config,
+            tokenizer=tokenizer,
+            strict=False,
+        )
     
     print_parameters(model)
     
@@ -342,6 +328,15 @@ def init_context(config, as_pipeline=False, init_data=True):
         return model, tokenizer
 
 
+def get_ckpt_file(ckpt_path):
+    """
+    ckpt_path 可以是 .ckpt 文件，也可以是包含 best_model.ckpt 的目录
+    """
+    if ".ckpt" in ckpt_path:
+        return ckpt_path
+    return ckpt_path + "/best_model.ckpt"
+
+
 @rank_zero_only
 def print_config(
     config,
@@ -1387,8 +1382,144 @@ def print_gpu_info(gpus):
         separator = True
 
 
+def get_available_gpus(config, redis_client):
+    """
+    获取当前可用于该训练任务的GPU
+    :return: 可用的GPU序号, 需要的GPU数量
+    """
+    min_count = config.want_gpu_num
+    self_occupied_gpus = redis_client.get_self_occupied_gpus()
+    if not isinstance(config.visible_cuda, str):
+        # 如果指定了GPU，只有全部空闲才可用
+        reserve_gpus = list(config.visible_cuda)
+        if set(reserve_gpus) & self_occupied_gpus:
+            return [], len(reserve_gpus)
+        return reserve_gpus, len(reserve_gpus)
+    # 自动选择
+    gpus = select_devices(
+        format="index",
+        min_count=min_count,
+        min_free_memory=config.cuda_min_free_memory,
+        max_memory_utilization=config.cuda_max_memory_utilization,
+    )
+    return list(set(gpus) - self_occupied_gpus), min_count
+
+
+def confirm_gpus_free(config, redis_client, gpus):
+    """
+    在 gpu_confirm_window 秒内每秒检查一次，GPU 始终可用才确认空闲，
+    避免刚释放就被其他程序重新占用的GPU被误判为空闲
+    """
+    deadline = time.time() + (config.get("gpu_confirm_window") or 5)
+    while time.time() < deadline:
+        time.sleep(1)
+        available_gpus, _ = get_available_gpus(config, redis_client)
+        if not set(gpus) <= set(available_gpus):
+            return False
+    return True
+
+
+# 排队每等待一小时增加的优先级，与 configs 中 gpu_aging_per_hour 的默认值一致
+DEFAULT_GPU_AGING_PER_HOUR = 1.0
+
+
+def plan_gpu_schedule(queue_tasks, running_tasks, free_gpu_num, now,
+                      default_minutes=720, aging_per_hour=DEFAULT_GPU_AGING_PER_HOUR):
+    """
+    带回填的保守调度：
+    按 优先级 + 已等待小时数 * aging_per_hour 从高到低，依次为每个排队任务预约最早能同时拿到 want_gpus 块GPU的时间段，
+    排在后面的小任务只有在不推迟任何排在前面的任务的预约时才会被安排在当前时刻开始（回填）
+    指定了GPU（pin_gpus）的任务除数量外还要求这几块GPU在整个时间段内没有被正在运行或已预约的任务占用
+    :param queue_tasks: 排队中的任务，需要 task_id、want_gpus，可选 priority、estimated_minutes、create_timestamp、pin_gpus
+    :param running_tasks: 正在占用GPU的任务，需要 use_gpus，可选 estimated_end（预计结束的时间戳）
+    :param free_gpu_num: 当前空闲的GPU数量
+    :return: {task_id: 预计开始的时间戳}，不晚于 now 的任务可以立即开始；在已知的GPU释放之后仍无法满足的任务为 inf
+    """
+    # (时间, 空闲GPU数量的变化)，正在运行的任务超时未结束时认为会在一分钟后结束
+    events = []
+    # GPU序号 --> [(开始, 结束)]，只用于检查指定了GPU的任务
+    busy_gpus = dict()
+    for task in running_tasks:
+        end = max(task.get("estimated_end") or now + default_minutes * 60, now + 60)
+        use_gpus = task["use_gpus"].split(",")
+        events.append((end, len(use_gpus)))
+        for gpu in use_gpus:
+            busy_gpus.setdefault(gpu, []).append((now, end))
+
+    def free_at(t):
+        return free_gpu_num + sum(delta for event_time, delta in events if event_time <= t)
+
+    def pinned_free(pin_gpus, start, end):
+        return all(
+            busy_end <= start or busy_start >= end
+            for gpu in pin_gpus for busy_start, busy_end in busy_gpus.get(gpu, [])
+        )
+
+    def effective_priority(task):
+        waited_hours = (now - task.get("create_timestamp", now)) / 3600
+        return task.get("priority", 0) + waited_hours * aging_per_hour
+
+    schedule = dict()
+    for task in sorted(queue_tasks, key=lambda task: (-effective_priority(task), task.get("create_timestamp", now))):
+        pin_gpus = task["pin_gpus"].split(",") if task.get("pin_gpus") else []
+        want = len(pin_gpus) if pin_gpus else int(task["want_gpus"])
+        duration = (task.get("estimated_minutes") or default_minutes) * 60
+        start = float("inf")
+        for t in sorted({now} | {event_time for event_time, _ in events if event_time > now}):
+            checkpoints = [t] + [event_time for event_time, _ in events if t < event_time < t + duration]
+            if all(free_at(checkpoint) >= want for checkpoint in checkpoints) \
+                    and pinned_free(pin_gpus, t, t + duration):
+                start = t
+                break
+        schedule[task["task_id"]] = start
+        if start != float("inf"):
+            events += [(start, -want), (start + duration, want)]
+            for gpu in pin_gpus:
+                busy_gpus.setdefault(gpu, []).append((start, start + duration))
+    return schedule
+
+
+def get_gpu_schedule(config, redis_client):
+    """
+    根据本机的排队任务、GPU占用信息与当前空闲GPU计算调度结果，见 plan_gpu_schedule
+    """
+    self_occupied_gpus = redis_client.get_self_occupied_gpus(only_gpus=False)
+    running_tasks = [task for task in self_occupied_gpus if task.get("host", redis_client.host) == redis_client.host]
+    occupied_gpus = {int(gpu) for task in running_tasks for gpu in task["use_gpus"].split(",")}
+    free_gpus = select_devices(
+        format="index",
+        min_free_memory=config.cuda_min_free_memory,
+        max_memory_utilization=config.cuda_max_memory_utilization,
+    )
+    queue_tasks = [
+        task for task in redis_client.get_queue_tasks() if task.get("host", redis_client.host) == redis_client.host
+    ]
+    return plan_gpu_schedule(
+        queue_tasks,
+        running_tasks,
+        len(set(free_gpus) - occupied_gpus),
+        time.time(),
+        default_minutes=config.get("gpu_default_estimated_minutes") or 720,
+        aging_per_hour=DEFAULT_GPU_AGING_PER_HOUR if config.get("gpu_aging_per_hour") is None
+        else config.gpu_aging_per_hour,
+    )
+
+
+def log_estimated_start_time(schedule, config):
+    start = schedule.get(config.task_id, float("inf"))
+    if start == float("inf"):
+        log.info("正在排队中！ 暂时无法估计开始时间，等待GPU释放......")
+    else:
+        start_time = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S")
+        log.info(f"正在排队中！ 预计开始时间：{start_time}")
+
+
 def set_config_gpus(config):
-    redis_client = RedisClient()
+    redis_client = RedisClient(lease_ttl=config.get("gpu_lease_ttl") or 60)
+    # 本机已有任务在排队时先加入队列，由调度决定能否立即开始（回填），避免新任务推迟排在前面的任务
+    others_waiting = config.use_gpu and config.wait_gpus and any(
+        task.get("host", redis_client.host) == redis_client.host for task in redis_client.get_queue_tasks()
+    )
     if (
         config.use_gpu
         and isinstance(config.visible_cuda, str)
@@ -1404,13 +1535,17 @@ def set_config_gpus(config):
         )
         self_occupied_gpus = redis_client.get_self_occupied_gpus()
         available_gpus = list(set(gpus) - self_occupied_gpus)
-        if len(available_gpus) > 0 and len(available_gpus) >= min_count:
-            # 有足够可用GPU
+        config.want_gpu_num = min_count
+        task_id = None
+        if not others_waiting and len(available_gpus) > 0 and len(available_gpus) >= min_count:
+            # 有足够可用GPU，原子地登记，登记失败说明GPU刚被其他训练任务抢先登记
+            task_id = redis_client.register_gpus(config, gpus=available_gpus[:min_count])
+        if task_id is not None:
             config.wait_gpus = False
             config.visible_cuda = available_gpus[:min_count]
             config.want_gpu_num = len(config.visible_cuda)
             config.default_device = f"cuda:{config.visible_cuda[0]}"
-            config.task_id = redis_client.register_gpus(config)
+            config.task_id = task_id
             log.info(f"自动选择GPU：{str(config.visible_cuda)}")
         else:
             # 可用GPU不足
@@ -1422,22 +1557,17 @@ def set_config_gpus(config):
                 raise Exception("可用GPU数量不足，建议使用排队功能！")
     elif config.use_gpu:
         # 如果指定了GPU
-        reserve_gpus = config.visible_cuda
-        min_count = len(reserve_gpus)
-        self_occupied_gpus = redis_client.get_self_occupied_gpus()
-        gpu_all_free = True
-        for gpu in reserve_gpus:
-            if gpu in self_occupied_gpus:
-                gpu_all_free = False
-        if not config.wait_gpus and not gpu_all_free:
-            raise Exception("指定GPU并未全部空闲，建议使用排队功能！")
-        elif gpu_all_free:
-            available_gpus = reserve_gpus
+        reserve_gpus = list(config.visible_cuda)
+        config.want_gpu_num = len(reserve_gpus)
+        task_id = None if others_waiting else redis_client.register_gpus(config, gpus=reserve_gpus)
+        if task_id is not None:
             config.wait_gpus = False
-            config.visible_cuda = available_gpus[:min_count]
+            config.visible_cuda = reserve_gpus
             config.want_gpu_num = len(config.visible_cuda)
             config.default_device = f"cuda:{config.visible_cuda[0]}"
-            config.task_id = redis_client.register_gpus(config)
+            config.task_id = task_id
+        elif not config.wait_gpus:
+            raise Exception("指定GPU并未全部空闲，建议使用排队功能！")
         else:
             # 排队
             config.task_id = redis_client.join_wait_queue(config)
@@ -1447,75 +1577,42 @@ def set_config_gpus(config):
 
     ###############################################
     # 检查是否需要等待Gpu
+    # 不再定时轮询，而是阻塞等待 GPU 空闲、任务结束或轮到自己等事件唤醒
     ###############################################
     while config.use_gpu and config.wait_gpus:
-        # 判断当前是否轮到自己
-        if redis_client.is_my_turn(config):
-            # 循环获取当前可用Gpu
+        # 判断当前是否轮到自己：调度结果为立即开始（包括回填），或者是优先级最高的任务
+        schedule = get_gpu_schedule(config, redis_client)
+        my_start = schedule.get(config.task_id, float("inf"))
+        if my_start <= time.time() or next(iter(schedule), None) == config.task_id:
             try:
-                min_count = config.want_gpu_num
-                gpus = select_devices(
-                    format="index",
-                    min_count=min_count,
-                    min_free_memory=config.cuda_min_free_memory,
-                    max_memory_utilization=config.cuda_max_memory_utilization,
-                )
-                self_occupied_gpus = redis_client.get_self_occupied_gpus()
-                if not isinstance(config.visible_cuda, str):
-                    # 如果指定了GPU
-                    reserve_gpus = config.visible_cuda
-                    gpu_all_free = True
-                    for gpu in reserve_gpus:
-                        if gpu in self_occupied_gpus:
-                            gpu_all_free = False
-                    if gpu_all_free:
-                        available_gpus = reserve_gpus
-                    else:
-                        available_gpus = []
-                    min_count = len(reserve_gpus)
-                else:
-                    # 自动选择
-                    available_gpus = list(set(gpus) - self_occupied_gpus)
-
+                available_gpus, min_count = get_available_gpus(config, redis_client)
                 if len(available_gpus) > 0 and len(available_gpus) >= min_count:
-                    # 自动选择，确认等待
-                    if (
-                        config.confirm_gpu_free
-                        and config.last_confirm_gpus == available_gpus[:min_count]
-                    ):
-                        # 如果满足条件退出循环
-                        log.info("发现足够可用GPU并二次确认成功！")
-                        config.wait_gpus = False
-                        config.visible_cuda = available_gpus[:min_count]
-                        config.want_gpu_num = len(config.visible_cuda)
-                        config.default_device = f"cuda:{config.visible_cuda[0]}"
-                        redis_client.pop_wait_queue(config)
-                        config.task_id = redis_client.register_gpus(config)
-                        break
-                    else:
-                        # 设置单次确认空闲
-                        log.info("发现足够可用GPU！即将进行二次确认！")
-                        config.confirm_gpu_free = True
-                        config.last_confirm_gpus = available_gpus[:min_count]
-                        redis_client.update_queue(config)
-                        time.sleep(30)
-                        continue
-                # 重置确认信息
-                log.info("当前无足够可用GPU，继续等待......")
-                if config.confirm_gpu_free:
-                    log.info("二次确认失败，继续等待......")
-                config.confirm_gpu_free = False
-                config.last_confirm_gpus = []
+                    log.info("发现足够可用GPU！正在确认......")
+                    if confirm_gpus_free(config, redis_client, available_gpus[:min_count]):
+                        # 登记GPU与出队在同一个Lua脚本中原子地完成
+                        task_id = redis_client.register_gpus(
+                            config, gpus=available_gpus[:min_count], from_queue=True
+                        )
+                        if task_id is not None:
+                            # 如果满足条件退出循环
+                            log.info("发现足够可用GPU并确认成功！")
+                            config.wait_gpus = False
+                            config.visible_cuda = available_gpus[:min_count]
+                            config.want_gpu_num = len(config.visible_cuda)
+                            config.default_device = f"cuda:{config.visible_cuda[0]}"
+                            config.task_id = task_id
+                            break
+                    log.info("确认失败，继续等待......")
+                else:
+                    log.info("当前无足够可用GPU，继续等待......")
                 redis_client.update_queue(config)
-                time.sleep(30)
             except Exception as e:
                 print_error_info(e)
                 raise e
         else:
             # 排队ing......
-            wait_num = len(redis_client.client.lrange("wait_queue", 0, -1)) - 1
-            log.info(f"正在排队中！ 前方还有 {wait_num} 个训练任务！")
-            time.sleep(60)
+            log_estimated_start_time(schedule, config)
+        redis_client.wait_for_wake_up(config, timeout=config.get("gpu_wait_timeout") or 60)
 
     if config.use_gpu:
         log.info("实验标识： " + config.task_full_name)
@@ -1526,30 +1623,242 @@ def set_config_gpus(config):
     return config
 
 
+###############################################
+# GPU 登记与排队队列的 Lua 脚本
+# 在 Redis 服务端原子地执行，多个训练任务之间不会出现 读取-判断-写入 的竞争
+# 注意：脚本会访问由 租约 key 前缀 + task_id 拼出的、没有在 KEYS 中声明的租约 key，
+# 并遍历整个 self_occupied_gpus 与 wait_queue，因此只支持单实例（或主从）Redis，不支持 Redis Cluster。
+# 登记与排队的任务数量与GPU数量同级，遍历的开销可以忽略
+###############################################
+# KEYS: self_occupied_gpus, wait_queue, wait_queue_ids
+# ARGV: task_id, 逗号分隔的GPU序号, 登记内容, 是否从排队队列中出队（"1"/"0"）, 租约 key 前缀, 租约时长（秒）, 主机名
+# 返回: 1 登记成功; 0 GPU已被占用; -1 当前任务不在排队队列中
+# 租约已过期的登记信息视为已释放并顺便清除；登记成功的同时创建当前任务的租约
+RESERVE_GPUS_SCRIPT = """
+local queued_task = nil
+if ARGV[4] == "1" then
+    for _, task in ipairs(redis.call("LRANGE", KEYS[2], 0, -1)) do
+        if cjson.decode(task)["task_id"] == ARGV[1] then
+            queued_task = task
+            break
+        end
+    end
+    if not queued_task then
+        return -1
+    end
+end
+local wanted = {}
+for gpu in string.gmatch(ARGV[2], "[^,]+") do
+    wanted[gpu] = true
+end
+local tasks = redis.call("HGETALL", KEYS[1])
+for i = 1, #tasks, 2 do
+    if redis.call("EXISTS", ARGV[5] .. tasks[i]) == 0 then
+        redis.call("HDEL", KEYS[1], tasks[i])
+    else
+        local task = cjson.decode(tasks[i + 1])
+        if (task["host"] or ARGV[7]) == ARGV[7] then
+            for gpu in string.gmatch(task["use_gpus"], "[^,]+") do
+                if wanted[gpu] then
+                    return 0
+                end
+            end
+        end
+    end
+end
+redis.call("HSET", KEYS[1], ARGV[1], ARGV[3])
+redis.call("SET", ARGV[5] .. ARGV[1], ARGV[7], "EX", tonumber(ARGV[6]))
+if queued_task then
+    redis.call("LREM", KEYS[2], 1, queued_task)
+    redis.call("SREM", KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# KEYS: wait_queue
+# ARGV: task_id, update_time
+# 返回: 1 更新成功; 0 当前任务不在排队队列中
+UPDATE_QUEUE_TASK_SCRIPT = """
+for index, item in ipairs(redis.call("LRANGE", KEYS[1], 0, -1)) do
+    local task = cjson.decode(item)
+    if task["task_id"] == ARGV[1] then
+        task["update_time"] = ARGV[2]
+        redis.call("LSET", KEYS[1], index - 1, cjson.encode(task))
+        return 1
+    end
+end
+return 0
+"""
+
+# KEYS: wait_queue, wait_queue_ids
+# ARGV: task_id
+# 返回: 出队的任务，当前任务不在排队队列中时返回 nil
+POP_QUEUE_TASK_SCRIPT = """
+redis.call("SREM", KEYS[2], ARGV[1])
+for _, item in ipairs(redis.call("LRANGE", KEYS[1], 0, -1)) do
+    if cjson.decode(item)["task_id"] == ARGV[1] then
+        redis.call("LREM", KEYS[1], 1, item)
+        return item
+    end
+end
+return nil
+"""
+
+# 租约 key 的前缀，每个排队或占用GPU的训练任务都持有一个带过期时间的租约
+LEASE_KEY_PREFIX = "gpu_lease:"
+# 排队中的 task_id 集合，与 wait_queue 同步增删，唤醒排队任务时不需要读取和解析整个队列
+WAIT_QUEUE_IDS_KEY = "wait_queue_ids"
+# task_id --> 当前进程中正在为该任务续约的 LeaseHeartbeat
+LEASE_HEARTBEATS = {}
+
+
+class LeaseHeartbeat(threading.Thread):
+    """
+    后台定期续约训练任务的租约，进程退出或崩溃后不再续约，租约过期后GPU占用和排队信息自动失效
+    """
+
+    def __init__(self, client, lease_key, ttl):
+        super().__init__(daemon=True)
+        self.client = client
+        self.lease_key = lease_key
+        self.ttl = ttl
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            try:
+                if not self.client.expire(self.lease_key, self.ttl):
+                    log.warning(f"租约 {self.lease_key} 已过期，GPU占用信息可能已被清除！")
+            except Exception as e:
+                log.warning(f"续约 {self.lease_key} 失败：{e}")
+
+    def stop(self):
+        self.stop_event.set()
+
+
 class RedisClient:
-    def __init__(self):
-        self.client = Redis(
-            host="127.0.0.1",
-            port=6379,
-            decode_responses=True,
-            charset="UTF-8",
-            encoding="UTF-8",
-        )
+    def __init__(self, client=None, lease_ttl=60):
+        """
+        :param client: 可传入已创建的 Redis 客户端（例如 fakeredis.FakeRedis(decode_responses=True)），默认连接本机 Redis
+        :param lease_ttl: 租约时长（秒），训练任务崩溃后最多经过该时长GPU即被释放
+        """
+        if client is None:
+            client = Redis(
+                host="127.0.0.1",
+                port=6379,
+                decode_responses=True,
+                charset="UTF-8",
+                encoding="UTF-8",
+            )
+        self.client = client
+        self.lease_ttl = lease_ttl
+        self.host = socket.gethostname()
+        self.reserve_gpus_script = self.client.register_script(RESERVE_GPUS_SCRIPT)
+        self.update_queue_task_script = self.client.register_script(UPDATE_QUEUE_TASK_SCRIPT)
+        self.pop_queue_task_script = self.client.register_script(POP_QUEUE_TASK_SCRIPT)
+
+    @staticmethod
+    def get_wake_up_key(task_id):
+        return f"wake_up:{task_id}"
+
+    @staticmethod
+    def get_lease_key(task_id):
+        return LEASE_KEY_PREFIX + task_id
+
+    def get_gpu_info_key(self, index, host=None):
+        """
+        每块GPU的状态保存在一个 hash 中，由 maintain_redis_data.py 维护
+        """
+        return f"gpu_info:{host or self.host}:{index}"
+
+    def get_gpu_watcher_key(self, host=None):
+        return f"gpu_watcher:{host or self.host}"
+
+    def new_task_id(self):
+        """
+        主机名*进程号*时间戳，多台主机共用一个 Redis 时也不会重复
+        """
+        return f"{self.host}*{os.getpid()}*{int(time.time())}"
+
+    def keep_alive(self, task_id):
+        """
+        启动后台线程为 task_id 的租约续约，同一任务只启动一次
+        """
+        if task_id not in LEASE_HEARTBEATS:
+            heartbeat = LeaseHeartbeat(self.client, self.get_lease_key(task_id), self.lease_ttl)
+            heartbeat.start()
+            LEASE_HEARTBEATS[task_id] = heartbeat
+
+    def get_queue_tasks(self):
+        """
+        获取所有租约有效的排队任务，顺便清除租约已过期的任务
+        """
+        queue = self.client.lrange("wait_queue", 0, -1)
+        tasks = [json.loads(item) for item in queue]
+        pipe = self.client.pipeline()
+        for task in tasks:
+            pipe.exists(self.get_lease_key(task["task_id"]))
+        alive = pipe.execute()
+        expired_items = [(item, task) for item, task, task_alive in zip(queue, tasks, alive) if not task_alive]
+        if expired_items:
+            pipe = self.client.pipeline()
+            for item, task in expired_items:
+                pipe.lrem("wait_queue", 1, item)
+                pipe.srem(WAIT_QUEUE_IDS_KEY, task["task_id"])
+            pipe.execute()
+        return [task for task, task_alive in zip(tasks, alive) if task_alive]
+
+    def notify_wait_queue(self, reason="gpu_free"):
+        """
+        唤醒所有排队中的训练任务，使其立即重新计算调度结果
+        GPU 空闲、训练任务结束释放GPU、有任务出队时调用
+        只读取 task_id 集合，过期任务由 get_queue_tasks 清除，残留的唤醒信号会自动过期
+        """
+        pipe = self.client.pipeline()
+        for task_id in self.client.smembers(WAIT_QUEUE_IDS_KEY):
+            wake_up_key = self.get_wake_up_key(task_id)
+            pipe.rpush(wake_up_key, reason)
+            # 只需要一个未处理的唤醒信号，过期时间防止任务异常退出后残留
+            pipe.ltrim(wake_up_key, -1, -1)
+            pipe.expire(wake_up_key, 600)
+        pipe.execute()
+
+    def wait_for_wake_up(self, config, timeout=60):
+        """
+        阻塞直到被唤醒或超时，超时后仍会重新检查一次，防止错过唤醒信号
+        :return: 唤醒原因，超时返回 None
+        """
+        result = self.client.blpop(self.get_wake_up_key(config.task_id), timeout=timeout)
+        return result[1] if result else None
 
     def get_self_occupied_gpus(self, only_gpus=True):
         """
-        获取自己已经占用的Gpu序号
+        获取自己已经占用的Gpu序号，只统计租约仍有效的训练任务，租约已过期的登记信息会被清除
+        :param only_gpus: 为 True 时只返回本机被占用的GPU序号，否则返回所有主机上的登记信息
         """
         self_occupied_gpus = self.client.hgetall("self_occupied_gpus")
+        pipe = self.client.pipeline()
+        for task_id in self_occupied_gpus:
+            pipe.exists(self.get_lease_key(task_id))
+        expired_tasks = [
+            task_id for task_id, alive in zip(self_occupied_gpus, pipe.execute()) if not alive
+        ]
+        if expired_tasks:
+            self.client.hdel("self_occupied_gpus", *expired_tasks)
+        tasks = [
+            json.loads(task) for task_id, task in self_occupied_gpus.items() if task_id not in expired_tasks
+        ]
         if only_gpus:
             all_gpus = []
-            for task in self_occupied_gpus.values():
+            for task in tasks:
+                if task.get("host", self.host) != self.host:
+                    continue
                 gpus = [
-                    int(device) for device in json.loads(task)["use_gpus"].split(",")
+                    int(device) for device in task["use_gpus"].split(",")
                 ]
                 all_gpus.extend(gpus)
             return set(all_gpus)
-        return [json.loads(g) for g in self_occupied_gpus.values()]
+        return tasks
 
     def join_wait_queue(self, config):
         """
@@ -1557,15 +1866,17 @@ class RedisClient:
         """
         curr_time = datetime.datetime.now()
         creat_time = datetime.datetime.strftime(curr_time, "%Y-%m-%d %H:%M:%S")
-        task_id = (
-            str(os.getpid())
-            + "*"
-            + str(int(time.mktime(time.strptime(creat_time, "%Y-%m-%d %H:%M:%S"))))
-        )
+        task_id = config.task_id or self.new_task_id()
         content = {
             "want_gpus": config.want_gpu_num,
+            "priority": config.get("gpu_priority") or 0,
+            "estimated_minutes": config.get("gpu_estimated_minutes"),
+            # 指定了GPU的任务只能使用这几块GPU，调度时按GPU序号检查
+            "pin_gpus": None if isinstance(config.visible_cuda, str) else ",".join(map(str, config.visible_cuda)),
             "create_time": creat_time,
+            "create_timestamp": curr_time.timestamp(),
             "update_time": creat_time,
+            "host": self.host,
             "system_pid": os.getpid(),
             "task_id": task_id,
             "run_notes": config.run_notes,
@@ -1573,66 +1884,62 @@ class RedisClient:
             "comet_name": config.comet_name,
             "logger_project": config.logger_project,
         }
-        wait_num = len(self.client.lrange("wait_queue", 0, -1))
-        self.client.rpush("wait_queue", json.dumps(content))
-        if wait_num == 0:
-            log.info(f"正在排队中！ 目前排第一位哦！")
-        else:
-            log.info(f"正在排队中！ 前方还有 {wait_num} 个训练任务！")
+        # 先创建租约再入队，避免入队后被其他任务当作过期任务清除
+        pipe = self.client.pipeline()
+        pipe.set(self.get_lease_key(task_id), self.host, ex=self.lease_ttl)
+        pipe.rpush("wait_queue", json.dumps(content))
+        pipe.sadd(WAIT_QUEUE_IDS_KEY, task_id)
+        pipe.execute()
+        self.keep_alive(task_id)
         log.info(
-            f"tips: 如果想要对任务进行调整可以移步Redis客户端进行数据修改，只建议进行修改 want_gpus 参数以及删除训练任务操作，其他操作可能会影响Redis读取的稳定性"
+            f"tips: 如果想要对任务进行调整可以移步Redis客户端进行数据修改，只建议进行修改 want_gpus、priority、estimated_minutes 参数以及删除训练任务操作，其他操作可能会影响Redis读取的稳定性"
         )
         return task_id
 
-    def is_my_turn(self, config):
-        """
-        排队这么长时间，是否轮到我了？
-        """
-        curr_task = json.loads(self.client.lrange("wait_queue", 0, -1)[0])
-        return curr_task["task_id"] == config.task_id
-
     def update_queue(self, config):
         """
         更新等待队列
         """
-        task = json.loads(self.client.lrange("wait_queue", 0, -1)[0])
-        if task["task_id"] != config.task_id:
-            # 登记异常信息
-            log.info("当前训练任务并不排在队列第一位，请检查Redis数据正确性！")
         curr_time = datetime.datetime.now()
         update_time = datetime.datetime.strftime(curr_time, "%Y-%m-%d %H:%M:%S")
-        task["update_time"] = update_time
-        self.client.lset("wait_queue", 0, json.dumps(task))
+        if not self.update_queue_task_script(keys=["wait_queue"], args=[config.task_id, update_time]):
+            # 登记异常信息
+            log.info("当前训练任务不在排队队列中，请检查Redis数据正确性！")
+            return
         log.info("更新训练任务时间戳成功！")
 
     def pop_wait_queue(self, config):
         """
-        弹出当前排位第一的训练任务
+        将当前训练任务移出等待队列
         """
-        task = json.loads(self.client.lrange("wait_queue", 0, -1)[0])
-        if task["task_id"] != config.task_id:
+        next_task = self.pop_queue_task_script(keys=["wait_queue", WAIT_QUEUE_IDS_KEY], args=[config.task_id])
+        if next_task is None:
             # 登记异常信息
-            log.info("当前训练任务并不排在队列第一位，请检查Redis数据正确性！")
-        next_task = self.client.lpop("wait_queue")
+            log.info("当前训练任务不在排队队列中，请检查Redis数据正确性！")
+            return None
+        self.client.delete(self.get_wake_up_key(config.task_id))
+        # 调度结果可能发生变化
+        self.notify_wait_queue("queue_pop")
         return next_task
 
-    def register_gpus(self, config):
+    def register_gpus(self, config, gpus=None, from_queue=False):
         """
         将当前训练任务登记到GPU占用信息中
+        检查排队、检查GPU占用、登记、出队在一个 Lua 脚本中原子地完成，不会有两个训练任务同时登记同一块GPU
+        :param gpus: 要登记的GPU，默认为 config.visible_cuda
+        :param from_queue: 是否是排队中的任务，登记成功后同时出队
+        :return: task_id，GPU已被占用或当前任务不在排队队列中时返回 None
         """
+        gpus = list(config.visible_cuda) if gpus is None else list(gpus)
         curr_time = datetime.datetime.now()
         creat_time = datetime.datetime.strftime(curr_time, "%Y-%m-%d %H:%M:%S")
-        if not config.task_id:
-            task_id = (
-                str(os.getpid())
-                + "*"
-                + str(int(time.mktime(time.strptime(creat_time, "%Y-%m-%d %H:%M:%S"))))
-            )
-        else:
-            task_id = config.task_id
+        task_id = config.task_id or self.new_task_id()
         content = {
-            "use_gpus": ",".join([str(gpu) for gpu in list(config.visible_cuda)]),
-            "register_time": datetime.datetime.strftime(curr_time, "%Y-%m-%d %H:%M:%S"),
+            "use_gpus": ",".join([str(gpu) for gpu in gpus]),
+            "register_time": creat_time,
+            "estimated_end": curr_time.timestamp()
+            + (config.get("gpu_estimated_minutes") or config.get("gpu_default_estimated_minutes") or 720) * 60,
+            "host": self.host,
             "system_pid": os.getpid(),
             "task_id": task_id,
             "run_notes": config.run_notes,
@@ -1640,18 +1947,45 @@ class RedisClient:
             "comet_name": config.comet_name,
             "logger_project": config.logger_project,
         }
-        self.client.hset("self_occupied_gpus", task_id, json.dumps(content))
+        status = self.reserve_gpus_script(
+            keys=["self_occupied_gpus", "wait_queue", WAIT_QUEUE_IDS_KEY],
+            args=[
+                task_id,
+                content["use_gpus"],
+                json.dumps(content),
+                "1" if from_queue else "0",
+                LEASE_KEY_PREFIX,
+                self.lease_ttl,
+                self.host,
+            ],
+        )
+        if status == -1:
+            log.info("当前训练任务不在排队队列中，请检查Redis数据正确性！")
+            return None
+        if status == 0:
+            log.info(f"GPU {content['use_gpus']} 已被其他训练任务登记！")
+            return None
+        self.keep_alive(task_id)
+        if from_queue:
+            self.client.delete(self.get_wake_up_key(task_id))
+            # 调度结果可能发生变化
+            self.notify_wait_queue("queue_pop")
         log.info("成功登记Gpu使用信息到Redis服务器！")
         return task_id
 
     def deregister_gpus(self, config):
         """
-        删除当前训练任务的占用信息
+        提前释放当前训练任务的租约与占用信息；即使没有调用，租约也会在进程退出后自动过期
         """
-        task = self.client.hget("self_occupied_gpus", config.task_id)
-        if task:
-            self.client.hdel("self_occupied_gpus", config.task_id)
+        heartbeat = LEASE_HEARTBEATS.pop(config.task_id, None)
+        if heartbeat is not None:
+            heartbeat.stop()
+        pipe = self.client.pipeline()
+        pipe.hdel("self_occupied_gpus", config.task_id)
+        pipe.delete(self.get_lease_key(config.task_id))
+        if pipe.execute()[0]:
             log.info("成功删除Redis服务器上的Gpu使用信息！")
+            self.notify_wait_queue("gpu_released")
         else:
             log.info("无法找到当前训练任务在Redis服务器上的Gpu使用信息！或许可以考虑检查一下Redis的数据 🤔")
 
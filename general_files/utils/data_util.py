@@ -2,8 +2,7 @@ from nltk.corpus import stopwords
 import rich.tree
 from sklearn.model_selection import train_test_split
 from general_files.utils.others.data_processor.processor import get_data_processor
-import pandas as pd
-from datasets import Dataset
+from datasets import Dataset, load_from_disk, concatenate_datasets
 import torch
 from rich.console import Console
 import jieba.analyse as analyse
@@ -19,7 +18,13 @@ import random
 import itertools
 import logging
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
+import numpy as np
+import math
+import importlib
+import inspect
+import hashlib
+import shutil
 
 # 英文表达常见缩写
 CONJUNCTIONS_WORDS_MAP = {
@@ -208,6 +213,93 @@ def get_tokenized_data(config, tokenizer, only_test=False):
     return data_processor.get_dataset()
 
 
+# 会影响预处理结果的配置项，共同决定数据集缓存的地址
+DATASET_CACHE_CONFIG_KEYS = [
+    "dataset",
+    "dataset_version",
+    "dataset_processor",
+    "dataset_part",
+    "dataset_split",
+    "data_mode",
+    "input_shape",
+    "target_shape",
+    "history_len",
+    "encoder_max_length",
+    "decoder_max_length",
+    "sent_max_length",
+    "valid_size",
+    "test_size",
+    "tokenize_method",
+    "pretrain_model",
+    "hf_model_type",
+    "add_special_tokens_for_input",
+    "add_special_tokens_for_label",
+    "add_special_tokens_for_decoder_input",
+    "pack_sequences",
+    "eval_bad_case_analysis",
+]
+DATASET_CACHE_SPLITS = ["train", "valid", "test", "raw_train", "raw_valid", "raw_test"]
+
+
+def get_dataset_cache_path(config, tokenizer, only_test=False):
+    """
+    根据数据处理代码、词表以及影响预处理结果的配置计算数据集缓存的地址
+    缓存放在 public_data_path 下，与 task_full_name 无关，相同配置的运行可以共享同一份缓存
+    """
+    return f"{config.public_data_path}/dataset_cache/{config.dataset}/{get_dataset_cache_hash(config, tokenizer, only_test)}"
+
+
+def get_dataset_cache_hash(config, tokenizer, only_test=False):
+    """
+    数据处理代码、词表与 DATASET_CACHE_CONFIG_KEYS 中配置的哈希，不包含 task_full_name、result_path 等每次运行都不同的配置
+    """
+    module_path = config.logger_project + ".data_processor." + config.dataset_processor
+    processor_class = getattr(importlib.import_module(module_path), "Processor")
+    hasher = hashlib.sha256()
+    processor_modules = []
+    for cls in processor_class.__mro__[:-1]:
+        module = inspect.getmodule(cls)
+        if module not in processor_modules:
+            processor_modules.append(module)
+            hasher.update(inspect.getsource(module).encode())
+    hasher.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode())
+    cache_config = {key: config.get(key) for key in DATASET_CACHE_CONFIG_KEYS}
+    cache_config["only_test"] = only_test
+    hasher.update(json.dumps(cache_config, sort_keys=True, default=str).encode())
+    return hasher.hexdigest()[:16]
+
+
+def save_dataset_cache(datasets, cache_path):
+    """
+    以 Arrow 格式保存数据集缓存，先写入临时目录再整体重命名，避免中断或并发写入产生残缺的缓存
+    :param datasets: (train, valid, test, raw_train, raw_valid, raw_test)，为 None 的部分不保存
+    """
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, dataset in zip(DATASET_CACHE_SPLITS, datasets):
+        if dataset is not None:
+            dataset.save_to_disk(f"{tmp_path}/{name}")
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        if not os.path.exists(cache_path):
+            raise
+        # 其他进程已写好相同的缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    log.info(f"保存数据集缓存成功: {cache_path}")
+
+
+def load_dataset_cache(cache_path):
+    """
+    load_from_disk 以内存映射的方式打开 Arrow 文件，不会把数据复制进内存
+    :return: (train, valid, test, raw_train, raw_valid, raw_test)
+    """
+    return tuple(
+        load_from_disk(f"{cache_path}/{name}") if os.path.exists(f"{cache_path}/{name}") else None
+        for name in DATASET_CACHE_SPLITS
+    )
+
+
 @rank_zero_only
 def print_dataset_overview(
     train_data_tokenized, valid_data_tokenized, test_data_tokenized
@@ -368,9 +460,11 @@ def split_data(ori_data, random_seed, valid_size=0.1, test_size=0.1):
 
 
 def concatenate_multi_datasets(dataset1, dataset2):
-    return Dataset.from_pandas(
-        pd.concat([pd.DataFrame(dataset1), pd.DataFrame(dataset2)], axis=1)
-    )
+    """
+    按下标横向拼接两个等长的数据集，直接在 Arrow 表上拼接而不经过 pandas；重名的列保留 dataset1 中的
+    """
+    duplicated_columns = [column for column in dataset2.column_names if column in dataset1.column_names]
+    return concatenate_datasets([dataset1, dataset2.remove_columns(duplicated_columns)], axis=1)
 
 
 def max_lens(X):
@@ -387,6 +481,38 @@ def max_lens(X):
         raise ValueError("Data list whose dim is greater than 3 is not supported!")
 
 
+def pad_sequences(sequences, pad_value, max_length=None, truncation=True, pad_to_multiple_of=None,
+                  return_attention_mask=False, return_lengths=False):
+    """
+    向量化地将不等长的序列补齐（或截断）并写入预先分配好的 numpy 数组，不逐条拼接 python 列表
+    :param sequences: [[token_id]]
+    :param max_length: 补齐长度，为空则使用最长序列的长度
+    :param truncation: 是否将超过 max_length 的序列截断；否则 max_length 会被扩大到最长序列的长度
+    :param pad_to_multiple_of: int, 将长度补齐为该值的倍数
+    :return: ids: batch_size, max_length；按需额外返回 attention_mask 与截断后的 lengths
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    longest = int(lengths.max()) if len(lengths) > 0 else 0
+    if max_length is None or max_length < 0 or (not truncation and longest > max_length):
+        max_length = longest
+    if pad_to_multiple_of:
+        max_length = math.ceil(max_length / pad_to_multiple_of) * pad_to_multiple_of
+    values = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64, count=int(lengths.sum()))
+    # 每个 token 所在的行以及在行内的位置
+    row_ids = np.repeat(np.arange(len(sequences)), lengths)
+    positions = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    keep = positions < max_length
+    ids = np.full((len(sequences), max_length), pad_value, dtype=np.int64)
+    ids[row_ids[keep], positions[keep]] = values[keep]
+    outputs = (ids,)
+    lengths = np.minimum(lengths, max_length)
+    if return_attention_mask:
+        outputs += ((np.arange(max_length)[None, :] < lengths[:, None]).astype(np.int64),)
+    if return_lengths:
+        outputs += (lengths,)
+    return outputs if len(outputs) > 1 else ids
+
+
 def list2tensor(X, pad_token_id):
     """
     list2tensor
@@ -396,22 +522,13 @@ def list2tensor(X, pad_token_id):
         tensor = torch.tensor(X)
         return tensor
 
-    tensor = torch.zeros(size, dtype=torch.long)
-    lengths = torch.zeros(size[:-1], dtype=torch.long)
     if len(size) == 2:
-        for i, x in enumerate(X):
-            x = torch.tensor(x)
-            l = x.ne(pad_token_id).int().sum().item()
-            tensor[i] = x
-            lengths[i] = l
+        sequences = X
     else:
-        for i, xs in enumerate(X):
-            for j, x in enumerate(xs):
-                x = torch.tensor(x)
-                l = x.ne(pad_token_id).int().sum().item()
-                tensor[i, j] = x
-                lengths[i, j] = l
-
+        # 内层不足的部分用空序列补齐，一次性补齐后再还原形状
+        sequences = [x for xs in X for x in xs + [[]] * (size[1] - len(xs))]
+    tensor = torch.from_numpy(pad_sequences(sequences, pad_token_id, max_length=size[-1])).view(*size)
+    lengths = tensor.ne(pad_token_id).long().sum(-1)
     return tensor, lengths
 
 
@@ -430,8 +547,32 @@ def sequence_mask(lengths, max_len=None):
     return mask
 
 
-def dict_list_to_tensor(ori_list):
+def pad_to_tensor(sequences, pad_token_id, pad_to_multiple_of=None):
+    """
+    将不等长的 id 序列补齐到 batch 内的最大长度并转换为 LongTensor
+    :param sequences: [[token_id]]
+    :param pad_to_multiple_of: int, 将长度补齐为该值的倍数，为空则只补齐到最大长度
+    :return: batch_size, max_len
+    """
+    # 至少保留长度 1，避免整个 batch 都为空序列时得到空张量
+    return torch.from_numpy(pad_sequences(sequences, pad_token_id, max_length=1, truncation=False,
+                                          pad_to_multiple_of=pad_to_multiple_of))
+
+
+def is_id_sequences(values):
+    """
+    判断是否为一维 id 序列组成的列表，即可以被 pad_to_tensor 处理
+    """
+    return all(isinstance(v, list) and (len(v) == 0 or isinstance(v[0], int)) for v in values)
+
+
+def dict_list_to_tensor(ori_list, pad_token_id=None, pad_to_multiple_of=None):
+    """
+    将 [dict] 格式的 batch 转换为 dict of LongTensor
+    如果提供了 pad_token_id，不等长的 id 序列将被动态补齐到当前 batch 的最大长度
+    """
     keys = ori_list[0].keys()
+    int_keys = [key for key in keys if isinstance(ori_list[0][key], int)]
     res = dict()
     for f in ori_list:
         for key in keys:
@@ -440,14 +581,99 @@ def dict_list_to_tensor(ori_list):
             item = [f[key]] if isinstance(f[key], int) else f[key]
             res[key].append(item)
 
-    for key in keys:
-        try:
-            res[key] = torch.LongTensor(res[key])
-        except ValueError:
+    return pad_batch_columns(res, pad_token_id, pad_to_multiple_of, skip_keys=int_keys)
+
+
+# 动态补齐时各列使用的 pad 值，未列出的 id 序列列使用 pad_token_id
+# labels 使用 -100，与 HF 模型及 BasePLModel 的损失函数忽略的标签一致
+COLUMN_PAD_VALUES = {
+    "labels": -100,
+    "position_ids": 0,
+    "segment_ids": 0,
+    "token_type_ids": 0,
+    "attention_mask": 0,
+}
+
+
+def pad_batch_columns(batch, pad_token_id=None, pad_to_multiple_of=None, skip_keys=None, pad_values=None):
+    """
+    将 dict of list 格式的 batch（如 Dataset.map 的 batched 输入）转换为 dict of LongTensor
+    无法转换的列保持原样
+    :param skip_keys: 不进行动态补齐的列
+    :param pad_values: {列名: pad 值}，默认为 COLUMN_PAD_VALUES
+    """
+    skip_keys = skip_keys if skip_keys is not None else []
+    pad_values = pad_values if pad_values is not None else COLUMN_PAD_VALUES
+    res = dict()
+    for key in batch.keys():
+        values = batch[key]
+        if pad_token_id is not None and key not in skip_keys and is_id_sequences(values):
+            res[key] = pad_to_tensor(values, pad_values.get(key, pad_token_id), pad_to_multiple_of)
             continue
+        try:
+            res[key] = torch.LongTensor(values)
+        except (ValueError, TypeError):
+            res[key] = values
     return res
 
 
+def pack_sequences(dataset, max_length, pad_token_id):
+    """
+    将多条较短的样本拼接为长度为 max_length 的一行，用于 decoder-only 模型训练
+    使用 best-fit decreasing 装箱，返回的数据集包含 input_ids、labels、position_ids、segment_ids 四列：
+    position_ids 在每段对话开头重新计数，segment_ids 从 1 开始、0 表示 padding，
+    每段第一个 token 的 label 被置为 pad，保证 loss 不会跨越对话边界
+    :return: packed_dataset, 打包效率（有效 token 数 / 总 token 数）
+    """
+    all_input_ids = dataset["input_ids"]
+    all_labels = dataset["labels"] if "labels" in dataset.column_names else all_input_ids
+    lengths = [min(len(input_ids), max_length) for input_ids in all_input_ids]
+
+    ###############################################
+    # 装箱：每条样本放入剩余空间最小且足够的行
+    ###############################################
+    bins = []
+    bins_by_space = [[] for _ in range(max_length + 1)]
+    for idx in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+        length = lengths[idx]
+        if length == 0:
+            continue
+        for space in range(length, max_length + 1):
+            if bins_by_space[space]:
+                bin_id = bins_by_space[space].pop()
+                break
+        else:
+            bin_id = len(bins)
+            bins.append([])
+            space = max_length
+        bins[bin_id].append(idx)
+        bins_by_space[space - length].append(bin_id)
+
+    ###############################################
+    # 拼接
+    ###############################################
+    packed = {"input_ids": [], "labels": [], "position_ids": [], "segment_ids": []}
+    for bin_indices in bins:
+        input_ids, labels, position_ids, segment_ids = [], [], [], []
+        for segment_id, idx in enumerate(bin_indices, start=1):
+            length = lengths[idx]
+            segment_labels = list(all_labels[idx][:length])
+            segment_labels += [pad_token_id] * (length - len(segment_labels))
+            segment_labels[0] = pad_token_id
+            input_ids.extend(all_input_ids[idx][:length])
+            labels.extend(segment_labels)
+            position_ids.extend(range(length))
+            segment_ids.extend([segment_id] * length)
+        pad_len = max_length - len(input_ids)
+        packed["input_ids"].append(input_ids + [pad_token_id] * pad_len)
+        packed["labels"].append(labels + [pad_token_id] * pad_len)
+        packed["position_ids"].append(position_ids + [0] * pad_len)
+        packed["segment_ids"].append(segment_ids + [0] * pad_len)
+
+    efficiency = sum(lengths) / (len(bins) * max_length) if bins else 0
+    return Dataset.from_dict(packed), efficiency
+
+
 def generate_square_subsequent_mask(seq_tensor):
     """
     生成decoder的上三角矩阵
@@ -676,6 +902,50 @@ def xxt(data):
     plt.show()
 
 
+class LengthBucketBatchSampler(Sampler):
+    """
+    按长度分桶的 batch 采样器
+    先打乱全部样本，每 batch_size * bucket_size_multiplier 个样本为一个桶，桶内按长度排序后切分为 batch，最后打乱 batch 的顺序，
+    使同一 batch 内的样本长度相近，配合动态 padding 减少无效计算
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size_multiplier=100, drop_last=False):
+        super().__init__(lengths)
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start : start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i : i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        num_batches = 0
+        for start in range(0, len(self.lengths), self.bucket_size):
+            bucket_len = min(self.bucket_size, len(self.lengths) - start)
+            if self.drop_last:
+                num_batches += bucket_len // self.batch_size
+            else:
+                num_batches += math.ceil(bucket_len / self.batch_size)
+        return num_batches
+
+
 class DataModule(pl.LightningDataModule):
     def __init__(self, train_dataset, eval_dataset, collate_fn, config):
         super().__init__()
@@ -683,9 +953,21 @@ class DataModule(pl.LightningDataModule):
         self.collate_fn = collate_fn
         self.config = config
 
-    def train_dataloader(self):
+    def get_dataloader(self, dataset):
+        if self.config.get("length_bucketing") and self.config.want_gpu_num <= 1:
+            # 按长度分桶，配合 collate_fn 中的动态 padding 使用
+            lengths = [len(input_ids) for input_ids in dataset["input_ids"]]
+            return DataLoader(
+                dataset,
+                batch_sampler=LengthBucketBatchSampler(
+                    lengths, self.config.train_batch_size, shuffle=True
+                ),
+                pin_memory=self.config.dataloader_pin_memory,
+                num_workers=self.config.dataloader_num_workers,
+                collate_fn=self.collate_fn,
+            )
         return DataLoader(
-            self.train_dataset,
+            dataset,
             batch_size=self.config.train_batch_size,
             shuffle=True,
             pin_memory=self.config.dataloader_pin_memory,
@@ -693,15 +975,11 @@ class DataModule(pl.LightningDataModule):
             collate_fn=self.collate_fn,
         )
 
+    def train_dataloader(self):
+        return self.get_dataloader(self.train_dataset)
+
     def val_dataloader(self):
-        return DataLoader(
-            self.eval_dataset,
-            batch_size=self.config.train_batch_size,
-            shuffle=True,
-            pin_memory=self.config.dataloader_pin_memory,
-            num_workers=self.config.dataloader_num_workers,
-            collate_fn=self.collate_fn,
-        )
+        return self.get_dataloader(self.eval_dataset)
 
 
 def replace_word(texts):
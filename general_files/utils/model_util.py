@@ -1,10 +1,10 @@
 import gensim.downloader as api
+from gensim.models import KeyedVectors
 import numpy as np
 import torch
 import torch.nn.functional as F
 import transformers.modeling_outputs
 from nltk import word_tokenize
-from nltk.translate.bleu_score import corpus_bleu, sentence_bleu, SmoothingFunction
 from nltk.translate.meteor_score import meteor_score
 from nltk.util import ngrams
 from rouge import Rouge
@@ -19,12 +19,34 @@ from statistics import mean
 from sklearn.metrics import accuracy_score
 import re
 import string
-from collections import Counter
+import time
+import json
+import glob
+import hashlib
+import sys
+import os
+import types
+import threading
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import Counter, OrderedDict
+from transformers import AutoModelForCausalLM, AutoTokenizer
 from bert_score import score
-from general_files.utils.others.q_squared.cal_q_squared import calc_scores
+from general_files.utils.others.q_squared.cal_q_squared import (
+    calc_scores,
+    load_qg_model,
+    load_qa_model,
+    load_nli_model,
+)
+from general_files.utils.data_util import pad_to_tensor
 from general_files.modules.pipeline import Pipeline
 from general_files.models.hf_custom import ModelNet
 from evaluate import load
+import pyarrow as pa
+from datasets import Dataset, concatenate_datasets
+from tqdm import tqdm
+import pyarrow.parquet as pq
 
 log = get_logger(__name__)
 
@@ -105,21 +127,6 @@ def get_padding_mask(seq, pad_token_id):
     return mask, seq_lens
 
 
-def get_ppl(df, model, tokenizer):
-    loss_dict = df.map(
-        lambda batch: {"loss": compute_loss(batch, model, tokenizer)},
-        batched=True,
-        batch_size=1,
-        desc="Compute PPL",
-    )
-
-    eval_loss = []
-    for item in list(loss_dict):
-        eval_loss.append(item["loss"])
-    ppl = np.mean(eval_loss)
-    return ppl
-
-
 def get_bert_score(df, config):
     # scorer = BertScorer()
     # scorer.init_scorer(lang='en', num_layers=8, rescale_with_baseline=True)
@@ -143,42 +150,230 @@ def get_q_squared_score(df, config=None):
     generated = df["generated_seqs"]
     knowledge = df["knowledge"]
     # scores = scorer.get_score(target, generated)[-1]
-    q_2_nli, q_2_f1 = calc_scores(generated, knowledge, config=config)
+    qg, qa, nli = [METRIC_REGISTRY.get(name, **kwargs) for name, kwargs in get_metric_scorer_specs("q_squared", config)]
+    q_2_nli, q_2_f1 = calc_scores(generated, knowledge, config=config, qg=qg, qa=qa, nli=nli)
     return round((q_2_nli), 4), round((q_2_f1), 4)
 
 
+###############################################
+# 评价模型注册表
+###############################################
+class MetricRegistry:
+    """
+    进程级的评价模型注册表：每个 scorer 只在第一次使用时加载，
+    之后在测试阶段、超参搜索以及多次 train_or_test 调用之间共享
+    已加载的 scorer 数量超过 max_size，或估计的总内存超过 max_memory（GB）时淘汰最久未使用的 scorer
+    """
+
+    def __init__(self, max_size=8, max_memory=None):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.loaders = dict()
+        self.scorers = OrderedDict()
+        # key --> 加载时估计的 scorer 大小（字节）
+        self.scorer_memory = dict()
+        self.lock = threading.Lock()
+        self.load_locks = dict()
+
+    def register(self, name, loader):
+        self.loaders[name] = loader
+
+    def get(self, name, **kwargs):
+        key = (name, tuple(sorted(kwargs.items())))
+        with self.lock:
+            load_lock = self.load_locks.setdefault(key, threading.Lock())
+        # 同一个 scorer 只会被加载一次，其他线程等待加载完成
+        with load_lock:
+            with self.lock:
+                if key in self.scorers:
+                    self.scorers.move_to_end(key)
+                    return self.scorers[key]
+            start_time = time.perf_counter()
+            scorer = self.loaders[name](**kwargs)
+            log.info(f"加载评价模型 {name} 完成，耗时 {time.perf_counter() - start_time:.2f}s")
+            with self.lock:
+                self.scorers[key] = scorer
+                self.scorer_memory[key] = get_scorer_memory(scorer)
+                # 最近加载的 scorer 本身不会被淘汰
+                while len(self.scorers) > 1 and (len(self.scorers) > self.max_size or self.over_memory()):
+                    evicted_key, _ = self.scorers.popitem(last=False)
+                    evicted_memory = self.scorer_memory.pop(evicted_key)
+                    log.info(f"评价模型缓存已满，释放 {evicted_key[0]}（{evicted_memory / 1024 ** 3:.2f}GB）")
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+            return scorer
+
+    def over_memory(self):
+        return bool(self.max_memory) and sum(self.scorer_memory.values()) > self.max_memory * 1024 ** 3
+
+    def set_limits(self, config):
+        self.max_size = config.get("metric_registry_size") or self.max_size
+        self.max_memory = config.get("metric_registry_memory") or self.max_memory
+
+    def warm_up(self, specs, background=True):
+        """
+        预先加载评价模型，可以在生成的同时在后台线程中进行
+        :param specs: [(name, kwargs)]
+        """
+        def load_all():
+            for name, kwargs in specs:
+                try:
+                    self.get(name, **kwargs)
+                except Exception as e:
+                    print_error_info(e)
+                    log.warning(f"预加载评价模型 {name} 失败，将在计算指标时重新尝试")
+
+        if not background:
+            load_all()
+            return
+        # 不需要等待预加载结束：计算指标时 get 会在同一个 scorer 的加载锁上等待
+        threading.Thread(target=load_all, daemon=True).start()
+
+
+def get_scorer_memory(scorer, depth=3):
+    """
+    估计 scorer 占用的字节数：torch 模型按参数与 buffer，张量与 numpy 数组（如 gensim 词向量）按数据大小，
+    其他对象按 sys.getsizeof，向下查找 depth 层属性与容器元素；scorer 内部延迟加载的模型不计入
+    """
+    if isinstance(scorer, torch.nn.Module):
+        return sum(tensor.numel() * tensor.element_size()
+                   for tensor in itertools.chain(scorer.parameters(), scorer.buffers()))
+    if isinstance(scorer, torch.Tensor):
+        return scorer.numel() * scorer.element_size()
+    if isinstance(scorer, np.ndarray):
+        return scorer.nbytes
+    if isinstance(scorer, (types.ModuleType, type)):
+        return 0
+    size = sys.getsizeof(scorer)
+    if depth == 0:
+        return size
+    if isinstance(scorer, dict):
+        children = itertools.chain(scorer.keys(), scorer.values())
+    elif isinstance(scorer, (tuple, list, set, frozenset)):
+        children = scorer
+    elif hasattr(scorer, "__dict__"):
+        children = vars(scorer).values()
+    else:
+        return size
+    return size + sum(get_scorer_memory(child, depth - 1) for child in children)
 
 
-def compute_loss(batch, model, tokenizer):
-    input_ids, labels = torch.LongTensor(batch["input_ids"]).to(
-        model.device
-    ), torch.LongTensor(batch["labels"]).to(model.device)
-    ignore_columns = [
-        "source",
-        "target",
-        "other_features",
-        "generated",
-        "input_ids",
-        "labels",
-        "decoder_input",
-        "decoder_prompt",
-        "decoder_input_ids",
-    ]
-    other_features = dict()
-    input_ids_len = input_ids.ne(tokenizer.pad_token_id).int().sum(-1).unsqueeze(1)
-    other_features["input_ids_len"] = input_ids_len
-    for k in batch.data.keys():
-        if k not in ignore_columns and "decoder_" in k:
-            try:
-                other_features[k] = torch.LongTensor(batch[k]).to(model.device)
-            except ValueError:
-                other_features[k] = batch[k]
-    with torch.no_grad():
-        model.stage = "train"
-        outputs = model(input_ids=input_ids, labels=labels, **other_features)
-        eval_loss = outputs.lm_loss
-
-    return [eval_loss.exp().item()]
+def load_gpt2_for_ppl(device="cpu"):
+    model = AutoModelForCausalLM.from_pretrained("gpt2").to(device)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained("gpt2")
+    # 与 evaluate 的 perplexity 一致，使用已有的特殊符号作为 pad
+    tokenizer.add_special_tokens({"pad_token": list(tokenizer.special_tokens_map_extended.values())[0]})
+    return model, tokenizer
+
+
+def load_glove(name="glove-wiki-gigaword-100"):
+    """
+    第一次加载后将词向量另存为 gensim 原生格式，之后以内存映射的方式打开，避免每个进程重新解析文本格式
+    """
+    cache_path = os.path.join(api.BASE_DIR, name, f"{name}.kv")
+    if not os.path.exists(cache_path):
+        api.load(name).save(cache_path)
+    return KeyedVectors.load(cache_path, mmap="r")
+
+
+def load_stopwords(path):
+    stopwords = set()
+    with open(path) as f:
+        for line in f:
+            stopwords.add(line.strip())
+    return stopwords
+
+
+def load_nlg_eval():
+    from nlgeval import NLGEval
+
+    return NLGEval()
+
+
+METRIC_REGISTRY = MetricRegistry()
+METRIC_REGISTRY.register("nlg_eval", load_nlg_eval)
+METRIC_REGISTRY.register("gpt2_ppl", load_gpt2_for_ppl)
+METRIC_REGISTRY.register("stopwords", load_stopwords)
+METRIC_REGISTRY.register("glove", load_glove)
+METRIC_REGISTRY.register("q_squared_qg", load_qg_model)
+METRIC_REGISTRY.register("q_squared_qa", load_qa_model)
+METRIC_REGISTRY.register("q_squared_nli", load_nli_model)
+for evaluate_metric in ["google_bleu", "meteor", "rouge", "bertscore", "accuracy"]:
+    METRIC_REGISTRY.register(evaluate_metric, lambda name=evaluate_metric: load(name))
+
+
+def get_metric_scorer_specs(metric_name, config):
+    """
+    :return: 计算该指标需要的评价模型 [(name, kwargs)]
+    """
+    q_squared_kwargs = dict(device=str(config.default_device), cache_dir=config.get("cache_dir"))
+    return {
+        "nlg_eval": [("nlg_eval", dict())],
+        "ppl": [("gpt2_ppl", dict(device=str(config.default_device)))],
+        "google_bleu": [("google_bleu", dict())],
+        "meteor": [("meteor", dict())],
+        "rouge": [("rouge", dict())],
+        "bert_score": [("bertscore", dict())],
+        "cls_acc": [("accuracy", dict())],
+        # 顺序与 get_q_squared_score 中的 qg, qa, nli 一致
+        "q_squared": [("q_squared_qg", q_squared_kwargs),
+                      ("q_squared_qa", q_squared_kwargs),
+                      ("q_squared_nli", q_squared_kwargs)],
+    }.get(metric_name, [])
+
+
+def warm_up_metrics(config, background=True):
+    """
+    在生成测试结果的同时，在后台预加载需要设备的评价指标的模型
+    CPU 指标在进程池中计算，其模型由子进程在第一次计算该指标时加载，见 init_metric_worker
+    """
+    METRIC_REGISTRY.set_limits(config)
+    specs = [spec for metric in config.eval_metrics
+             if metric in EVAL_METRICS and EVAL_METRICS[metric][1]
+             for spec in get_metric_scorer_specs(metric, config)]
+    METRIC_REGISTRY.warm_up(specs, background=background)
+
+
+def init_metric_worker(config):
+    """
+    指标进程池子进程的初始化函数：不预加载模型，每个子进程只在计算某个指标时才加载它需要的模型，
+    避免每个子进程都持有一份全部 CPU 指标的模型
+    """
+    METRIC_REGISTRY.set_limits(config)
+
+
+def compute_perplexity(predictions, model, tokenizer, batch_size=16):
+    """
+    与 evaluate 0.3.0 的 perplexity 指标一致（包括其使用的 exp2），但复用已加载的 GPT-2
+    """
+    device = model.device
+    # 为 BOS 预留一个位置，截断长度与 evaluate 相同，取自 model.config.max_length
+    max_tokenized_len = model.config.max_length - 1
+    encodings = tokenizer(predictions, add_special_tokens=False, padding=True,
+                          truncation=True if max_tokenized_len else False, max_length=max_tokenized_len,
+                          return_tensors="pt", return_attention_mask=True).to(device)
+    encoded_texts = encodings["input_ids"]
+    attn_masks = encodings["attention_mask"]
+    loss_fct = torch.nn.CrossEntropyLoss(reduction="none")
+    ppls = []
+    for start_index in range(0, len(encoded_texts), batch_size):
+        encoded_batch = encoded_texts[start_index: start_index + batch_size]
+        attn_mask = attn_masks[start_index: start_index + batch_size]
+        bos_tokens_tensor = torch.full((encoded_batch.size(0), 1), tokenizer.bos_token_id, device=device)
+        encoded_batch = torch.cat([bos_tokens_tensor, encoded_batch], dim=1)
+        attn_mask = torch.cat([torch.ones_like(bos_tokens_tensor), attn_mask], dim=1)
+        with torch.no_grad():
+            out_logits = model(encoded_batch, attention_mask=attn_mask).logits
+        shift_logits = out_logits[..., :-1, :].contiguous()
+        shift_labels = encoded_batch[..., 1:].contiguous()
+        shift_attention_mask = attn_mask[..., 1:].contiguous()
+        perplexity_batch = torch.exp2(
+            (loss_fct(shift_logits.transpose(1, 2), shift_labels) * shift_attention_mask).sum(1)
+            / shift_attention_mask.sum(1)
+        )
+        ppls += perplexity_batch.tolist()
+    return np.mean(ppls)
 
 
 def clean_text(text):
@@ -188,30 +383,107 @@ def clean_text(text):
     return re.sub(" +", " ", text).strip()
 
 
-def compute_f1(test_df):
+class TokenizedCorpus:
+    """
+    测试集的共享分词结果：候选与参考只分词一次，token 被映射为整数 id，
+    并预先统计 1~max_n 阶 n-gram 计数，供 BLEU、Dist、F1 共用
+    """
+
+    def __init__(self, candidates, references, f1_references=None, max_n=4):
+        self.vocab = dict()
+        self.max_n = max_n
+        self.candidates = [self.encode(word_tokenize(candidate)) for candidate in candidates]
+        self.references = [
+            [self.encode(word_tokenize(ref)) for ref in (reference if type(reference) is list else [reference])]
+            for reference in references
+        ]
+        self.candidate_ngrams = [self.count_ngrams(candidate) for candidate in self.candidates]
+        # F1 沿用 q-squared 的清洗与空格分词方式
+        self.f1_candidates = [Counter(self.encode(clean_text(candidate).split())) for candidate in candidates]
+        self.f1_references = [Counter(self.encode(clean_text(reference).split())) for reference in f1_references] \
+            if f1_references is not None else None
+
+    def encode(self, tokens):
+        return tuple(self.vocab.setdefault(token, len(self.vocab)) for token in tokens)
+
+    def count_ngrams(self, token_ids):
+        """
+        :return: [Counter]，第 n-1 个元素为 n 阶 n-gram 的计数
+        """
+        return [Counter(ngrams(token_ids, n)) for n in range(1, self.max_n + 1)]
+
+    @staticmethod
+    def get_ngram_rows(sequences, n):
+        """
+        将若干 token id 序列中的全部 n 阶 n-gram 展开为二维数组
+        :return: rows: (num_ngrams, n)，seq_index: (num_ngrams,) 每个 n-gram 所在序列的下标
+        """
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        flat = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.int64, count=int(lengths.sum()))
+        ngram_nums = np.maximum(lengths - n + 1, 0)
+        seq_index = np.repeat(np.arange(len(sequences)), ngram_nums)
+        # 每个 n-gram 在 flat 中的起始位置 = 所在序列的起始位置 + 在序列中的偏移
+        offsets = np.cumsum(lengths) - lengths
+        ngram_offsets = np.arange(len(seq_index)) - np.repeat(np.cumsum(ngram_nums) - ngram_nums, ngram_nums)
+        starts = offsets[seq_index] + ngram_offsets
+        rows = flat[starts[:, None] + np.arange(n)]
+        return rows, seq_index
+
+    def get_bleu_statistics(self):
+        """
+        每个样本只统计一次 1~max_n 阶的截断匹配数，供所有 BLEU 权重共用
+        截断方式与 nltk 的 modified_precision 一致：候选中每个 n-gram 的计数不超过其在各参考中的最大计数
+        每一阶把 (样本下标, n-gram) 统一映射为整数 id 后用 bincount 计数，不逐条样本构造 Counter
+        :return: numerators, denominators: (num_examples, max_n)；hyp_lengths, closest_ref_lengths: (num_examples,)
+        """
+        num_examples = len(self.candidates)
+        references = [ref for refs in self.references for ref in refs]
+        # 每条参考所属的样本下标
+        ref_example = np.repeat(np.arange(num_examples), [len(refs) for refs in self.references])
+        hyp_lengths = np.array([len(candidate) for candidate in self.candidates], dtype=np.int64)
+        numerators = np.zeros((num_examples, self.max_n), dtype=np.int64)
+        denominators = np.zeros((num_examples, self.max_n), dtype=np.int64)
+        for n in range(1, self.max_n + 1):
+            denominators[:, n - 1] = np.maximum(1, hyp_lengths - n + 1)
+            cand_rows, cand_example = self.get_ngram_rows(self.candidates, n)
+            ref_rows, ref_index = self.get_ngram_rows(references, n)
+            if len(cand_rows) == 0 or len(ref_rows) == 0:
+                continue
+            keys = np.concatenate([
+                np.concatenate([cand_example[:, None], cand_rows], axis=1),
+                np.concatenate([ref_example[ref_index][:, None], ref_rows], axis=1),
+            ])
+            unique_keys, key_ids = np.unique(keys, axis=0, return_inverse=True)
+            key_ids = key_ids.reshape(-1)
+            num_keys = len(unique_keys)
+            cand_counts = np.bincount(key_ids[:len(cand_rows)], minlength=num_keys)
+            # 每条参考中每个 n-gram 的计数，再取各参考中的最大值
+            ref_pairs, ref_counts = np.unique(ref_index * num_keys + key_ids[len(cand_rows):], return_counts=True)
+            max_ref_counts = np.zeros(num_keys, dtype=np.int64)
+            np.maximum.at(max_ref_counts, ref_pairs % num_keys, ref_counts)
+            numerators[:, n - 1] = np.bincount(unique_keys[:, 0], weights=np.minimum(cand_counts, max_ref_counts),
+                                               minlength=num_examples).astype(np.int64)
+        closest_ref_lengths = np.array([
+            min((len(ref) for ref in refs), key=lambda ref_len: (abs(ref_len - hyp_len), ref_len))
+            for refs, hyp_len in zip(self.references, hyp_lengths)
+        ], dtype=np.int64)
+        return numerators, denominators, hyp_lengths, closest_ref_lengths
+
+
+def compute_f1(test_df, corpus=None, ndigits=2):
     """
     This function is copied from: https://github.com/orhonovich/q-squared/blob/main/pipeline/score.py
+    2PR/(P+R) 等价于 2*num_same/(len_pred+len_gold)，在共享的词频表上向量化计算
+    :param ndigits: 保留的小数位数，为 None 时不取整
     """
-    candidates = test_df["generated_seqs"]
-    references = test_df["f1_reference"]
-    f1_list = []
-    for i, a_gold in enumerate(references):
-        a_pred = candidates[i]
-        if a_pred == "":
-            f1_list.append(0)
-            continue
-        gold_toks = clean_text(a_gold).split()
-        pred_toks = clean_text(a_pred).split()
-        common = Counter(gold_toks) & Counter(pred_toks)
-        num_same = sum(common.values())
-        if num_same == 0:
-            f1_list.append(0)
-            continue
-        precision = 1.0 * num_same / len(pred_toks)
-        recall = 1.0 * num_same / len(gold_toks)
-        f1 = (2 * precision * recall) / (precision + recall)
-        f1_list.append(f1)
-    return round(sum(f1_list) / len(f1_list) * 100, 2)
+    if corpus is None or corpus.f1_references is None:
+        corpus = TokenizedCorpus(test_df["generated_seqs"], test_df["f1_reference"], test_df["f1_reference"], max_n=1)
+    num_same = np.array([sum((gold & pred).values()) for gold, pred in zip(corpus.f1_references, corpus.f1_candidates)])
+    pred_len = np.array([sum(pred.values()) for pred in corpus.f1_candidates])
+    gold_len = np.array([sum(gold.values()) for gold in corpus.f1_references])
+    f1_list = np.where(num_same > 0, 2 * num_same / np.maximum(pred_len + gold_len, 1), 0)
+    f1 = f1_list.mean() * 100
+    return round(f1, ndigits) if ndigits is not None else f1
 
 
 def compute_chrf(references, candidates):
@@ -224,51 +496,45 @@ def compute_sacre_bleu(references, candidates):
     return round(bleu.corpus_score(candidates, [references]).score, 4)
 
 
-def compute_sent_bleu(references, candidates):
-    bleu1 = 0.0
-    bleu2 = 0.0
-    bleu3 = 0.0
-    bleu4 = 0.0
-    ref_list, dec_list = [], []
-    for i in range(len(candidates)):
-        dec_list.append(word_tokenize(candidates[i]))
-        if type(references[i]) is list:
-            tmp = []
-            for ref in references[i]:
-                tmp.append(word_tokenize(ref))
-            ref_list.append(tmp)
-        else:
-            ref_list.append([word_tokenize(references[i])])
-
-    for example_id, (label, pred) in enumerate(zip(ref_list, dec_list)):
-        bleu1 += sentence_bleu(
-            label,
-            pred,
-            weights=[1, 0, 0, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu2 += sentence_bleu(
-            label,
-            pred,
-            weights=[0.5, 0.5, 0, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu3 += sentence_bleu(
-            label,
-            pred,
-            weights=[1 / 3, 1 / 3, 1 / 3, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu4 += sentence_bleu(
-            label,
-            pred,
-            weights=[0.25, 0.25, 0.25, 0.25],
-            smoothing_function=SmoothingFunction().method3,
-        )
-    bleu1 = bleu1 / len(ref_list)
-    bleu2 = bleu2 / len(ref_list)
-    bleu3 = bleu3 / len(ref_list)
-    bleu4 = bleu4 / len(ref_list)
+# BLEU-1 ~ BLEU-4 的累积权重与单阶权重
+SENT_BLEU_WEIGHTS = np.array([
+    [1, 0, 0, 0],
+    [1 / 2, 1 / 2, 0, 0],
+    [1 / 3, 1 / 3, 1 / 3, 0],
+    [1 / 4, 1 / 4, 1 / 4, 1 / 4],
+])
+CORPUS_BLEU_WEIGHTS = np.eye(4)
+
+
+def brevity_penalty(closest_ref_lengths, hyp_lengths):
+    """
+    与 nltk 一致：候选长于参考时为 1，候选为空时为 0
+    """
+    closest_ref_lengths = np.asarray(closest_ref_lengths, dtype=np.float64)
+    hyp_lengths = np.asarray(hyp_lengths, dtype=np.float64)
+    ratio = closest_ref_lengths / np.maximum(hyp_lengths, 1)
+    return np.where(hyp_lengths > closest_ref_lengths, 1.0, np.where(hyp_lengths == 0, 0.0, np.exp(1 - ratio)))
+
+
+def compute_sent_bleu(references, candidates, corpus=None, ndigits=4):
+    """
+    在共享的 n-gram 计数上批量计算 sentence BLEU-1~4，结果与 nltk 的 sentence_bleu + SmoothingFunction().method3 一致：
+    method3 将第 k 个为 0 的精度替换为 1 / (2^k * 分母)
+    :param ndigits: 保留的小数位数，为 None 时不取整
+    """
+    corpus = corpus if corpus is not None else TokenizedCorpus(candidates, references)
+    numerators, denominators, hyp_lengths, closest_ref_lengths = corpus.get_bleu_statistics()
+    zero_counts = np.cumsum(numerators == 0, axis=1)
+    precisions = np.where(numerators == 0,
+                          1 / (2.0 ** zero_counts * denominators),
+                          numerators / denominators)
+    # batch_size, 4
+    scores = brevity_penalty(closest_ref_lengths, hyp_lengths)[:, None] * np.exp(np.log(precisions) @ SENT_BLEU_WEIGHTS.T)
+    # nltk 在 unigram 无匹配时直接返回 0
+    scores = np.where(numerators[:, :1] == 0, 0.0, scores)
+    if ndigits is None:
+        return tuple(scores.mean(axis=0) * 100)
+    bleu1, bleu2, bleu3, bleu4 = scores.mean(axis=0)
     return (
         round(bleu1 * 100, 4),
         round(bleu2 * 100, 4),
@@ -277,25 +543,19 @@ def compute_sent_bleu(references, candidates):
     )
 
 
-def compute_corpus_bleu(references, candidates):
-    bleu1 = 0.0
-    bleu2 = 0.0
-    bleu3 = 0.0
-    bleu4 = 0.0
-    ref_list, dec_list = [], []
-    for i in range(len(candidates)):
-        dec_list.append(word_tokenize(candidates[i]))
-        if type(references[i]) is list:
-            tmp = []
-            for ref in references[i]:
-                tmp.append(word_tokenize(ref))
-            ref_list.append(tmp)
-        else:
-            ref_list.append([word_tokenize(references[i])])
-    bleu1 = corpus_bleu(ref_list, dec_list, weights=(1, 0, 0, 0))
-    bleu2 = corpus_bleu(ref_list, dec_list, weights=(0, 1, 0, 0))
-    bleu3 = corpus_bleu(ref_list, dec_list, weights=(0, 0, 1, 0))
-    bleu4 = corpus_bleu(ref_list, dec_list, weights=(0, 0, 0, 1))
+def compute_corpus_bleu(references, candidates, corpus=None):
+    """
+    结果与 nltk 的 corpus_bleu（默认 method0 平滑）一致：分子分母在整个语料上累加后再计算精度
+    """
+    corpus = corpus if corpus is not None else TokenizedCorpus(candidates, references)
+    numerators, denominators, hyp_lengths, closest_ref_lengths = corpus.get_bleu_statistics()
+    numerators, denominators = numerators.sum(axis=0), denominators.sum(axis=0)
+    if numerators[0] == 0:
+        return 0.0, 0.0, 0.0, 0.0
+    precisions = np.where(numerators == 0, sys.float_info.min, numerators / denominators)
+    scores = brevity_penalty(closest_ref_lengths.sum(), hyp_lengths.sum()) \
+        * np.exp(CORPUS_BLEU_WEIGHTS @ np.log(precisions))
+    bleu1, bleu2, bleu3, bleu4 = scores
     return (
         round(bleu1 * 100, 4),
         round(bleu2 * 100, 4),
@@ -331,17 +591,13 @@ def compute_rouge(references, candidates):
     )
 
 
-def distinct_ngram(candidates, n=2):
-    """Return basic ngram statistics, as well as a dict of all ngrams and their freqsuencies."""
-    ngram_freqs = {}  # ngrams with frequencies
-    ngram_len = 0  # total number of ngrams
-    for candidate in candidates:
-        for ngram in ngrams(word_tokenize(candidate), n):
-            ngram_freqs[ngram] = ngram_freqs.get(ngram, 0) + 1
-            ngram_len += 1
-    # number of unique ngrams
-    uniq_ngrams = len([val for val in ngram_freqs.values() if val == 1])
-    distinct_ngram = len(ngram_freqs) / ngram_len if ngram_len > 0 else 0
+def distinct_ngram(candidates, n=2, corpus=None):
+    """Return the ratio of unique ngrams to all ngrams over the candidates."""
+    corpus = corpus if corpus is not None else TokenizedCorpus(candidates, candidates, max_n=n)
+    ngram_counts = [ngram_count[n - 1] for ngram_count in corpus.candidate_ngrams]
+    ngram_len = sum(sum(ngram_count.values()) for ngram_count in ngram_counts)
+    uniq_ngram_len = len(set().union(*ngram_counts))
+    distinct_ngram = uniq_ngram_len / ngram_len if ngram_len > 0 else 0
     return round(distinct_ngram, 4)
 
 
@@ -353,11 +609,7 @@ def knowledge_f1(references, candidates, work_dir):
     res = 0.0
     r = 0.0
     p = 0.0
-    stopwords = set()
-    with open(f"{work_dir}/data/stopwords.txt") as f:
-        for line in f:
-            word = line.strip()
-            stopwords.add(word)
+    stopwords = METRIC_REGISTRY.get("stopwords", path=f"{work_dir}/data/stopwords.txt")
 
     for candidate, reference in zip(candidates, references):
         cnt += 1
@@ -393,40 +645,51 @@ def knowledge_f1(references, candidates, work_dir):
     return recall, precision, f1
 
 
-def compute_cos_sim(references, candidates, work_dir):
-    # load pre-trained word-vectors from gensim-data
-    word_vectors = api.load("glove-wiki-gigaword-100")
-    vocab_list = word_vectors.index_to_key
-
-    stopwords = set()
-    with open(f"{work_dir}/data/stopwords.txt") as f:
-        for line in f:
-            word = line.strip()
-            stopwords.add(word)
+class EmbeddingSimilarityScorer:
+    """
+    基于词向量的句子相似度，与 gensim 的 n_similarity 一致：去停用词后的词向量取均值、单位化后求内积
+    词表使用哈希表 O(1) 查询，词向量矩阵以内存映射方式加载，整个测试集的句向量通过一次批量矩阵运算得到
+    """
 
-    sim_list = []
-    for i in range(len(candidates)):
-        dec_set = set()
-        for word in word_tokenize(candidates[i]):
-            word = word.lower()
-            if word in vocab_list:
-                dec_set.add(word)
-        dec_set = dec_set - stopwords
-        dec_list = list(dec_set)
-        if len(dec_list) == 0:
-            continue
+    def __init__(self, word_vectors, stopwords):
+        self.key_to_index = word_vectors.key_to_index
+        self.vectors = word_vectors.vectors
+        self.stopwords = stopwords
+
+    def get_word_indices(self, sentence):
+        words = {word.lower() for word in word_tokenize(sentence)} - self.stopwords
+        return [self.key_to_index[word] for word in words if word in self.key_to_index]
+
+    def get_sentence_vectors(self, sentences):
+        """
+        :return: sentence_vectors: num_sentences, dim 的单位化句向量；lengths: 每句有效词的数量，为 0 时句向量全为 0
+        """
+        indices_list = [self.get_word_indices(sentence) for sentence in sentences]
+        lengths = np.array([len(indices) for indices in indices_list], dtype=np.int64)
+        sums = np.zeros((len(indices_list), self.vectors.shape[1]), dtype=np.float32)
+        non_empty = lengths > 0
+        if non_empty.any():
+            flat_indices = np.fromiter(itertools.chain.from_iterable(indices_list), dtype=np.int64, count=lengths.sum())
+            offsets = (np.cumsum(lengths) - lengths)[non_empty]
+            sums[non_empty] = np.add.reduceat(self.vectors[flat_indices], offsets, axis=0)
+        means = sums / np.maximum(lengths, 1)[:, None]
+        norms = np.linalg.norm(means, axis=1, keepdims=True)
+        return means / np.where(norms > 0, norms, 1), lengths
+
+    def score(self, references, candidates):
+        candidate_vectors, candidate_lengths = self.get_sentence_vectors(candidates)
+        reference_vectors, reference_lengths = self.get_sentence_vectors(references)
+        # 任一侧没有有效词的样本不参与计算
+        valid = (candidate_lengths > 0) & (reference_lengths > 0)
+        return (candidate_vectors[valid] * reference_vectors[valid]).sum(axis=1)
 
-        ref_set = set()
-        for word in word_tokenize(references[i]):
-            word = word.lower()
-            if word in vocab_list:
-                ref_set.add(word)
-        ref_set = ref_set - stopwords
-        ref_list = list(ref_set)
-        # compute cosine similarity between two sets of docvecs from the trained set
-        cos_sim = word_vectors.n_similarity(dec_list, ref_list)
-        sim_list.append(cos_sim)
 
+def compute_cos_sim(references, candidates, work_dir):
+    scorer = EmbeddingSimilarityScorer(
+        METRIC_REGISTRY.get("glove"),
+        METRIC_REGISTRY.get("stopwords", path=f"{work_dir}/data/stopwords.txt"),
+    )
+    sim_list = scorer.score(references, candidates)
     avg_sim = np.mean(sim_list)
     cos_similarity = round(avg_sim, 4)
     return cos_similarity
@@ -436,245 +699,328 @@ def compute_cls_acc(references, candidates):
     return accuracy_score(references, candidates)
 
 
-def get_eval_metrics(test_df, config, tokenizer):
+###############################################
+# 各项评价指标
+# 每个指标接收 columns（测试集各列组成的 dict）与 config，返回需要合并到测试结果中的 dict
+###############################################
+def eval_nlg_eval(columns, config):
+    nlgeval = METRIC_REGISTRY.get("nlg_eval")
+    metrics_dict = nlgeval.compute_metrics([columns["reference"]], columns["generated_seqs"])
+    for key, value in metrics_dict.items():
+        metrics_dict[key] = round(value, 4)
+    return metrics_dict
+
+
+def eval_ppl(columns, config):
+    try:
+        model, tokenizer = METRIC_REGISTRY.get("gpt2_ppl", device=str(config.default_device))
+        ppl = compute_perplexity(columns["generated_seqs"], model, tokenizer)
+    except Exception as e:
+        log.error("计算 PPL 失败")
+        print_error_info(e)
+        ppl = 9999
+    return {"ppl": ppl}
+
+
+def eval_f1(columns, config):
+    return {"f1": compute_f1(columns, corpus=columns.get("corpus"), ndigits=None)}
+
+
+def eval_google_bleu(columns, config):
+    google_bleu = METRIC_REGISTRY.get("google_bleu")
+    try:
+        google_bleu_score = google_bleu.compute(
+            predictions=columns["generated_seqs"], references=columns["reference"]
+        )["google_bleu"]
+        google_bleu_score = google_bleu_score * 100
+    except Exception as e:
+        log.error("计算 google_bleu 失败")
+        print_error_info(e)
+        google_bleu_score = 9999
+    return {"google_bleu": round(google_bleu_score, 4)}
+
+
+def eval_sacrebleu(columns, config):
+    return {"sacrebleu": compute_sacre_bleu(columns["reference"], columns["generated_seqs"])}
+
+
+def eval_sent_bleu(columns, config):
+    bleu1, bleu2, bleu3, bleu4 = compute_sent_bleu(columns["reference"], columns["generated_seqs"],
+                                                   corpus=columns.get("corpus"), ndigits=None)
+    return {"sent_bleu1": bleu1, "sent_bleu2": bleu2, "sent_bleu3": bleu3, "sent_bleu4": bleu4}
+
+
+def eval_corpus_bleu(columns, config):
+    bleu1, bleu2, bleu3, bleu4 = compute_corpus_bleu(columns["reference"], columns["generated_seqs"],
+                                                     corpus=columns.get("corpus"))
+    return {"corpus_bleu1": bleu1, "corpus_bleu2": bleu2, "corpus_bleu3": bleu3, "corpus_bleu4": bleu4}
+
+
+def eval_dist(columns, config):
+    return {
+        "dist1": distinct_ngram(columns["generated_seqs"], n=1, corpus=columns.get("corpus")),
+        "dist2": distinct_ngram(columns["generated_seqs"], n=2, corpus=columns.get("corpus")),
+    }
+
+
+def eval_meteor(columns, config):
+    meteor = METRIC_REGISTRY.get("meteor")
+    meteor_score = meteor.compute(predictions=columns["generated_seqs"], references=columns["reference"])['meteor']
+    return {"meteor": meteor_score}
+
+
+def eval_charf(columns, config):
+    return {"charf": compute_chrf(columns["reference"], columns["generated_seqs"])}
+
+
+def eval_rouge(columns, config):
+    rouge = METRIC_REGISTRY.get("rouge")
+    rouge_results = rouge.compute(predictions=columns["generated_seqs"], references=columns["reference"])
+    return {
+        "rouge_1": round(rouge_results['rouge1'], 4),
+        "rouge_2": round(rouge_results['rouge2'], 4),
+        "rouge_L": round(rouge_results['rougeL'], 4),
+        "rouge_Lsum": round(rouge_results['rougeLsum'], 4),
+    }
+
+
+def eval_bert_score(columns, config):
+    bertscore = METRIC_REGISTRY.get("bertscore")
+    bert_score = mean(bertscore.compute(predictions=columns["generated_seqs"],
+                                        references=columns["bert_score_reference"],
+                                        lang="en",
+                                        rescale_with_baseline=True,
+                                        device=config.default_device)['f1'])
+    return {"bert_score": bert_score}
+
+
+def eval_q_squared(columns, config):
+    q_squared_nli, q_squared_f1 = get_q_squared_score(columns, config=config)
+    return {"q_squared_nli": q_squared_nli, "q_squared_f1": q_squared_f1}
+
+
+def eval_cls_acc(columns, config):
+    accuracy_metric = METRIC_REGISTRY.get("accuracy")
+    cls_acc = accuracy_metric.compute(
+        references=columns["reference"], predictions=columns["generated_seqs"]
+    )["accuracy"]
+    return {"cls_acc": cls_acc}
+
+
+# 指标名称 --> (计算函数, 是否需要使用模型所在的设备)
+# 不需要设备的指标在进程池中并行计算，需要设备的指标在主进程的线程中同时计算
+EVAL_METRICS = {
+    "nlg_eval": (eval_nlg_eval, False),
+    "ppl": (eval_ppl, True),
+    "f1": (eval_f1, False),
+    "google_bleu": (eval_google_bleu, False),
+    "sacrebleu": (eval_sacrebleu, False),
+    "sent_bleu": (eval_sent_bleu, False),
+    "corpus_bleu": (eval_corpus_bleu, False),
+    "dist": (eval_dist, False),
+    "meteor": (eval_meteor, False),
+    "charf": (eval_charf, False),
+    "rouge": (eval_rouge, False),
+    "bert_score": (eval_bert_score, True),
+    "q_squared": (eval_q_squared, True),
+    "cls_acc": (eval_cls_acc, False),
+}
+
+
+METRIC_PROCESS_POOL = None
+# 模型很大（NLGEval 会加载 skip-thought 与 GloVe 词向量）的 CPU 指标，只在一个专用子进程中计算，进程内只保留一份
+HEAVY_CPU_EVAL_METRICS = {"nlg_eval"}
+HEAVY_METRIC_PROCESS_POOL = None
+
+
+def get_cpu_eval_metrics(config):
+    return [metric for metric in config.eval_metrics or [] if metric in EVAL_METRICS and not EVAL_METRICS[metric][1]]
+
+
+def new_metric_process_pool(num_workers, config):
+    # 主进程已初始化 CUDA 并持有多个线程，fork 不安全，因此使用 forkserver（不可用时为 spawn）启动
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=num_workers,
+                               mp_context=multiprocessing.get_context(start_method),
+                               initializer=init_metric_worker, initargs=(config,))
+
+
+def get_metric_process_pool(config, metric=None):
+    """
+    进程池在进程内复用，子进程中已加载的评价模型可以在多次评估之间共享
+    HEAVY_CPU_EVAL_METRICS 中的指标使用只有一个子进程的专用进程池，其余 CPU 指标共用一个进程池，进程数不超过这些指标的数量
+    """
+    global METRIC_PROCESS_POOL, HEAVY_METRIC_PROCESS_POOL
+    if metric in HEAVY_CPU_EVAL_METRICS:
+        if HEAVY_METRIC_PROCESS_POOL is None:
+            HEAVY_METRIC_PROCESS_POOL = new_metric_process_pool(1, config)
+        return HEAVY_METRIC_PROCESS_POOL
+    light_metrics = [metric for metric in get_cpu_eval_metrics(config) if metric not in HEAVY_CPU_EVAL_METRICS]
+    num_workers = max(min(config.get("eval_num_workers") or os.cpu_count(), len(light_metrics)), 1)
+    if METRIC_PROCESS_POOL is None or METRIC_PROCESS_POOL._max_workers != num_workers:
+        if METRIC_PROCESS_POOL is not None:
+            METRIC_PROCESS_POOL.shutdown()
+        METRIC_PROCESS_POOL = new_metric_process_pool(num_workers, config)
+    return METRIC_PROCESS_POOL
+
+
+def round_metric_result(metric_name, metric_result):
+    """
+    CHUNKED_EVAL_METRICS 中的指标函数返回未取整的结果，在这里按各自的小数位数取整
+    """
+    if metric_result is None or metric_name not in CHUNKED_EVAL_METRICS:
+        return metric_result
+    return {key: round(value, CHUNKED_EVAL_METRICS[metric_name]) for key, value in metric_result.items()}
+
+
+def run_eval_metric(metric_name, columns, config, raw=False):
+    """
+    计算单个指标并计时，失败时只影响该指标本身
+    :param raw: 为 True 时不取整，供 ChunkedEvaluator 合并分片结果
+    :return: metric_name, 指标结果（失败为 None）, 耗时
+    """
+    start_time = time.perf_counter()
+    try:
+        metric_result = EVAL_METRICS[metric_name][0](columns, config)
+        if not raw:
+            metric_result = round_metric_result(metric_name, metric_result)
+    except Exception as e:
+        print_error_info(e)
+        log.error(f"计算 {metric_name} 失败，请检查生成数据！")
+        metric_result = None
+    return metric_name, metric_result, time.perf_counter() - start_time
+
+
+# 使用共享分词结果 TokenizedCorpus 的指标，只有这些指标的任务会带上 corpus 列
+CORPUS_EVAL_METRICS = {"sent_bleu", "corpus_bleu", "dist", "f1"}
+
+
+def get_eval_columns(test_df, eval_metrics):
+    """
+    取出计算评价指标所需的列，测试集中没有 reference 列时返回 None
+    """
+    if "reference" not in test_df.column_names:
+        return None
+    columns = Result(
+        generated_seqs=test_df["generated_seqs"] if "generated_seqs" in test_df.column_names else test_df["generated"],
+        reference=test_df["reference"],
+    )
+    for column in ["f1_reference", "bert_score_reference", "knowledge"]:
+        if column in test_df.column_names:
+            columns[column] = test_df[column]
+    if set(eval_metrics) & CORPUS_EVAL_METRICS:
+        # n-gram 类指标共用一次分词结果
+        columns["corpus"] = TokenizedCorpus(columns["generated_seqs"], columns["reference"],
+                                            columns.get("f1_reference"))
+    return columns
+
+
+def submit_eval_metrics(eval_metrics, columns, config, thread_pool, raw=False):
+    """
+    CPU 指标提交到进程池，需要设备的指标提交到 thread_pool，提交本身不等待评价模型加载
+    :return: [Future]，结果为 run_eval_metric 的返回值
+    """
+    METRIC_REGISTRY.set_limits(config)
+    # 提交到进程池的参数会被序列化，不需要 corpus 的指标不携带它
+    columns_without_corpus = Result(**{key: value for key, value in columns.items() if key != "corpus"})
+    return [
+        (thread_pool if EVAL_METRICS[metric][1] else get_metric_process_pool(config, metric)).submit(
+            run_eval_metric, metric, columns if metric in CORPUS_EVAL_METRICS else columns_without_corpus, config, raw
+        )
+        for metric in eval_metrics
+    ]
+
+
+# 结果为逐条样本得分均值的指标，可以在生成过程中对已完成的分片计算，最后按样本数加权平均合并
+# 指标名称 --> 保留的小数位数，分片结果不取整，合并后只取整一次
+CHUNKED_EVAL_METRICS = {"ppl": 4, "f1": 2, "sent_bleu": 4, "meteor": 4, "bert_score": 4}
+
+
+class ChunkedEvaluator:
+    """
+    在测试集仍在生成时，对已生成完的分片计算 CHUNKED_EVAL_METRICS 中的指标
+    分片的分词与指标提交都在 dispatcher 线程中进行，生成线程只负责把分片放入队列，不会被阻塞
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.eval_metrics = [metric for metric in config.eval_metrics or [] if metric in CHUNKED_EVAL_METRICS]
+        self.dispatcher = ThreadPoolExecutor(max_workers=1)
+        self.thread_pool = ThreadPoolExecutor(max_workers=1)
+        # [(分片样本数, Future)]，Future 的结果为该分片各指标的 [Future]，没有 reference 列时为 None
+        self.chunk_futures = []
+
+    def submit(self, chunk):
+        """
+        :param chunk: 已经过 map_column 的测试输出分片
+        """
+        if not self.eval_metrics:
+            return
+        self.chunk_futures.append((len(chunk), self.dispatcher.submit(self.dispatch, chunk)))
+
+    def dispatch(self, chunk):
+        columns = get_eval_columns(chunk, self.eval_metrics)
+        if columns is None:
+            return None
+        return submit_eval_metrics(self.eval_metrics, columns, self.config, self.thread_pool, raw=True)
+
+    def results(self):
+        """
+        等待所有分片计算完成并按样本数加权合并
+        :return: {metric_name: 指标结果}，任一分片计算失败的指标不返回，交由 get_eval_metrics 在完整测试集上重新计算
+        """
+        chunk_results = {metric: [] for metric in self.eval_metrics}
+        for num_rows, dispatch_future in self.chunk_futures:
+            for future in dispatch_future.result() or []:
+                metric_name, metric_result, _ = future.result()
+                chunk_results[metric_name].append((num_rows, metric_result))
+        self.dispatcher.shutdown()
+        self.thread_pool.shutdown()
+        metric_results = dict()
+        for metric, results in chunk_results.items():
+            if not results or any(result is None for _, result in results):
+                continue
+            total_rows = sum(num_rows for num_rows, _ in results)
+            metric_results[metric] = round_metric_result(metric, {
+                key: sum(num_rows * result[key] for num_rows, result in results) / total_rows
+                for key in results[0][1]
+            })
+        return metric_results
+
+
+def get_eval_metrics(test_df, config, tokenizer, chunk_results=None):
     """
     评价指标计算
+    CPU 指标在进程池中计算，需要设备的指标同时在主进程的线程中计算，总耗时约等于最慢的一个指标
     :param config:
     :param test_df: Dataframe类型,必须要包含的column为 [generated, reference, other_features, input_ids, labels]
+    :param chunk_results: ChunkedEvaluator 在生成过程中已经算好的指标，不再重复计算
     :return: dict
     """
     test_result = Result()
-    eval_metrics = config.eval_metrics
-    if "generated_seqs" in test_df.column_names:
-        generated_seqs = test_df["generated_seqs"]
-    else:
-        generated_seqs = test_df["generated"]
-    if "reference" in test_df.column_names:
-        reference = test_df["reference"]
-    else:
+    chunk_results = chunk_results or dict()
+    eval_metrics = [metric for metric in config.eval_metrics if metric in EVAL_METRICS]
+    for metric in set(config.eval_metrics) - set(EVAL_METRICS):
+        log.warning(f"未知的评价指标：{metric}")
+    remaining_metrics = [metric for metric in eval_metrics if metric not in chunk_results]
+    columns = get_eval_columns(test_df, remaining_metrics)
+    if columns is None:
         return test_result
-
-    ###############################################
-    # 计算 nlg_eval
-    ###############################################
-    if "nlg_eval" in eval_metrics:
-        from nlgeval import NLGEval
-
-        log.info("计算 nlg_eval ing...")
-        try:
-            nlgeval = NLGEval()  # loads the models
-            metrics_dict = nlgeval.compute_metrics([reference], generated_seqs)
-            for key, value in metrics_dict.items():
-                metrics_dict[key] = round(value, 4)
-            log.info(f"nlg_eval = {str(metrics_dict)}")
-            test_result.merge_or_update(metrics_dict)
-        except Exception as e:
-            print_error_info(e)
-            log.error("计算 nlg_eval 失败")
-
-    ###############################################
-    # 计算 PPL
-    ###############################################
-    if "ppl" in eval_metrics:
-        log.info("计算 PPL ing...")
-        perplexity = load("perplexity", module_type="metric")
-        try:
-            ppl = perplexity.compute(predictions=generated_seqs, model_id="gpt2")[
-                "mean_perplexity"
-            ]
-        except Exception as e:
-            log.error("计算 PPL 失败")
-            print_error_info(e)
-            ppl = 9999
-        # ppl = get_ppl(test_df, model, tokenizer)
-        ppl = round(ppl, 4)
-        test_result.add(ppl=ppl)
-        log.info(f"PPL = {str(ppl)}")
-
-    ###############################################
-    # 计算 f1
-    ###############################################
-    if "f1" in eval_metrics:
-        log.info("计算 F1 ing...")
-        f1 = compute_f1(test_df)
-        test_result.add(f1=f1)
-        log.info(f"f1 = {str(f1)}")
-
-    ###############################################
-    # 计算 google_bleu
-    ###############################################
-    if "google_bleu" in eval_metrics:
-        log.info("计算 google_bleu ing...")
-        google_bleu = load("google_bleu")
-        try:
-            google_bleu_score = google_bleu.compute(
-                predictions=generated_seqs, references=reference
-            )["google_bleu"]
-            google_bleu_score = google_bleu_score * 100
-        except Exception as e:
-            log.error("计算 google_bleu 失败")
-            print_error_info(e)
-            google_bleu_score = 9999
-        google_bleu_score = round(google_bleu_score, 4)
-        test_result.add(google_bleu=google_bleu_score)
-        log.info(f"google_bleu = {str(google_bleu_score)}")
-
-    ###############################################
-    # 计算 sacrebleu
-    ###############################################
-    if "sacrebleu" in eval_metrics:
-        log.info("计算 Sacre BLEU ing...")
-        bleu = compute_sacre_bleu(reference, generated_seqs)
-        test_result.add(sacrebleu=bleu)
-        log.info(f"sacrebleu = {str(bleu)}")
-
-    ###############################################
-    # 计算 sent_bleu
-    ###############################################
-    if "sent_bleu" in eval_metrics:
-        bleu1, bleu2, bleu3, bleu4 = compute_sent_bleu(reference, generated_seqs)
-        test_result.add(
-            sent_bleu1=bleu1,
-            sent_bleu2=bleu2,
-            sent_bleu3=bleu3,
-            sent_bleu4=bleu4,
-        )
-        log.info(f"sent_bleu1 = {str(bleu1)}")
-        log.info(f"sent_bleu2 = {str(bleu2)}")
-        log.info(f"sent_bleu3 = {str(bleu3)}")
-        log.info(f"sent_bleu4 = {str(bleu4)}")
-
-    ###############################################
-    # 计算 corpus_bleu
-    ###############################################
-    if "corpus_bleu" in eval_metrics:
-        bleu1, bleu2, bleu3, bleu4 = compute_corpus_bleu(reference, generated_seqs)
-        test_result.add(
-            corpus_bleu1=bleu1,
-            corpus_bleu2=bleu2,
-            corpus_bleu3=bleu3,
-            corpus_bleu4=bleu4,
-        )
-        log.info(f"corpus_bleu1 = {str(bleu1)}")
-        log.info(f"corpus_bleu2 = {str(bleu2)}")
-        log.info(f"corpus_bleu3 = {str(bleu3)}")
-        log.info(f"corpus_bleu4 = {str(bleu4)}")
-
-    ###############################################
-    # 计算 Dist
-    ###############################################
-    if "dist" in eval_metrics:
-        log.info("计算 Dist ing...")
-        dist1 = distinct_ngram(generated_seqs, n=1)
-        dist2 = distinct_ngram(generated_seqs, n=2)
-        test_result.add(
-            dist1=dist1,
-            dist2=dist2,
-        )
-        log.info(f"dist1 = {str(dist1)}")
-        log.info(f"dist2 = {str(dist2)}")
-
-    ###############################################
-    # 计算 Meteor
-    ###############################################
-    if "meteor" in eval_metrics:
-        log.info("计算 Meteor ing...")
-        meteor = load('meteor')
-        meteor_score = meteor.compute(predictions=generated_seqs, references=reference)['meteor']
-        meteor_score = round(meteor_score, 4)
-        # meteor_score = compute_meteor(reference, generated_seqs)
-        test_result.add(meteor=meteor_score)
-        log.info(f"meteor = {str(meteor_score)}")
-
-    ###############################################
-    # 计算 CharF
-    ###############################################
-    if "charf" in eval_metrics:
-        log.info("计算 chrF ing...")
-        charf = compute_chrf(reference, generated_seqs)
-        test_result.add(charf=charf)
-        log.info(f"charf = {str(charf)}")
-
-    ###############################################
-    # 计算 ROUGE
-    ###############################################
-    if "rouge" in eval_metrics:
-        log.info("计算 ROUGE ing...")
-        try:
-            rouge = load('rouge')
-            
-            rouge_results = rouge.compute(predictions=generated_seqs,
-                        references=reference)
-            # rouge_1, rouge_2, rouge_l = compute_rouge(reference, generated_seqs)
-            # test_result.add(rouge_1=rouge_1)
-            # test_result.add(rouge_2=rouge_2)
-            # test_result.add(rouge_l=rouge_l)
-            rouge_1 = round(rouge_results['rouge1'], 4)
-            rouge_2 = round(rouge_results['rouge2'], 4)
-            rouge_L = round(rouge_results['rougeL'], 4)
-            rouge_Lsum = round(rouge_results['rougeLsum'], 4)
-            test_result.add(rouge_1=rouge_1)
-            test_result.add(rouge_2=rouge_2)
-            test_result.add(rouge_L=rouge_L)
-            test_result.add(rouge_Lsum=rouge_Lsum)
-            log.info(f"rouge_1 = {str(rouge_1)}")
-            log.info(f"rouge_2 = {str(rouge_2)}")
-            log.info(f"rouge_L = {str(rouge_L)}")
-            log.info(f"rouge_Lsum = {str(rouge_Lsum)}")
-            
-        except Exception as e:
-            print_error_info(e)
-            log.info("Rouge 无法计算，Reference可能为空，请检查生成数据！")
-
-    ###############################################
-    # 计算 Bert Score
-    ###############################################
-    if "bert_score" in eval_metrics:
-        log.info("计算 Bert score ing...")
-        
-        try:
-            # scores = get_bert_score(test_df, config)
-            # test_result.add(bert_score=scores)
-            bertscore = load("bertscore")
-            bert_score_reference = test_df["bert_score_reference"]           
-            bert_score = mean(bertscore.compute(predictions=generated_seqs, references=bert_score_reference, lang="en", rescale_with_baseline=True)['f1'])
-            bert_score = round(bert_score, 4)
-            test_result.add(bert_score=bert_score)
-            log.info(f"bert_score = {str(bert_score)}")
-        except ValueError:
-            log.info("bert_score 无法计算，Reference可能为空，请检查生成数据！")
-
-    ###############################################
-    # 计算 q_squared
-    ###############################################
-    if "q_squared" in eval_metrics:
-        log.info("计算 q_squared ing...")
-        
-        try:
-            q_squared_nli, q_squared_f1 = get_q_squared_score(test_df, config=config)
-            test_result.add(q_squared_nli=q_squared_nli)
-            test_result.add(q_squared_f1=q_squared_f1)
-            log.info(f"q_squared_nli = {str(q_squared_nli)}")
-            log.info(f"q_squared_f1 = {str(q_squared_f1)}")
-        except Exception as e:
-            print_error_info(e)
-            log.info("q_squared 无法计算，请检查数据！")
-
-    ###############################################
-    # 计算 分类 Accuracy
-    ###############################################
-    if "cls_acc" in eval_metrics:
-        log.info("计算 分类 Accuracy ing...")
-        try:
-            accuracy_metric = load("accuracy")
-            cls_acc = accuracy_metric.compute(
-                references=reference, predictions=generated_seqs
-            )["accuracy"]
-        except Exception as e:
-            print_error_info(e)
-            accuracy_metric = 0
-        # cls_acc = compute_cls_acc(reference, generated_seqs)
-        test_result.add(cls_acc=cls_acc)
+    log.info(f"计算评价指标 ing...: {', '.join(remaining_metrics)}")
+
+    metric_results = dict(chunk_results)
+    device_metrics = [metric for metric in remaining_metrics if EVAL_METRICS[metric][1]]
+    with ThreadPoolExecutor(max_workers=max(len(device_metrics), 1)) as thread_pool:
+        futures = submit_eval_metrics(remaining_metrics, columns, config, thread_pool)
+        for future in as_completed(futures):
+            metric_name, metric_result, cost_time = future.result()
+            metric_results[metric_name] = metric_result
+            log.info(f"{metric_name} = {str(metric_result)}，耗时 {cost_time:.2f}s")
+
+    # 按配置中的顺序合并结果
+    for metric in eval_metrics:
+        if metric_results[metric] is not None:
+            test_result.merge_or_update(metric_results[metric])
 
     print_dict_to_table(
         test_result,
@@ -721,104 +1067,161 @@ def nucleus_generate(
     model=None,
     **other_features,
 ):
-    generated_ids = None
-    past_result = None
-    for i in range(max_length):
-        past_result = model(input_ids, decoder_input_ids, past_result, **other_features)
-        logits = past_result["logits"][:, -1, :]
-        logits = logits / temperature
-
-        filtered_logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+    def sample_next_token(logits):
+        filtered_logits = top_k_top_p_filtering(
+            logits, top_k=top_k, top_p=top_p, temperature=temperature
+        )
         probabilities = F.softmax(filtered_logits, dim=-1)
+        return torch.multinomial(probabilities, 1).squeeze(-1)
+
+    return generate_with_early_stop(
+        input_ids,
+        decoder_input_ids,
+        decoder_eos_token_id,
+        next_token_fn=sample_next_token,
+        max_length=max_length,
+        model=model,
+        **other_features,
+    )
 
-        next_token = torch.multinomial(probabilities, 1)
-        pred_index = next_token.detach().cpu()
 
-        if (pred_index == decoder_eos_token_id).int().sum() == len(pred_index):
-            break
-        generated_ids = (
-            torch.cat([generated_ids, pred_index], dim=-1)
-            if generated_ids is not None
-            else pred_index
-        )
-        if decoder_input_ids is not None:
-            decoder_input_ids = torch.cat(
-                [decoder_input_ids, pred_index.to(decoder_input_ids.device)], dim=-1
-            )
-        else:
-            input_ids = torch.cat([input_ids, pred_index.to(input_ids.device)], dim=-1)
-    for i, s in enumerate(generated_ids):
-        ss = s.tolist()
-        if decoder_eos_token_id in ss:
-            generated_ids[i][ss.index(decoder_eos_token_id) :] = decoder_eos_token_id
-    return generated_ids.tolist()
+def greedy_generate(
+    input_ids: torch.Tensor,
+    decoder_input_ids: torch.Tensor,
+    decoder_eos_token_id: int,
+    max_length: int = 100,
+    model=None,
+    **other_features,
+):
+    return generate_with_early_stop(
+        input_ids,
+        decoder_input_ids,
+        decoder_eos_token_id,
+        next_token_fn=lambda logits: torch.argmax(logits, dim=-1),
+        max_length=max_length,
+        model=model,
+        **other_features,
+    )
 
 
-def greedy_generate(
+def generate_with_early_stop(
     input_ids: torch.Tensor,
     decoder_input_ids: torch.Tensor,
     decoder_eos_token_id: int,
+    next_token_fn=None,
     max_length: int = 100,
     model=None,
     **other_features,
 ):
-    generated_ids = None
+    """
+    自定义生成方法的公共解码循环
+    所有状态都保存在模型所在的设备上，输出按 max_length 预先分配；
+    某一行生成 eos 后即连同其编码结果、缓存和特征一起移出活跃 batch，最后按原始下标写回
+    :param next_token_fn: 输入最后一个位置的 logits (active_batch_size, vocab_size)，返回下一个 token (active_batch_size,)
+    :return: [[token_id]]，eos 之后的位置均为 eos
+    """
+    batch_size = input_ids.size(0)
+    generated_ids = input_ids.new_full((batch_size, max_length), decoder_eos_token_id)
+    active_rows = torch.arange(batch_size, device=input_ids.device)
+
+    # encoder-decoder 模型在 decoder_input_ids 后追加，decoder-only 模型在 input_ids 后追加
+    prefix_ids = decoder_input_ids if decoder_input_ids is not None else input_ids
+    prefix_len = prefix_ids.size(1)
+    sequences = torch.cat([prefix_ids, prefix_ids.new_zeros((batch_size, max_length))], dim=-1)
+
     past_result = None
-    softmax = torch.nn.Softmax(dim=-1)
-    for _ in range(max_length):
-        past_result = model(input_ids, decoder_input_ids, past_result, **other_features)
-        probabilities = softmax(past_result["logits"][:, -1, :])
-        next_token = torch.multinomial(probabilities, 1)
-        pred_index = next_token.detach().cpu()
-        if (pred_index == decoder_eos_token_id).int().sum() == len(pred_index):
-            break
-        generated_ids = (
-            torch.cat([generated_ids, pred_index], dim=-1)
-            if generated_ids is not None
-            else pred_index
-        )
+    step = 0
+    for step in range(max_length):
+        curr_len = prefix_len + step
         if decoder_input_ids is not None:
-            decoder_input_ids = torch.cat(
-                [decoder_input_ids, pred_index.to(decoder_input_ids.device)], dim=-1
+            past_result = model.generate_step(
+                input_ids, sequences[:, :curr_len], past_result, **other_features
             )
         else:
-            input_ids = torch.cat([input_ids, pred_index.to(input_ids.device)], dim=-1)
-    for i, s in enumerate(generated_ids):
-        ss = s.tolist()
-        if decoder_eos_token_id in ss:
-            generated_ids[i][ss.index(decoder_eos_token_id) :] = decoder_eos_token_id
-    return generated_ids.tolist()
+            past_result = model.generate_step(
+                sequences[:, :curr_len], None, past_result, **other_features
+            )
+        next_token = next_token_fn(past_result["logits"][:, -1, :])
+        sequences[:, curr_len] = next_token
+        generated_ids[active_rows, step] = next_token
+
+        unfinished = next_token.ne(decoder_eos_token_id)
+        if not unfinished.all():
+            if not unfinished.any():
+                break
+            ###############################################
+            # 移除已经结束的行
+            ###############################################
+            keep_rows = unfinished.nonzero().squeeze(-1)
+            active_rows = active_rows[keep_rows]
+            sequences = sequences[keep_rows]
+            input_ids = input_ids[keep_rows]
+            past_result = model.select_rows(past_result, keep_rows)
+            other_features = model.select_rows(other_features, keep_rows)
+    return generated_ids[:, : step + 1].tolist()
 
 
 def top_k_top_p_filtering(
-    batch_logits, top_k=10, top_p=0.9, filter_value=-10000.0
+    batch_logits,
+    top_k=10,
+    top_p=0.9,
+    filter_value=-10000.0,
+    temperature=1.0,
+    min_tokens_to_keep=1,
 ) -> torch.tensor:
+    """
+    批量 top-k/top-p 过滤，整个 batch 在一次张量运算中完成
+    top_k、top_p、temperature 可以是标量，也可以是长度为 batch_size 的列表或张量，以便逐行设置
+    :param batch_logits: batch_size, vocab_size
+    :param top_k: 小于等于 0 时不进行 top-k 过滤
+    :param top_p: 小于等于 0 时不进行 top-p 过滤
+    :param min_tokens_to_keep: 每行至少保留的 token 数
+    :return: batch_size, vocab_size
+    """
     assert batch_logits.dim() == 2
-    for index in range(batch_logits.shape[0]):
-        logits = batch_logits[index]
-        top_k = min(top_k, logits.size(-1))
-        if top_k > 0:
-            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-            logits[indices_to_remove] = filter_value
-
-        if top_p > 0.0:
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    batch_size, vocab_size = batch_logits.shape
+    device = batch_logits.device
+
+    def per_row(value, dtype):
+        return torch.as_tensor(value, dtype=dtype, device=device).expand(batch_size).unsqueeze(-1)
+
+    logits = batch_logits / per_row(temperature, batch_logits.dtype)
+    top_k = per_row(top_k, torch.long)
+    top_p = per_row(top_p, batch_logits.dtype)
+    top_k = torch.where(
+        top_k > 0,
+        top_k.clamp(min=min_tokens_to_keep, max=vocab_size),
+        torch.full_like(top_k, vocab_size),
+    )
 
-            sorted_indices_to_remove = cumulative_probs > top_p
-            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
-                ..., :-1
-            ].clone()
-            sorted_indices_to_remove[..., 0] = 0
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    # 与第 k 大的值比较，保留并列的 token
+    kth_logits = sorted_logits.gather(-1, top_k - 1)
+    sorted_indices_to_remove = sorted_logits < kth_logits
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    # 右移一位，保证第一个超过 top_p 的 token 也被保留
+    exceed_top_p = torch.cat(
+        [
+            torch.zeros_like(cumulative_probs[:, :1], dtype=torch.bool),
+            cumulative_probs[:, :-1] > top_p,
+        ],
+        dim=-1,
+    )
+    sorted_indices_to_remove |= exceed_top_p & (top_p > 0)
+    sorted_indices_to_remove[:, :min_tokens_to_keep] = False
 
-            indices_to_remove = sorted_indices[sorted_indices_to_remove]
-            logits[indices_to_remove] = filter_value
-            batch_logits[index] = logits
-    return batch_logits
+    indices_to_remove = sorted_indices_to_remove.scatter(
+        -1, sorted_indices, sorted_indices_to_remove
+    )
+    return logits.masked_fill(indices_to_remove, filter_value)
 
 
 def generate_sentences(model, batch, tokenizer, config):
-    input_ids = torch.LongTensor(batch["input_ids"]).to(model.device)
+    input_ids = pad_to_tensor(
+        batch["input_ids"], tokenizer.pad_token_id, config.get("pad_to_multiple_of")
+    ).to(model.device)
     other_features = model.prepare_other_features_for_generation(batch)
     if config.data_mode == "unilm":
         max_len = config.max_generation_length + len(input_ids[0])
@@ -834,6 +1237,7 @@ def generate_sentences(model, batch, tokenizer, config):
             # Generate with nucleus search.
             generated_ids = nucleus_generate(
                 input_ids=input_ids,
+                decoder_input_ids=model.get_decoder_start_ids(input_ids),
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 top_k=config.top_k,
                 top_p=config.top_p,
@@ -846,6 +1250,7 @@ def generate_sentences(model, batch, tokenizer, config):
             # Generate with greedy search.
             generated_ids = greedy_generate(
                 input_ids=input_ids,
+                decoder_input_ids=model.get_decoder_start_ids(input_ids),
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 max_length=max_len,
                 model=model,
@@ -878,6 +1283,7 @@ def generate_sentences(model, batch, tokenizer, config):
             # Generate with nucleus search.
             generated_ids = nucleus_generate(
                 input_ids=input_ids,
+                decoder_input_ids=model.get_decoder_start_ids(input_ids),
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 top_k=config.top_k,
                 top_p=config.top_p,
@@ -910,9 +1316,172 @@ def generate_sentences(model, batch, tokenizer, config):
 
 def predict_labels(model, batch, tokenizer, config):
     model.eval()
-    input_ids = torch.LongTensor(batch["input_ids"]).to(model.device)
+    input_ids = pad_to_tensor(
+        batch["input_ids"], tokenizer.pad_token_id, config.get("pad_to_multiple_of")
+    ).to(model.device)
     other_features = model.prepare_other_features_for_generation(batch)
-    for key in other_features.keys():
-        other_features[key] = other_features[key].to(model.device)
     generated_ids = model(input_ids=input_ids, **other_features)["predict_labels"]
     return generated_ids.cpu().tolist()
+
+
+###############################################
+# 生成结果缓存
+###############################################
+# 影响生成结果的解码配置，任一项改变都会使用新的缓存
+GENERATION_CACHE_CONFIG_KEYS = [
+    "data_mode",
+    "generate_method",
+    "top_k",
+    "top_p",
+    "beam_size",
+    "temperature",
+    "max_generation_length",
+    "min_generation_length",
+    "num_return_sequences",
+    "do_sample",
+    # 采样解码的结果取决于随机种子
+    "seed",
+]
+
+
+def get_ckpt_file_hash(ckpt_file):
+    """
+    以 checkpoint 文件的绝对路径、大小与修改时间标识其中的权重，不需要读取或遍历权重
+    覆盖写入同一路径时修改时间会变化，旧的缓存不会被误用
+    """
+    stat = os.stat(ckpt_file)
+    identity = [os.path.realpath(ckpt_file), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256(json.dumps(identity).encode()).hexdigest()[:16]
+
+
+class GenerationCache:
+    """
+    按 (checkpoint 文件标识, 解码配置, 样本输入哈希) 逐条缓存生成结果
+    缓存以 parquet 分片的形式追加写入 public_data_path/generation_cache 下，
+    生成中断后可以从断点继续，修改解码配置时只需重新生成未缓存的样本
+    ckpt_file 为空（例如刚训练完、权重只在内存中）时不读写磁盘缓存
+    """
+
+    def __init__(self, ckpt_file, config, flush_size=256):
+        self.cache_path = None
+        self.flush_size = flush_size
+        self.cache = {}
+        self.buffer = []
+        if ckpt_file is None:
+            return
+        decoding_config = {key: config.get(key) for key in GENERATION_CACHE_CONFIG_KEYS}
+        decoding_hash = hashlib.sha256(
+            json.dumps(decoding_config, sort_keys=True, default=str).encode()
+        ).hexdigest()[:16]
+        self.cache_path = f"{config.public_data_path}/generation_cache/{get_ckpt_file_hash(ckpt_file)}/{decoding_hash}"
+        os.makedirs(self.cache_path, exist_ok=True)
+        for part in sorted(glob.glob(f"{self.cache_path}/part-*.parquet")):
+            table = pq.read_table(part)
+            self.cache.update(
+                zip(table.column("key").to_pylist(), table.column("generated").to_pylist())
+            )
+        if self.cache:
+            log.info(f"发现生成结果缓存 {len(self.cache)} 条: {self.cache_path}")
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    @staticmethod
+    def get_example_keys(batch):
+        """
+        对 batch 中每个样本的全部输入列计算哈希
+        """
+        columns = sorted(batch.keys())
+        return [
+            hashlib.sha256(
+                json.dumps([batch[c][i] for c in columns], default=str).encode()
+            ).hexdigest()
+            for i in range(len(batch[columns[0]]))
+        ]
+
+    def get(self, key):
+        return json.loads(self.cache[key])
+
+    def add(self, key, generated):
+        self.cache[key] = json.dumps(generated, ensure_ascii=False)
+        self.buffer.append(key)
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """
+        将新增的生成结果写成一个新的分片，先写临时文件再重命名，避免中断时留下残缺的分片
+        """
+        if not self.buffer or self.cache_path is None:
+            self.buffer = []
+            return
+        table = pa.table(
+            {
+                "key": self.buffer,
+                "generated": [self.cache[key] for key in self.buffer],
+            }
+        )
+        part_path = f"{self.cache_path}/part-{time.time_ns()}-{os.getpid()}.parquet"
+        pq.write_table(table, part_path + ".tmp")
+        os.replace(part_path + ".tmp", part_path)
+        self.buffer = []
+
+
+def generate_with_cache(generate_fn, model, batch, tokenizer, config, cache):
+    """
+    只对缓存中没有的样本调用 generate_fn（generate_sentences 或 predict_labels），并将结果写入缓存
+    """
+    keys = cache.get_example_keys(batch)
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    if missing:
+        missing_batch = {k: [v[i] for i in missing] for k, v in batch.items()}
+        generated = generate_fn(model, missing_batch, tokenizer, config=config)
+        for i, g in zip(missing, generated):
+            cache.add(keys[i], g)
+    return [cache.get(key) for key in keys]
+
+
+def stream_generate(model, test_data, raw_data, tokenizer, config, generation_cache,
+                    output_path=None, chunk_callback=None):
+    """
+    按 test_generation_chunk_size 分片生成测试输出，每个分片生成结束后立即：
+    1. 按下标与原始数据的列合并（不经过 pandas）
+    2. 写入 output_path 下的 parquet 分片
+    3. 交给 chunk_callback（例如在后续分片生成的同时计算评价指标）
+    :param raw_data: 与 test_data 逐行对应的原始测试集
+    :return: 所有分片拼接成的 Dataset
+    """
+    generate_fn = predict_labels if config.data_mode == "classification" else generate_sentences
+    chunk_size = config.get("test_generation_chunk_size") or len(test_data)
+    if output_path:
+        os.makedirs(output_path, exist_ok=True)
+        # 清理上一次运行留下的分片，断点续跑依赖的是 GenerationCache 而不是这些分片
+        for part in glob.glob(f"{output_path}/part-*.parquet"):
+            os.remove(part)
+    chunks = []
+    for chunk_id, start in enumerate(tqdm(range(0, len(test_data), chunk_size), desc="正在生成")):
+        end = min(start + chunk_size, len(test_data))
+        columns = test_data[start:end]
+        generated = []
+        for batch_start in range(0, end - start, config.test_batch_size):
+            batch = {k: v[batch_start: batch_start + config.test_batch_size] for k, v in columns.items()}
+            generated += generate_with_cache(generate_fn, model, batch, tokenizer, config, generation_cache)
+        generation_cache.flush()
+
+        for column, values in raw_data[start:end].items():
+            columns.setdefault(column, values)
+        if config.data_mode == "classification":
+            columns["generated"] = generated
+        else:
+            columns["generated_seqs"] = [g["seqs"] for g in generated]
+            columns["generated_seqs_with_special_tokens"] = [g["seqs_with_special_tokens"] for g in generated]
+        chunk = Dataset.from_dict(columns)
+        if output_path:
+            chunk.to_parquet(f"{output_path}/part-{chunk_id:05d}.parquet")
+        if chunk_callback is not None:
+            chunk_callback(chunk)
+        chunks.append(chunk)
+    return concatenate_datasets(chunks)
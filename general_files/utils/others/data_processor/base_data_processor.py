@@ -1,10 +1,24 @@
+import os
 from datasets import Dataset
+from datasets.fingerprint import Hasher
 import general_files.utils.common_util as utils
-from general_files.utils.data_util import print_dataset_overview
+from general_files.utils.data_util import print_dataset_overview, pack_sequences, get_dataset_cache_hash
 
 log = utils.get_logger(__name__)
 
 
+class TokenizeFunction:
+    """
+    可被 pickle 的编码函数，替代闭包了整个 processor 的 lambda，便于 datasets 计算指纹与多进程编码
+    """
+    def __init__(self, processor, stage):
+        self.processor = processor
+        self.stage = stage
+
+    def __call__(self, batch):
+        return self.processor.tokenize_data(batch, stage=self.stage)
+
+
 class BaseProcessor:
     def __init__(self, config, tokenizer=None, only_test=False):
         self.config = config
@@ -24,42 +38,14 @@ class BaseProcessor:
         """
         if self.only_test:
             self.config.dataset_part = ['test']
-        train_data_tokenized = valid_data_tokenized = test_data_tokenized = None
-        if 'train' in self.config.dataset_part:
-            train_rows = self.read_data(stage='train')
-            train_dataset = Dataset.from_dict(train_rows)
-            log.info("Tokenize Train Dataset...")
-            train_data_tokenized = train_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='train'),
-                batched=True,
-                desc='Tokenize Train Dataset'
-            )
-            if '__index_level_0__' in train_data_tokenized.column_names:
-                train_data_tokenized = train_data_tokenized.remove_columns('__index_level_0__')
-
-        if 'valid' in self.config.dataset_part:
-            valid_rows = self.read_data(stage='valid')
-            valid_dataset = Dataset.from_dict(valid_rows)
-            log.info("Tokenize Valid Dataset...")
-            valid_data_tokenized = valid_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='valid'),
-                batched=True,
-                desc='Tokenize Valid Dataset'
-            )
-            if '__index_level_0__' in valid_data_tokenized.column_names:
-                valid_data_tokenized = valid_data_tokenized.remove_columns('__index_level_0__')
-
-        if 'test' in self.config.dataset_part:
-            test_rows = self.read_data(stage='test')
-            test_dataset = Dataset.from_dict(test_rows)
-            log.info("Tokenize Test Dataset...")
-            test_data_tokenized = test_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='test'),
-                batched=True,
-                desc='Tokenize Test Dataset'
-            )
-            if '__index_level_0__' in test_data_tokenized.column_names:
-                test_data_tokenized = test_data_tokenized.remove_columns('__index_level_0__')
+        stages = [stage for stage in ['train', 'valid', 'test'] if stage in self.config.dataset_part]
+        # 各数据集依次编码：HF fast tokenizer 的截断、padding 设置是共享状态，不能在多个线程中同时使用，
+        # 并行由 tokenize_num_proc 在 map 内部的多进程完成
+        all_rows = {stage: self.read_data(stage=stage) for stage in stages}
+        tokenized = {stage: self.tokenize_dataset(Dataset.from_dict(all_rows[stage]), stage) for stage in stages}
+        train_rows, train_data_tokenized = all_rows.get('train'), tokenized.get('train')
+        valid_data_tokenized = tokenized.get('valid')
+        test_rows, test_data_tokenized = all_rows.get('test'), tokenized.get('test')
         columns = list(train_rows.keys()) if train_data_tokenized is not None else None
         test_columns = list(test_rows.keys()) if test_data_tokenized is not None else None
         raw_data = (
@@ -83,9 +69,56 @@ class BaseProcessor:
             list(set(test_data_tokenized.column_names).intersection(set(test_columns)))) \
             if test_data_tokenized is not None else None
 
+        if self.config.get("pack_sequences") and self.config.hf_model_type == "language-modeling":
+            train_data_tokenized = self.pack_dataset(train_data_tokenized, stage='train')
+            if not self.config.eval_bad_case_analysis:
+                # 做 Bad case 分析时验证集会被用于生成，不能打包
+                valid_data_tokenized = self.pack_dataset(valid_data_tokenized, stage='valid')
+
         print_dataset_overview(train_data_tokenized, valid_data_tokenized, test_data_tokenized)
         return train_data_tokenized, valid_data_tokenized, test_data_tokenized, raw_data
 
+    def tokenize_dataset(self, dataset, stage):
+        """
+        使用可被 pickle 的 TokenizeFunction 编码数据集，设置 tokenize_num_proc 时多进程编码
+        结果缓存在 public_data_path 下，缓存文件名只由数据内容、stage 与 get_dataset_cache_hash 决定，
+        不受 task_full_name 等每次运行都不同的配置影响，相同的数据与编码方式跨运行复用
+        """
+        log.info(f"Tokenize {stage.capitalize()} Dataset...")
+        tokenize_function = TokenizeFunction(self, stage)
+        cache_file_name = None
+        if not self.config.fast_run:
+            cache_dir = f"{self.public_dataset_path}/tokenize_cache"
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_key = Hasher.hash([dataset._fingerprint, stage,
+                                     get_dataset_cache_hash(self.config, self.tokenizer, self.only_test)])
+            cache_file_name = f"{cache_dir}/{stage}_{cache_key}.arrow"
+        dataset_tokenized = dataset.map(
+            tokenize_function,
+            batched=True,
+            num_proc=self.config.get("tokenize_num_proc"),
+            cache_file_name=cache_file_name,
+            desc=f'Tokenize {stage.capitalize()} Dataset'
+        )
+        if '__index_level_0__' in dataset_tokenized.column_names:
+            dataset_tokenized = dataset_tokenized.remove_columns('__index_level_0__')
+        return dataset_tokenized
+
+    def pack_dataset(self, dataset, stage=None):
+        """
+        将多条较短的样本拼接为长度为 sent_max_length 的一行，仅保留 input_ids 与 labels 以及打包产生的特征
+        """
+        if dataset is None:
+            return None
+        packed_dataset, efficiency = pack_sequences(
+            dataset,
+            max_length=self.config.sent_max_length,
+            pad_token_id=self.tokenizer.pad_token_id,
+        )
+        log.info(f"{stage} 数据集打包完成：{len(dataset)} 条样本 --> {len(packed_dataset)} 行，"
+                 f"打包效率 {efficiency:.2%}")
+        return packed_dataset
+
     def tokenize_data(self, batch, stage=None):
         pass
 
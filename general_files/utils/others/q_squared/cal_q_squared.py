@@ -12,16 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import json
 # os.environ["CUDA_VISIBLE_DEVICES"] = '1'
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import torch
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, AutoModelForQuestionAnswering, pipeline
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, AutoModelForQuestionAnswering, \
+    AutoModelForSequenceClassification
 import spacy
 import re
 import string
-from collections import Counter
+from collections import Counter, OrderedDict
 from bert_score import score
 
 
@@ -33,8 +35,31 @@ NO_Q = -1
 ENTAILMENT_SCORE = 1
 CONTRADICTION_SCORE = 0
 NEUTRAL_SCORE = 0.5
+QG_MODEL_NAME = 'mrm8488/t5-base-finetuned-question-generation-ap'
+QA_MODEL_NAME = 'ktrapeznikov/albert-xlarge-v2-squad-v2'
+NLI_MODEL_NAME = 'boychaboy/SNLI_roberta-large'
+# (NLI 模型名, premise, hypothesis) --> NLI 标签，按加入的先后顺序淘汰
+NLI_LABEL_CACHE = OrderedDict()
+# 已读入 NLI_LABEL_CACHE 的缓存文件 --> 文件中的行数
+NLI_CACHE_LINES = dict()
 
-nlp = spacy.load("en_core_web_sm")
+# spaCy 模型在第一次使用时才加载，避免 import model_util 时的开销
+nlp = None
+
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        # 候选答案抽取需要 ner 与 parser（noun_chunks），非人称问题过滤只需要 parser，lemmatizer 均不需要
+        nlp = spacy.load("en_core_web_sm", disable=["lemmatizer"])
+    return nlp
+
+
+def pipe_docs(texts, config=None, disable=()):
+    config = config if config is not None else dict()
+    batch_size = config.get("q_squared_spacy_batch_size") or 256
+    n_process = config.get("q_squared_spacy_n_process") or 1
+    return get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process, disable=list(disable))
 
 
 def clean_text(text):
@@ -64,26 +89,30 @@ def f1_bert_score(a_gold, a_pred):
     return F1.mean().item()
 
 
-
-def get_answer(question, text, qa_model, qa_tokenizer, config):  # Code taken from https://huggingface.co/transformers/task_summary.html
-    inputs = qa_tokenizer.encode_plus(question, text, add_special_tokens=True, return_tensors="pt").to(config.default_device)
-    input_ids = inputs["input_ids"].tolist()[0]
-
-    text_tokens = qa_tokenizer.convert_ids_to_tokens(input_ids)
-    answer_start_scores, answer_end_scores = qa_model(**inputs, return_dict=False)
-
-    answer_start = torch.argmax(
-        answer_start_scores
-    )  # Get the most likely beginning of answer with the argmax of the score
-    answer_end = torch.argmax(answer_end_scores) + 1  # Get the most likely end of answer with the argmax of the score
-
-    ans = qa_tokenizer.convert_tokens_to_string(qa_tokenizer.convert_ids_to_tokens(input_ids[answer_start:answer_end]))
-    return ans
-
-
-def get_answer_candidates(text):
-    all_candidates = []
-    doc = nlp(text)
+def get_answers(questions, texts, qa_model, qa_tokenizer, config, batch_size=32):
+    """
+    批量回答问题，答案为 start/end 得分 argmax 之间的片段，padding 位置不参与 argmax
+    """
+    answers = []
+    for start_index in range(0, len(questions), batch_size):
+        inputs = qa_tokenizer(questions[start_index: start_index + batch_size],
+                              texts[start_index: start_index + batch_size],
+                              add_special_tokens=True,
+                              padding=True,
+                              truncation='only_second',
+                              return_tensors="pt").to(config.default_device)
+        with torch.no_grad():
+            answer_start_scores, answer_end_scores = qa_model(**inputs, return_dict=False)
+        pad_mask = inputs["attention_mask"] == 0
+        answer_starts = answer_start_scores.masked_fill(pad_mask, float('-inf')).argmax(dim=-1).tolist()
+        answer_ends = (answer_end_scores.masked_fill(pad_mask, float('-inf')).argmax(dim=-1) + 1).tolist()
+        for input_ids, answer_start, answer_end in zip(inputs["input_ids"].tolist(), answer_starts, answer_ends):
+            answers.append(qa_tokenizer.convert_tokens_to_string(
+                qa_tokenizer.convert_ids_to_tokens(input_ids[answer_start:answer_end])))
+    return answers
+
+
+def extract_answer_candidates(doc):
     candidates = [ent.text for ent in list(doc.ents)]
     noun_chunks = list(doc.noun_chunks)
     for chunk in noun_chunks:
@@ -98,6 +127,13 @@ def get_answer_candidates(text):
     return candidates
 
 
+def get_answer_candidates_batch(texts, config=None):
+    """
+    使用 nlp.pipe 批量抽取候选答案
+    """
+    return [extract_answer_candidates(doc) for doc in pipe_docs(texts, config)]
+
+
 # def get_answer_candidates(text):
 #     doc = nlp(text)
 #     candidates = [ent.text for ent in list(doc.ents)]
@@ -107,44 +143,35 @@ def get_answer_candidates(text):
 #     return candidates
 
 
-def get_question_greedy(answer, context, qg_model, qg_tokenizer, max_length=128):
-    input_text = ["answer: %s  context: %s </s>" % (a, c) for a, c in (answer, context)]
-    features = qg_tokenizer(input_text, return_tensors='pt')
-    output = qg_model.generate(input_ids=features['input_ids'], attention_mask=features['attention_mask'],
-                               max_length=max_length)
-
-    question = [qg_tokenizer.decode(output[0]).replace("question: ", "", 1)]
-    return question
-
-
-def get_questions_beam(answer, context, qg_model, qg_tokenizer, config, max_length=128, beam_size=5, num_return=5):
+def generate_questions(answers, contexts, gen_method, qg_model, qg_tokenizer, config, max_length=128,
+                       beam_size=5, top_k=50, top_p=0.95, num_return=5, batch_size=32):
+    """
+    批量生成问题，greedy、beam、sample 三种生成方式的参数与 q-squared 原实现一致
+    :return: [[question]]，与输入一一对应，greedy 每个输入生成一个问题，beam 与 sample 生成 num_return 个
+    """
+    if gen_method == 'greedy':
+        generate_kwargs = dict(max_length=max_length)
+        num_return = 1
+    elif gen_method == 'beam':
+        generate_kwargs = dict(max_length=max_length, num_beams=beam_size, no_repeat_ngram_size=3,
+                               num_return_sequences=num_return, early_stopping=True)
+    else:
+        generate_kwargs = dict(max_length=max_length, do_sample=True, top_k=top_k, top_p=top_p,
+                               num_return_sequences=num_return)
+    input_texts = ["answer: %s  context: %s </s>" % (answer, context) for answer, context in zip(answers, contexts)]
     all_questions = []
-    input_text = "answer: %s  context: %s </s>" % (answer, context)
-    features = qg_tokenizer([input_text], return_tensors='pt').to(config.default_device)
-
-    beam_outputs = qg_model.generate(input_ids=features['input_ids'], attention_mask=features['attention_mask'],
-                                     max_length=max_length, num_beams=beam_size, no_repeat_ngram_size=3,
-                                     num_return_sequences=num_return, early_stopping=True)
-
-    for beam_output in beam_outputs:
-        all_questions.append(qg_tokenizer.decode(beam_output, skip_special_tokens=True).replace("question: ", "", 1))
+    for start_index in range(0, len(input_texts), batch_size):
+        features = qg_tokenizer(input_texts[start_index: start_index + batch_size],
+                                padding=True, return_tensors='pt').to(config.default_device)
+        with torch.no_grad():
+            outputs = qg_model.generate(input_ids=features['input_ids'], attention_mask=features['attention_mask'],
+                                        **generate_kwargs)
+        questions = [qg_tokenizer.decode(output, skip_special_tokens=True).replace("question: ", "", 1)
+                     for output in outputs]
+        all_questions.extend(questions[i: i + num_return] for i in range(0, len(questions), num_return))
     return all_questions
 
 
-def get_questions_sample(answer, context, qg_model, qg_tokenizer, max_length=128, top_k=50, top_p=0.95, num_return=5):
-    all_questions = []
-    input_text = "answer: %s  context: %s </s>" % (answer, context)
-    features = qg_tokenizer([input_text], return_tensors='pt')
-
-    sampled_outputs = qg_model.generate(input_ids=features['input_ids'], attention_mask=features['attention_mask'],
-                                        max_length=max_length, do_sample=True, top_k=top_k, top_p=top_p,
-                                        num_return_sequences=num_return)
-
-    for sampled in sampled_outputs:
-        all_questions.append(qg_tokenizer.decode(sampled, skip_special_tokens=True).replace("question: ", "", 1))
-
-    return all_questions
-
 def filter_questions(exp_ans, pred_ans):
     if pred_ans == NO_ANS:
         return 'NO MATCH'
@@ -153,8 +180,7 @@ def filter_questions(exp_ans, pred_ans):
     return 'VALID'
 
 
-def non_personal(question):
-    question_tok = nlp(question)
+def is_non_personal_doc(question_tok):
     for tok in question_tok:
         if tok.dep_ == 'nsubj':
             if tok.text.lower() == 'i' or tok.text.lower() == 'you':
@@ -165,152 +191,241 @@ def non_personal(question):
     return True
 
 
-def single_question_score(question, cand, response, knowledge, qa_model, qa_tokenizer, config):
-    pred_ans = get_answer(question, response, qa_model, qa_tokenizer, config)
-
-    if filter_questions(cand, pred_ans) == 'VALID':
-        knowledge_ans = get_answer(question, knowledge, qa_model, qa_tokenizer, config)
+def non_personal_batch(questions, config=None):
+    """
+    使用 nlp.pipe 批量判断问题是否为非人称问题，只需要依存句法，跳过 ner
+    """
+    return [is_non_personal_doc(doc) for doc in pipe_docs(questions, config, disable=["ner"])]
+
+
+def get_chunk_scores(responses, knowledges, gen_method, single, remove_personal,
+                     qg_model, qg_tokenizer, qa_model, qa_tokenizer, config):
+    """
+    批量计算一组回复的问题与得分，结果与逐条回复、逐个问题计算一致：
+    先为所有 (候选答案, 回复) 生成问题，再批量在回复上回答全部问题，按原顺序挑出有效问题（single 时每个候选只取第一个），
+    最后批量在知识上回答有效问题
+    :return: [(avg_f1, valid_questions, valid_cands, knowledge_answers, scores)]，与 responses 一一对应
+    """
+    batch_size = config.get("q_squared_batch_size") or 32
+    pairs = [(idx, cand) for idx, candidates in enumerate(get_answer_candidates_batch(responses, config))
+             for cand in candidates]
+    questions_per_pair = generate_questions([cand for _, cand in pairs], [responses[idx] for idx, _ in pairs],
+                                            gen_method, qg_model, qg_tokenizer, config, batch_size=batch_size)
+    if remove_personal:
+        flags = iter(non_personal_batch([question for questions in questions_per_pair for question in questions], config))
+        questions_per_pair = [[question for question in questions if next(flags)]
+                              for questions in questions_per_pair]
+
+    ###############################################
+    # 在回复上回答全部问题，筛选有效问题
+    ###############################################
+    flat_questions = [(pair_idx, question) for pair_idx, questions in enumerate(questions_per_pair)
+                      for question in questions]
+    pred_answers = get_answers([question for _, question in flat_questions],
+                               [responses[pairs[pair_idx][0]] for pair_idx, _ in flat_questions],
+                               qa_model, qa_tokenizer, config, batch_size=batch_size)
+    valid_questions = []
+    found_pairs = set()
+    for (pair_idx, question), pred_ans in zip(flat_questions, pred_answers):
+        if single and pair_idx in found_pairs:
+            continue
+        if filter_questions(pairs[pair_idx][1], pred_ans) == 'VALID':
+            valid_questions.append((pair_idx, question))
+            found_pairs.add(pair_idx)
+
+    ###############################################
+    # 在知识上回答有效问题并打分
+    ###############################################
+    knowledge_answers = get_answers([question for _, question in valid_questions],
+                                    [knowledges[pairs[pair_idx][0]] for pair_idx, _ in valid_questions],
+                                    qa_model, qa_tokenizer, config, batch_size=batch_size)
+    results = [(INVALID_QUESTION, [], [], [], []) for _ in responses]
+    for (pair_idx, question), knowledge_ans in zip(valid_questions, knowledge_answers):
+        idx, cand = pairs[pair_idx]
         if knowledge_ans != NO_ANS:
-            return f1_score(cand, knowledge_ans), knowledge_ans
+            question_score = f1_score(cand, knowledge_ans)
         else:
-            return 0, NO_ANS
-    else:
-        return INVALID_QUESTION, INVALID_QUESTION
+            question_score, knowledge_ans = 0, NO_ANS
+        _, res_questions, res_cands, res_answers, res_scores = results[idx]
+        res_questions.append(question)
+        res_cands.append(cand)
+        res_answers.append(knowledge_ans)
+        res_scores.append(question_score)
+        results[idx] = (sum(res_scores) / len(res_scores), res_questions, res_cands, res_answers, res_scores)
+    return results
 
 
 def get_response_score(response, knowledge, gen_method, single, remove_personal, qg_model, qg_tokenizer, qa_model, qa_tokenizer, config):
-    f1 = 0
-    num_questions = 0
-
-    valid_questions = []
-    valid_cands = []
-    knowledge_answers = []
-    scores = []
-
-    candidates = get_answer_candidates(response)
-    for cand in candidates:
-        if gen_method == 'greedy':
-            questions = [get_question_greedy(cand, response)]
-        elif gen_method == 'beam':
-            questions = get_questions_beam(cand, response, qg_model, qg_tokenizer, config)
-        else:
-            questions = get_questions_sample(cand, response)
-
-        for question in questions:
-            if not remove_personal or non_personal(question):
-                question_score, knowledge_ans = single_question_score(question, cand, response, knowledge, qa_model, qa_tokenizer, config)
-                if question_score != INVALID_QUESTION:
-                    num_questions += 1
-                    f1 += question_score
-
-                    valid_questions.append(question)
-                    valid_cands.append(cand)
-                    knowledge_answers.append(knowledge_ans)
-                    scores.append(question_score)
-
-                    if single:
-                        break
-    if num_questions:
-        avg_f1 = f1 / num_questions
-    else:
-        avg_f1 = INVALID_QUESTION
-    return avg_f1, valid_questions, valid_cands, knowledge_answers, scores
-
-
-def response_questions_stats(response, knowledge, gen_method, single, remove_personal):
-    num_questions = 0
-    num_no_ans = 0
-
-    candidates = get_answer_candidates(response)
-    for cand in candidates:
-        if gen_method == 'greedy':
-            questions = [get_question_greedy(cand, response)]
-        elif gen_method == 'beam':
-            questions = get_questions_beam(cand, response)
-        else:
-            questions = get_questions_sample(cand, response)
-
-        for question in questions:
-            if not remove_personal or non_personal(question):
-                pred_ans = get_answer(question, response)
-
-                if filter_questions(cand, pred_ans) == 'VALID':
-                    num_questions += 1
-                    knowledge_ans = get_answer(question, knowledge)
-                    if knowledge_ans == NO_ANS:
-                        num_no_ans += 1
-                    if single:
-                        break
-    return num_questions, num_no_ans
-
-
-def get_stats(in_path, gen_method, single, remove_personal):
-    num_questions = 0
-    num_no_ans = 0
-    df = pd.read_csv(in_path)
-    for _, row in df.iterrows():
-        q, no_ans = response_questions_stats(row['response'], row['knowledge'], gen_method, single, remove_personal)
-        num_questions += q
-        num_no_ans += no_ans
-
-
-def get_e2e_nli_score(response, knowledge, predictor):
-    res = predictor([(knowledge, response)], ['contradiction', 'entailment', 'neutral'])
+    """
+    单条回复的问题与得分，供 pipeline/prep_sys_experiment.py 使用
+    :return: avg_f1, valid_questions, valid_cands, knowledge_answers, scores
+    """
+    return get_chunk_scores([response], [knowledge], gen_method, single, remove_personal,
+                            qg_model, qg_tokenizer, qa_model, qa_tokenizer, config)[0]
+
+
+def load_pretrained(model_class, model_name, device="cpu", cache_dir=None):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, cache_dir=cache_dir)
+    model = model_class.from_pretrained(model_name, cache_dir=cache_dir).to(device).eval()
+    return model, tokenizer
+
+
+def load_qg_model(device="cpu", cache_dir=None):
+    return load_pretrained(AutoModelForSeq2SeqLM, QG_MODEL_NAME, device, cache_dir)
+
+
+def load_qa_model(device="cpu", cache_dir=None):
+    return load_pretrained(AutoModelForQuestionAnswering, QA_MODEL_NAME, device, cache_dir)
+
+
+def load_nli_model(device="cpu", cache_dir=None):
+    nli_model, nli_tokenizer = load_pretrained(AutoModelForSequenceClassification, NLI_MODEL_NAME, device, cache_dir)
+    check_nli_labels(nli_model)
+    return nli_model, nli_tokenizer
+
+
+def get_nli_cache_path(config, model_name):
+    if not config.get("cache_dir"):
+        return None
+    return os.path.join(config.cache_dir, f"q_squared_nli_cache_{model_name.replace('/', '--')}.jsonl")
+
+
+def load_nli_cache(cache_path, model_name):
+    """
+    依次读入轮换出的旧文件与当前文件，每个缓存文件在进程中只读一次
+    """
+    if cache_path is None or cache_path in NLI_CACHE_LINES:
+        return
+    NLI_CACHE_LINES[cache_path] = 0
+    for path, is_current in [(cache_path + ".old", False), (cache_path, True)]:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                premise, hypothesis, label = json.loads(line)
+                NLI_LABEL_CACHE[(model_name, premise, hypothesis)] = label
+                if is_current:
+                    NLI_CACHE_LINES[cache_path] += 1
+
+
+def save_nli_cache(cache_path, model_name, pairs, max_size):
+    """
+    追加写入缓存文件，超过 max_size 行后将其轮换为 .old（覆盖上一次轮换的文件），磁盘上最多保留 2 * max_size 行
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    if NLI_CACHE_LINES[cache_path] >= max_size:
+        os.replace(cache_path, cache_path + ".old")
+        NLI_CACHE_LINES[cache_path] = 0
+    with open(cache_path, "a") as f:
+        for premise, hypothesis in pairs:
+            f.write(json.dumps([premise, hypothesis, NLI_LABEL_CACHE[(model_name, premise, hypothesis)]]) + "\n")
+    NLI_CACHE_LINES[cache_path] += len(pairs)
+
+
+def get_nli_labels(pairs, nli_model, nli_tokenizer, config, batch_size=32):
+    """
+    批量计算 (premise, hypothesis) 的 NLI 标签，结果按 NLI 模型缓存在进程内并追加写入 cache_dir 下该模型的缓存文件，
+    重复评估同一个 checkpoint 时相同的句对不会重复计算
+    """
+    model_name = nli_model.name_or_path
+    max_size = config.get("q_squared_nli_cache_size") or 1000000
+    cache_path = get_nli_cache_path(config, model_name)
+    load_nli_cache(cache_path, model_name)
+    todo_pairs = list(dict.fromkeys(pair for pair in pairs if (model_name, *pair) not in NLI_LABEL_CACHE))
+    for start_index in range(0, len(todo_pairs), batch_size):
+        batch_pairs = todo_pairs[start_index: start_index + batch_size]
+        inputs = nli_tokenizer([premise for premise, _ in batch_pairs],
+                               [hypothesis for _, hypothesis in batch_pairs],
+                               padding=True,
+                               truncation=True,
+                               return_tensors="pt").to(config.default_device)
+        with torch.no_grad():
+            label_ids = nli_model(**inputs).logits.argmax(dim=-1).tolist()
+        for pair, label_id in zip(batch_pairs, label_ids):
+            NLI_LABEL_CACHE[(model_name, *pair)] = nli_model.config.id2label[label_id].lower()
+    if cache_path is not None and todo_pairs:
+        save_nli_cache(cache_path, model_name, todo_pairs, max_size)
+    labels = [NLI_LABEL_CACHE[(model_name, *pair)] for pair in pairs]
+    # 进程内的缓存同样不超过磁盘上保留的行数
+    while len(NLI_LABEL_CACHE) > 2 * max_size:
+        NLI_LABEL_CACHE.popitem(last=False)
+    return labels
+
+
+def check_nli_labels(nli_model):
+    """
+    get_nli_labels 按 id2label 中的名称将预测结果映射为分数，模型的标签必须包含 entailment 与 contradiction，
+    否则（如 LABEL_0 这类默认标签）所有句对都会被当作 neutral
+    """
+    labels = {label.lower() for label in nli_model.config.id2label.values()}
+    missing = sorted({'entailment', 'contradiction'} - labels)
+    if missing:
+        raise ValueError(f"NLI 模型 {nli_model.name_or_path} 的标签 {nli_model.config.id2label} 中缺少 {missing}")
+
+
+def get_e2e_nli_pair(response, knowledge):
+    return knowledge, response
+
+
+def get_nli_pair(question, cand, evidence_ans):
+    premise = question + ' ' + evidence_ans + '.'
+    hypothesis = question + ' ' + cand + '.'
+    return premise, hypothesis
 
-    nli_label = res[0]['labels'][res[0]['scores'].index(max(res[0]['scores']))]
 
+def nli_label_to_score(nli_label, default_score=NEUTRAL_SCORE):
     if nli_label == 'entailment':  # If entails, the score is 1
         return ENTAILMENT_SCORE
     elif nli_label == 'contradiction':  # If contradicts, the score is 0
         return CONTRADICTION_SCORE
-    else:
-        return NEUTRAL_SCORE
-
-
-def get_nli_label(question, cand, evidence_ans, predictor):
-    premise = question + ' ' + evidence_ans + '.'
-    hypothesis = question + ' ' + cand + '.'
+    return default_score
 
-    res = predictor([(premise, hypothesis)], ['contradiction', 'entailment', 'neutral'])
 
-    return res[0]['labels'][res[0]['scores'].index(max(res[0]['scores']))]
-
-
-def scores_with_nli(score, knowledge_ans, question, cand, response, knowledge, predictor):
-    nli_scores = []
-    f1_scores = []
+def scores_with_nli(score, knowledge_ans, question, cand, response, knowledge, nli_model, nli_tokenizer, config):
+    """
+    先收集所有需要 NLI 的句对，批量计算后再回填分数
+    """
+    nli_pairs = []
+    # 每一行：(f1_score, 需要 NLI 的句对下标, 是否为无问题时的端到端 NLI)
+    rows = []
 
     for i, row in enumerate(response):
         f1_score = score[i]
 
         evidence_answer = str(knowledge_ans[i])
 
-        nli_score = f1_score
-
         # Use NLI to determine answer similarity.
         # This is only applicable for responses that had at least one valid question generated
 
         if 0 <= f1_score < 1 and NO_ANS not in evidence_answer and evidence_answer != '' and evidence_answer != 'nan':
-            f1_scores.append(f1_score)
             # If the score is 1, there is a full overlap between the
             # candidate and the predicted answer, so the score is 1
             # If there is no answer - can't run NLI, keep the original score (0)
-
-            nli_label = get_nli_label(str(question[i]), str(cand[i]), evidence_answer, predictor)
-
-            if nli_label == 'entailment':  # If entails, the score is 1
-                nli_score = ENTAILMENT_SCORE
-            elif nli_label == 'contradiction':  # If contradicts, the score is 0
-                nli_score = CONTRADICTION_SCORE
+            nli_pairs.append(get_nli_pair(str(question[i]), str(cand[i]), evidence_answer))
+            rows.append((f1_score, len(nli_pairs) - 1, False))
 
         # Add fallback NLI to responses that are not covered by Q2 (no questions generated)
         elif f1_score == NO_Q:
-            nli_fallback = get_e2e_nli_score(str(response[i]), str(knowledge[i]).lower(), predictor)
-            nli_score = nli_fallback
-            f1_scores.append(nli_fallback)
+            nli_pairs.append(get_e2e_nli_pair(str(response[i]), str(knowledge[i]).lower()))
+            rows.append((f1_score, len(nli_pairs) - 1, True))
         else:
-            f1_scores.append(f1_score)
+            rows.append((f1_score, None, False))
+
+    nli_labels = get_nli_labels(nli_pairs, nli_model, nli_tokenizer, config,
+                                batch_size=config.get("q_squared_batch_size") or 32)
 
+    nli_scores = []
+    f1_scores = []
+    for f1_score, pair_index, is_fallback in rows:
+        if pair_index is None:
+            nli_score = f1_score
+            f1_scores.append(f1_score)
+        elif is_fallback:
+            nli_score = nli_label_to_score(nli_labels[pair_index])
+            f1_scores.append(nli_score)
+        else:
+            nli_score = nli_label_to_score(nli_labels[pair_index], default_score=f1_score)
+            f1_scores.append(f1_score)
         nli_scores.append(nli_score)
 
     return nli_scores, f1_scores
@@ -365,15 +480,11 @@ def aggregate_per_response(q2_no_nli, q2_score, id):
     return np.mean(mean_nli_scores), np.mean(mean_f1_scores)
 
 
-def add_baseline_e2e_nli(response, knowledge):
-    e2e_nli_scores = []
-    for i, resp in enumerate(response):
-        e2e_nli_scores.append(get_e2e_nli_score(str(resp), str(knowledge[i]).lower()))
-    return e2e_nli_scores
-
-
-
-def calc_scores(response, knowledge, gen_method='beam', single=True, remove_personal=True, config=None):
+def calc_scores(response, knowledge, gen_method='beam', single=True, remove_personal=True, config=None,
+                qg=None, qa=None, nli=None):
+    """
+    :param qg, qa, nli: 已加载的 (model, tokenizer)，由 model_util 的 METRIC_REGISTRY 提供，为 None 时在这里加载
+    """
     q_scores = []
 
     all_questions = []
@@ -383,13 +494,17 @@ def calc_scores(response, knowledge, gen_method='beam', single=True, remove_pers
     all_responses = []
     all_knowledge = []
     ids = []
-    qg_tokenizer = AutoTokenizer.from_pretrained("mrm8488/t5-base-finetuned-question-generation-ap", cache_dir=config.cache_dir)
-    qg_model = AutoModelForSeq2SeqLM.from_pretrained("mrm8488/t5-base-finetuned-question-generation-ap", cache_dir=config.cache_dir).to(config.default_device)
-    qa_tokenizer = AutoTokenizer.from_pretrained("ktrapeznikov/albert-xlarge-v2-squad-v2", cache_dir=config.cache_dir)
-    qa_model = AutoModelForQuestionAnswering.from_pretrained("ktrapeznikov/albert-xlarge-v2-squad-v2", cache_dir=config.cache_dir).to(config.default_device)
-    for idx, resp in enumerate(tqdm(response, desc="计算Q-squared分数中")):
-        res, res_questions, res_cands, res_answers, res_scores =\
-            get_response_score(resp, knowledge[idx], gen_method, single, remove_personal, qg_model, qg_tokenizer, qa_model, qa_tokenizer, config)
+    qg_model, qg_tokenizer = qg if qg is not None else load_qg_model(config.default_device, config.cache_dir)
+    qa_model, qa_tokenizer = qa if qa is not None else load_qa_model(config.default_device, config.cache_dir)
+    chunk_size = config.get("q_squared_chunk_size") or 256
+    chunk_results = []
+    for start_index in tqdm(range(0, len(response), chunk_size), desc="计算Q-squared分数中"):
+        chunk_results.extend(get_chunk_scores(response[start_index: start_index + chunk_size],
+                                              knowledge[start_index: start_index + chunk_size],
+                                              gen_method, single, remove_personal,
+                                              qg_model, qg_tokenizer, qa_model, qa_tokenizer, config))
+    for idx, resp in enumerate(response):
+        res, res_questions, res_cands, res_answers, res_scores = chunk_results[idx]
 
         all_questions.extend(res_questions)
         all_cands.extend(res_cands)
@@ -409,16 +524,15 @@ def calc_scores(response, knowledge, gen_method='beam', single=True, remove_pers
             ids.extend([idx])
 
         q_scores.append(res)
-    qg_model = qg_model.to("cpu")
-    qa_model = qa_model.to("cpu")
-    predictor = pipeline("zero-shot-classification", model='boychaboy/SNLI_roberta-large')
+    nli_model, nli_tokenizer = nli if nli is not None else load_nli_model(config.default_device, config.cache_dir)
     # if save_steps:
     #     data = {'id': ids, 'response': all_responses, 'cand': all_cands, 'question': all_questions, 'knowledge': all_knowledge,
     #             'knowledge_ans': all_answers, 'score': all_scores}
     #     steps_df = pd.DataFrame(data=data)
     #     steps_df.to_csv(out_path + '.steps.csv')
 
-    q2_score, q2_no_nli = scores_with_nli(all_scores, all_answers, all_questions, all_cands, response, knowledge, predictor)
+    q2_score, q2_no_nli = scores_with_nli(all_scores, all_answers, all_questions, all_cands,
+                                          all_responses, all_knowledge, nli_model, nli_tokenizer, config)
     Q2_nli, Q2_f1 = aggregate_per_response(q2_no_nli, q2_score, ids)
 
     valid_scores = [s for s in q_scores if s != -1]
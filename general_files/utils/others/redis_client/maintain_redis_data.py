@@ -1,5 +1,4 @@
 from general_files.utils.common_util import RedisClient
-import psutil
 import json
 import time
 from nvitop import Device, GpuProcess, NA
@@ -8,49 +7,40 @@ import setproctitle
 setproctitle.setproctitle("Redis Watcher!!!")
 
 
+# 占用和排队信息由各训练任务的租约维护，过期后自动失效，这里只负责同步GPU状态并在GPU被释放时唤醒排队任务
 redis_client = RedisClient()
-while True:
-    self_occupied_gpus = redis_client.get_self_occupied_gpus(only_gpus=False)
-    queue = redis_client.client.lrange('wait_queue', 0, -1)
-    for task in self_occupied_gpus:
-        pid = int(task['system_pid'])
-        if not psutil.pid_exists(pid):
-            redis_client.client.hdel("self_occupied_gpus", task['task_id'])
-            print(f"发现 GPU占用信息 中存在残余数据，已清除，进程为{pid}")
-    for task_json in queue:
-        task = json.loads(task_json)
-        pid = int(task['system_pid'])
-        if not psutil.pid_exists(pid):
-            redis_client.client.lrem("wait_queue", 1, task_json)
-            print(f"发现 GPU排队队列 中存在残余数据，已清除，进程为{pid}")
+# 上一次检查时各GPU上的进程数，进程数减少说明有GPU被释放
+last_process_nums = {}
+# GPU序号 --> 上一次写入 Redis 的各字段，只写入发生变化的字段
+last_gpu_infos = {}
+# 每隔 FULL_SYNC_TICKS 次检查完整重写一次所有字段，修正被手动修改、删除或 Redis 重启后丢失的数据
+FULL_SYNC_TICKS = 20
+tick = 0
+
+# 清除旧版本以 'GPU info --> N ...' 和 'GPU N processes' 为 key 的数据，只在启动时执行一次
+for key in redis_client.client.scan_iter(match="GPU *"):
+    redis_client.client.delete(key)
 
-    gpu_infos = []
-    gpu = {}
+while True:
+    gpu_free = False
+    # 监控进程的存活标记不存在说明之前的数据可能已过期或丢失，同样完整重写
+    if tick % FULL_SYNC_TICKS == 0 or not redis_client.client.exists(redis_client.get_gpu_watcher_key()):
+        last_gpu_infos.clear()
+    tick += 1
+    # 每次检查的所有写入在一次往返中完成
+    pipe = redis_client.client.pipeline(transaction=False)
 
     devices = Device.all()  # or `Device.all()` to use NVML ordinal instead
-    separator = False
     for device in devices:
         processes = device.processes()  # type: Dict[int, GpuProcess]
-
-        gpu['index'] = device.physical_index
-        gpu['GPU utilization'] = f'{device.gpu_utilization()}%'
-        gpu['Total memory'] = f'{device.memory_total_human()}'
-        gpu['Used memory'] = f'{device.memory_used_human()}'
-        gpu['Free memory'] = f'{device.memory_free_human()}'
-
-        keys = redis_client.client.keys()
-        for key in keys:
-            if 'GPU info --> ' + str(device.physical_index) in key:
-                redis_client.client.delete(key)
-
-        gpu_name = 'GPU info --> ' + str(device.physical_index) + f' utilization {device.gpu_utilization()}%  Free memory {device.memory_free_human()}'
-        redis_client.client.set(gpu_name, json.dumps(gpu))
+        if len(processes) < last_process_nums.get(device.physical_index, 0):
+            gpu_free = True
+        last_process_nums[device.physical_index] = len(processes)
 
         new_processes = []
         if len(processes) > 0:
             processes = GpuProcess.take_snapshots(processes.values(), failsafe=True)
             processes.sort(key=lambda process: (process.username, process.pid))
-            new_processes = []
             for snapshot in processes:
                 process = {}
                 process['pid'] = snapshot.pid
@@ -60,12 +50,28 @@ while True:
                 process['gpu_memory_percent'] = f'{snapshot.gpu_memory_percent}%'
                 process['command'] = snapshot.command
                 new_processes.append(process)
-        if len(new_processes) > 0:
-            redis_client.client.set('GPU ' + str(device.physical_index) + ' processes', json.dumps(new_processes))
-        else:
-            redis_client.client.delete('GPU ' + str(device.physical_index) + ' processes')
 
+        # 每块GPU一个 hash，字段名固定，实时数据只放在字段值中
+        gpu = {
+            'index': device.physical_index,
+            'GPU utilization': f'{device.gpu_utilization()}%',
+            'Total memory': f'{device.memory_total_human()}',
+            'Used memory': f'{device.memory_used_human()}',
+            'Free memory': f'{device.memory_free_human()}',
+            'processes': json.dumps(new_processes),
+        }
+        last_gpu = last_gpu_infos.get(device.physical_index, {})
+        changed = {field: value for field, value in gpu.items() if last_gpu.get(field) != value}
+        if changed:
+            pipe.hset(redis_client.get_gpu_info_key(device.physical_index), mapping=changed)
+            last_gpu_infos[device.physical_index] = gpu
 
-    time.sleep(3)
+    # 监控进程的存活标记，超时未更新说明GPU信息已不再可信
+    pipe.set(redis_client.get_gpu_watcher_key(), int(time.time()), ex=30)
+    pipe.execute()
 
+    if gpu_free:
+        # 有GPU被释放，唤醒排队中的训练任务重新计算调度结果
+        redis_client.notify_wait_queue("gpu_free")
 
+    time.sleep(3)
@@ -50,16 +50,16 @@ from general_files.utils.common_util import (
     init_comet_experiment,
     seed_everything,
     RedisClient,
+    get_ckpt_file,
 )
 from general_files.utils.model_util import (
     get_eval_metrics,
-    generate_sentences,
-    predict_labels,
+    warm_up_metrics,
+    GenerationCache,
+    ChunkedEvaluator,
+    stream_generate,
 )
 from general_files.utils.data_util import (
-    concatenate_multi_datasets,
-    save_as,
-    read_by,
     print_sample_data,
 )
 
@@ -118,45 +118,26 @@ def train_or_test_with_DingTalk(config):
 
 def train_or_test(config):
 
-    test_output = None
     test_results = Result()
 
+    log.info("初始化训练、测试等所需环境")
+
     ###############################################
-    # 加载测试输出结果缓存
+    # 加载数据集、模型、分词器
     ###############################################
-    log.info("初始化训练、测试等所需环境")
-    if config.stage == "test":
-        # 在测试阶段，如果有之前的生成缓存，则直接读取
-        test_output_path = config.ckpt_path
-        if ".ckpt" in test_output_path:
-            test_output_path = "/".join(test_output_path.split("/")[:-1])
-        if os.path.exists(test_output_path + "/test_output.pt"):
-            log.info(f"发现测试输出结果缓存，准备加载...: {test_output_path}")
-            test_output = read_by(
-                test_output_path + "/test_output.pt", data_name="测试输出")
-        if config.ckpt_path and os.path.exists(config.ckpt_path + "/tokenizer.pt"):
-            # 微调、测试的分词器加载
-            tokenizer = read_by(config.ckpt_path +
-                                "/tokenizer.pt", data_name="tokenizer")
-
-    if test_output is None:
-        
-        ###############################################
-        # 加载数据集、模型、分词器
-        ###############################################
-        # 训练或微调，或者测试时没有缓存，需要重新加载数据
-        (model,
-         tokenizer,
-         train_data_tokenized,
-         valid_data_tokenized,
-         test_data_tokenized,
-         raw_data,
-         ) = init_context(config)
+    # 生成结果按 checkpoint 与解码配置逐条缓存（见 GenerationCache），测试时同样需要加载数据
+    (model,
+     tokenizer,
+     train_data_tokenized,
+     valid_data_tokenized,
+     test_data_tokenized,
+     raw_data,
+     ) = init_context(config)
 
-        ###############################################
-        # 自动选择 GPU
-        ###############################################
-        config = set_config_gpus(config)
+    ###############################################
+    # 自动选择 GPU
+    ###############################################
+    config = set_config_gpus(config)
         
     ###############################################
     # 初始化 Comet
@@ -164,14 +145,13 @@ def train_or_test(config):
     experiment = init_comet_experiment(config)
     
     try:
-        if test_output is None:
-            print_sample_data(
-                tokenizer,
-                [train_data_tokenized, valid_data_tokenized, test_data_tokenized],
-                ["Train data", "Valid data", "Test data"],
-                config=config,
-                experiment=experiment,
-            )
+        print_sample_data(
+            tokenizer,
+            [train_data_tokenized, valid_data_tokenized, test_data_tokenized],
+            ["Train data", "Valid data", "Test data"],
+            config=config,
+            experiment=experiment,
+        )
             
         ###############################################
         # 模型训练
@@ -195,68 +175,50 @@ def train_or_test(config):
             log.info(f"使用最优模型进行预测/生成！")
             model = trainer.model
 
+        ###############################################
+        # 在后台预加载评价模型，与生成同时进行
+        ###############################################
+        if config.eval_metrics is not None:
+            warm_up_metrics(config)
+
         ###############################################
         # 生成测试输出结果缓存
         ###############################################
-        if test_output is None:
-
-            ###############################################
-            # 模型测试
-            ###############################################
-            model.eval()
-            model = model.to(config.default_device)
-
-            if config.data_mode == "classification":
-                test_output = test_data_tokenized.map(
-                    lambda batch: {
-                        "generated": predict_labels(model, batch, tokenizer, config=config)
-                    },
-                    batched=True,
-                    batch_size=config.test_batch_size,
-                    desc="正在预测分类标签",
-                )
-            else:
-                test_output = test_data_tokenized.map(
-                    lambda batch: {
-                        "generated": generate_sentences(
-                            model, batch, tokenizer, config=config
-                        )
-                    },
-                    batched=True,
-                    batch_size=config.test_batch_size,
-                    desc="正在生成",
-                )
+        data_processor = get_data_processor(config, tokenizer)
+        chunked_evaluator = ChunkedEvaluator(config)
 
-            if config.eval_bad_case_analysis:
-                test_output = concatenate_multi_datasets(test_output, raw_data[-2])
-            else:
-                test_output = concatenate_multi_datasets(test_output, raw_data[-1])
-
-            if config.data_mode != "classification":
-                test_output = test_output.map(
-                    lambda batch: {
-                        "generated_seqs": batch["generated"]["seqs"],
-                        "generated_seqs_with_special_tokens": batch["generated"][
-                            "seqs_with_special_tokens"
-                        ],
-                    },
-                    desc="生成语句字典展开映射",
-                )
-                test_output = test_output.remove_columns(["generated"])
-
-            if not config.fast_run:
-                if config.ckpt_path:
-                    test_output_path = config.ckpt_path
-                else:
-                    test_output_path = config.result_path
-                log.info(f"保存测试输出结果...: {test_output_path}")
-                save_as(test_output, test_output_path +
-                        "/test_output", data_name="测试输出")
+        ###############################################
+        # 模型测试
+        # 分片生成，每个分片完成后立即保存，并在后续分片生成的同时计算可分片的评价指标
+        ###############################################
+        model.eval()
+        model = model.to(config.default_device)
+        # 只有直接从 checkpoint 文件加载、之后没有再训练的权重才能按文件标识复用生成缓存
+        generation_cache = GenerationCache(
+            get_ckpt_file(config.ckpt_path) if config.stage == "test" and config.ckpt_path else None, config
+        )
+        test_output_path = None
+        if not config.fast_run:
+            test_output_path = config.ckpt_path if config.ckpt_path else config.result_path
+            if ".ckpt" in test_output_path:
+                test_output_path = "/".join(test_output_path.split("/")[:-1])
+            test_output_path += "/test_output"
+            log.info(f"测试输出结果将逐分片保存至: {test_output_path}")
+
+        test_output = stream_generate(
+            model,
+            test_data_tokenized,
+            raw_data[-2] if config.eval_bad_case_analysis else raw_data[-1],
+            tokenizer,
+            config,
+            generation_cache,
+            output_path=test_output_path,
+            chunk_callback=lambda chunk: chunked_evaluator.submit(data_processor.map_column(chunk)),
+        )
 
         ###############################################
         # 将所有输出列名标准化以使用统一的评价指标函数
         ###############################################
-        data_processor = get_data_processor(config, tokenizer)
         test_output = data_processor.map_column(test_output)
         if config.data_mode != "classification":
             # 保存测试生成语句方便以后测试
@@ -268,7 +230,8 @@ def train_or_test(config):
         ###############################################
         log.info("评估模型！")
         if config.eval_metrics is not None:
-            test_results = get_eval_metrics(test_output, config, tokenizer)
+            test_results = get_eval_metrics(test_output, config, tokenizer,
+                                            chunk_results=chunked_evaluator.results())
 
         ###############################################
         # 打印 ckpt 存储信息
@@ -279,13 +242,6 @@ def train_or_test(config):
             log.info(f"运行结果保存在：")
             log.info(f"{config.result_path}")
 
-        ###############################################
-        # 删除Redis的Gpu占用记录
-        ###############################################
-        if config.task_id:
-            redis_client = RedisClient()
-            redis_client.deregister_gpus(config)
-
         test_results.add(
             run_name=config.comet_name,
             run_notes=config.run_notes,
@@ -317,7 +273,13 @@ def train_or_test(config):
             experiment.set_name(config.comet_name + "  Error!")
             experiment.end()
             raise e
-        
+    finally:
+        ###############################################
+        # 删除Redis的Gpu占用记录，异常退出时同样释放
+        ###############################################
+        if config.task_id:
+            redis_client = RedisClient()
+            redis_client.deregister_gpus(config)
 
     return test_results
 
@@ -0,0 +1,61 @@
+"""
+向量化的 sentence / corpus BLEU 与 nltk 逐句计算的结果一致
+"""
+import pytest
+
+nltk = pytest.importorskip("nltk")
+model_util = pytest.importorskip("general_files.utils.model_util")
+from nltk.translate.bleu_score import sentence_bleu, corpus_bleu, SmoothingFunction
+
+SENT_WEIGHTS = [[1, 0, 0, 0], [0.5, 0.5, 0, 0], [1 / 3, 1 / 3, 1 / 3, 0], [0.25, 0.25, 0.25, 0.25]]
+CORPUS_WEIGHTS = [(1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)]
+
+CASES = {
+    # 候选为空
+    "empty_hypothesis": (["the cat sat on the mat", "a dog runs"], ["", "a dog runs fast"]),
+    # 只有低阶 n-gram 命中，高阶计数为 0，需要平滑
+    "zero_count_ngrams": (["the cat sat on the mat", "i like green tea very much"],
+                          ["cat the mat on sat", "i like tea"]),
+    # 多参考，候选长度介于各参考之间
+    "multiple_references": ([["the cat is on the mat", "there is a cat on the mat"],
+                             ["he reads a book", "he is reading a long book today"]],
+                            ["the cat is on the mat today", "he is reading a book"]),
+    # unigram 完全不命中
+    "no_unigram_match": (["the cat sat", "a dog runs"], ["blue sky", "a dog runs"]),
+}
+
+
+def nltk_inputs(references, candidates):
+    refs = [[nltk.word_tokenize(r) for r in (ref if type(ref) is list else [ref])] for ref in references]
+    hyps = [nltk.word_tokenize(candidate) for candidate in candidates]
+    return refs, hyps
+
+
+@pytest.mark.parametrize("case", list(CASES))
+def test_sent_bleu_matches_nltk(case):
+    references, candidates = CASES[case]
+    refs, hyps = nltk_inputs(references, candidates)
+    smoothing_function = SmoothingFunction().method3
+    expected = [
+        round(sum(sentence_bleu(r, h, weights=w, smoothing_function=smoothing_function)
+                  for r, h in zip(refs, hyps)) / len(hyps) * 100, 4)
+        for w in SENT_WEIGHTS
+    ]
+    assert model_util.compute_sent_bleu(references, candidates) == pytest.approx(expected, abs=1e-4)
+
+
+@pytest.mark.parametrize("case", list(CASES))
+def test_corpus_bleu_matches_nltk(case):
+    references, candidates = CASES[case]
+    refs, hyps = nltk_inputs(references, candidates)
+    expected = [round(corpus_bleu(refs, hyps, weights=w) * 100, 4) for w in CORPUS_WEIGHTS]
+    assert model_util.compute_corpus_bleu(references, candidates) == pytest.approx(expected, abs=1e-4)
+
+
+def test_shared_corpus_gives_same_scores():
+    references, candidates = CASES["multiple_references"]
+    corpus = model_util.TokenizedCorpus(candidates, references)
+    assert model_util.compute_sent_bleu(references, candidates, corpus) == \
+        model_util.compute_sent_bleu(references, candidates)
+    assert model_util.compute_corpus_bleu(references, candidates, corpus) == \
+        model_util.compute_corpus_bleu(references, candidates)
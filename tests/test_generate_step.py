@@ -0,0 +1,123 @@
+"""
+增量解码（KV 缓存）与每步完整重算的结果一致性测试，使用随机初始化的小型 GPT-2 / T5，无需下载权重
+"""
+import types
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("pytorch_lightning")
+from omegaconf import OmegaConf
+from general_files.models.pl_base_model import BasePLModel
+
+PAD_TOKEN_ID = 0
+STEPS = 6
+
+
+class TinyModel(BasePLModel):
+    def __init__(self, backbone):
+        tokenizer = types.SimpleNamespace(pad_token_id=PAD_TOKEN_ID, bos_token_id=1, eos_token_id=2)
+        super().__init__(OmegaConf.create({}), tokenizer)
+        self.backbone = backbone
+        self.eval()
+
+
+def build_gpt2():
+    config = transformers.GPT2Config(vocab_size=50, n_positions=64, n_embd=32, n_layer=2, n_head=2,
+                                     pad_token_id=PAD_TOKEN_ID)
+    return TinyModel(transformers.GPT2LMHeadModel(config))
+
+
+def build_t5():
+    config = transformers.T5Config(vocab_size=50, d_model=32, d_kv=8, d_ff=64, num_layers=2, num_heads=4,
+                                   pad_token_id=PAD_TOKEN_ID, decoder_start_token_id=PAD_TOKEN_ID)
+    return TinyModel(transformers.T5ForConditionalGeneration(config))
+
+
+def random_input_ids():
+    torch.manual_seed(0)
+    # 不包含 pad，保证两种方式的 attention_mask 相同
+    return torch.randint(3, 50, (3, 7))
+
+
+@torch.no_grad()
+def test_decoder_only_cache_matches_full_recompute():
+    model = build_gpt2()
+    input_ids = random_input_ids()
+    past_result = None
+    for _ in range(STEPS):
+        past_result = model.generate_step(input_ids, past_result=past_result)
+        cached_logits = past_result.logits[:, -1]
+        full_logits = model.backbone(input_ids=input_ids).logits[:, -1]
+        assert torch.allclose(cached_logits, full_logits, atol=1e-5)
+        next_ids = cached_logits.argmax(-1, keepdim=True)
+        input_ids = torch.cat([input_ids, next_ids], dim=-1)
+
+
+@torch.no_grad()
+def test_encoder_decoder_cache_matches_full_recompute():
+    model = build_t5()
+    input_ids = random_input_ids()
+    decoder_input_ids = model.get_decoder_start_ids(input_ids)
+    past_result = None
+    for _ in range(STEPS):
+        past_result = model.generate_step(input_ids, decoder_input_ids, past_result=past_result)
+        cached_logits = past_result.logits[:, -1]
+        full_logits = model.backbone(input_ids=input_ids, decoder_input_ids=decoder_input_ids).logits[:, -1]
+        assert torch.allclose(cached_logits, full_logits, atol=1e-5)
+        next_ids = cached_logits.argmax(-1, keepdim=True)
+        decoder_input_ids = torch.cat([decoder_input_ids, next_ids], dim=-1)
+
+
+@torch.no_grad()
+def test_generate_step_passes_backbone_features():
+    model = build_gpt2()
+    input_ids = random_input_ids()
+    token_type_ids = torch.ones_like(input_ids)
+    with_features = model.generate_step(input_ids, token_type_ids=token_type_ids, unknown_feature=[1, 2, 3])
+    without_features = model.generate_step(input_ids)
+    full_logits = model.backbone(input_ids=input_ids, token_type_ids=token_type_ids).logits
+    assert torch.allclose(with_features.logits, full_logits, atol=1e-5)
+    assert not torch.allclose(with_features.logits, without_features.logits)
+
+
+
+def first_eos_truncated(sequence, eos_token_id):
+    """
+    截断到第一个 eos（包括 eos），之后的位置补 eos
+    """
+    if eos_token_id not in sequence:
+        return list(sequence)
+    end = sequence.index(eos_token_id) + 1
+    return list(sequence[:end]) + [eos_token_id] * (len(sequence) - end)
+
+
+@torch.no_grad()
+def test_early_stop_matches_full_generation_truncated_at_eos():
+    model_util = pytest.importorskip("general_files.utils.model_util")
+    # 较大的初始化范围使 logits 差距明显，移除行前后 argmax 不会因为浮点误差改变
+    config = transformers.GPT2Config(vocab_size=50, n_positions=64, n_embd=32, n_layer=2, n_head=2,
+                                     pad_token_id=PAD_TOKEN_ID, initializer_range=0.5)
+    torch.manual_seed(1)
+    model = TinyModel(transformers.GPT2LMHeadModel(config))
+    input_ids = torch.randint(3, 50, (8, 5))
+    max_length = 10
+    greedy = lambda logits: logits.argmax(-1)
+    # eos 为不存在的 token 时所有行都生成到 max_length
+    full = model_util.generate_with_early_stop(input_ids, None, -1, greedy, max_length=max_length, model=model)
+    assert all(len(row) == max_length for row in full)
+
+    # 选择使各行在最多不同步数结束的 token 作为 eos
+    def finish_steps(token):
+        return {row.index(token) for row in full if token in row}
+
+    eos_token_id = max(sorted({token for row in full for token in row}), key=lambda token: len(finish_steps(token)))
+    assert len(finish_steps(eos_token_id)) >= 2
+
+    early = model_util.generate_with_early_stop(input_ids, None, eos_token_id, greedy, max_length=max_length,
+                                                model=model)
+    expected = [first_eos_truncated(row, eos_token_id) for row in full]
+    # 所有行都结束后循环停止，输出长度为最晚结束的步数，之后的位置在完整生成中均为 eos
+    output_length = len(early[0])
+    assert early == [row[:output_length] for row in expected]
+    assert all(token == eos_token_id for row in expected for token in row[output_length:])
@@ -0,0 +1,130 @@
+"""
+GPU 登记的并发压力测试：数十个模拟训练任务同时抢占 8 块GPU，部分任务排队、部分任务中途崩溃（不释放、只停止续约），
+检查任何时刻都不会有两个任务占用同一块GPU。使用 fakeredis（Lua 脚本需要 lupa），无需 Redis 服务与 GPU
+"""
+import random
+import threading
+import time
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+common_util = pytest.importorskip("general_files.utils.common_util")
+from omegaconf import OmegaConf
+
+NUM_GPUS = 8
+NUM_JOBS = 40
+LEASE_TTL = 2
+
+
+def make_config(task_id, gpus):
+    return OmegaConf.create({
+        "task_id": task_id,
+        "visible_cuda": list(gpus),
+        "want_gpu_num": len(gpus),
+        "run_notes": "",
+        "comet_name": task_id,
+        "logger_project": "test",
+    })
+
+
+class GpuLedger:
+    """
+    测试侧记录的GPU持有者：登记成功之后记入，释放之前移除，记录的持有区间包含在 Redis 中的登记区间内，
+    因此这里出现冲突就说明 Redis 中同一块GPU被登记了两次
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = dict()
+        self.conflicts = []
+
+    def acquire(self, task_id, gpus):
+        with self.lock:
+            for gpu in gpus:
+                if gpu in self.holders:
+                    self.conflicts.append((gpu, self.holders[gpu], task_id))
+                self.holders[gpu] = task_id
+
+    def release(self, task_id, gpus):
+        with self.lock:
+            for gpu in gpus:
+                if self.holders.get(gpu) == task_id:
+                    del self.holders[gpu]
+
+
+def run_job(server, ledger, job_index, rng, errors):
+    try:
+        client = common_util.RedisClient(client=fakeredis.FakeRedis(server=server, decode_responses=True),
+                                         lease_ttl=LEASE_TTL)
+        task_id = f"job{job_index}"
+        gpus = sorted(rng.sample(range(NUM_GPUS), rng.choice([1, 1, 2, 4])))
+        config = make_config(task_id, gpus)
+        queued = rng.random() < 0.5
+        if queued:
+            client.join_wait_queue(config)
+        deadline = time.time() + 60
+        while client.register_gpus(config, from_queue=queued) is None:
+            assert time.time() < deadline, f"{task_id} 等待GPU超时"
+            if queued:
+                client.wait_for_wake_up(config, timeout=1)
+            else:
+                time.sleep(rng.uniform(0.005, 0.02))
+        ledger.acquire(task_id, gpus)
+        assert set(gpus) <= client.get_self_occupied_gpus()
+        time.sleep(rng.uniform(0.01, 0.05))
+        ledger.release(task_id, gpus)
+        if rng.random() < 0.1:
+            # 模拟崩溃：不释放登记信息，只停止续约，租约过期后GPU自动释放
+            common_util.LEASE_HEARTBEATS.pop(task_id).stop()
+        else:
+            client.deregister_gpus(config)
+    except Exception as e:
+        errors.append(e)
+
+
+def test_no_gpu_is_double_booked():
+    server = fakeredis.FakeServer()
+    ledger = GpuLedger()
+    errors = []
+    jobs = [
+        threading.Thread(target=run_job, args=(server, ledger, job_index, random.Random(job_index), errors))
+        for job_index in range(NUM_JOBS)
+    ]
+    try:
+        for job in jobs:
+            job.start()
+        for job in jobs:
+            job.join()
+    finally:
+        for heartbeat in common_util.LEASE_HEARTBEATS.values():
+            heartbeat.stop()
+        common_util.LEASE_HEARTBEATS.clear()
+    assert not errors, errors
+    assert not ledger.conflicts, ledger.conflicts
+    client = common_util.RedisClient(client=fakeredis.FakeRedis(server=server, decode_responses=True))
+    assert client.get_queue_tasks() == []
+
+
+def test_concurrent_registration_of_same_gpus_has_one_winner():
+    server = fakeredis.FakeServer()
+    barrier = threading.Barrier(NUM_JOBS)
+    winners = []
+
+    def register(job_index):
+        client = common_util.RedisClient(client=fakeredis.FakeRedis(server=server, decode_responses=True))
+        barrier.wait()
+        if client.register_gpus(make_config(f"job{job_index}", [3, 5])) is not None:
+            winners.append(job_index)
+
+    threads = [threading.Thread(target=register, args=(job_index,)) for job_index in range(NUM_JOBS)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for heartbeat in common_util.LEASE_HEARTBEATS.values():
+            heartbeat.stop()
+        common_util.LEASE_HEARTBEATS.clear()
+    assert len(winners) == 1
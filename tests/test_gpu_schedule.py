@@ -0,0 +1,171 @@
+"""
+带回填的保守调度 plan_gpu_schedule：回填不推迟队首任务、优先级老化、无法满足时为 inf，
+以及一天的确定性模拟中与 FIFO（不回填）的GPU利用率对比
+"""
+import math
+import os
+import random
+import pytest
+
+common_util = pytest.importorskip("general_files.utils.common_util")
+plan_gpu_schedule = common_util.plan_gpu_schedule
+
+NOW = 1_000_000.0
+HOUR = 3600
+
+
+def running(num_gpus, end, gpus=None):
+    return {"use_gpus": ",".join(map(str, gpus if gpus is not None else [0] * num_gpus)), "estimated_end": end}
+
+
+def queued(task_id, want_gpus, minutes, created=NOW, priority=0, pin_gpus=None):
+    return {"task_id": task_id, "want_gpus": want_gpus, "estimated_minutes": minutes,
+            "create_timestamp": created, "priority": priority,
+            "pin_gpus": ",".join(map(str, pin_gpus)) if pin_gpus else None}
+
+
+###############################################
+# 单元测试
+###############################################
+def test_backfill_does_not_delay_head_reservation():
+    running_tasks = [running(2, NOW + HOUR)]
+    head = queued("head", 4, 120, created=NOW - 60)
+    alone = plan_gpu_schedule([head], running_tasks, 2, NOW)
+    assert alone["head"] == NOW + HOUR
+
+    short_job = queued("short", 2, 30)
+    long_job = queued("long", 2, 180)
+    schedule = plan_gpu_schedule([head, short_job, long_job], running_tasks, 2, NOW)
+    assert schedule["head"] == alone["head"]
+    # 能在队首任务开始前结束的小任务立即开始，会推迟队首任务的不行
+    assert schedule["short"] == NOW
+    assert schedule["long"] >= schedule["head"] + 120 * 60
+
+
+def test_aging_promotes_long_waiting_task():
+    fresh = queued("fresh", 1, 60, created=NOW, priority=1)
+    old = queued("old", 1, 60, created=NOW - 2 * HOUR, priority=0)
+    without_aging = plan_gpu_schedule([fresh, old], [], 1, NOW, aging_per_hour=0)
+    assert list(without_aging) == ["fresh", "old"]
+    assert without_aging["fresh"] == NOW
+
+    with_aging = plan_gpu_schedule([fresh, old], [], 1, NOW, aging_per_hour=1.0)
+    assert list(with_aging) == ["old", "fresh"]
+    assert with_aging["old"] == NOW
+    assert with_aging["fresh"] == NOW + HOUR
+
+
+def test_unsatisfiable_task_is_inf_and_does_not_block_others():
+    running_tasks = [running(2, NOW + HOUR)]
+    schedule = plan_gpu_schedule([queued("huge", 8, 60, created=NOW - 60), queued("small", 1, 60)],
+                                 running_tasks, 2, NOW)
+    assert schedule["huge"] == math.inf
+    assert schedule["small"] == NOW
+
+
+def test_overdue_running_task_is_expected_to_end_soon():
+    schedule = plan_gpu_schedule([queued("next", 2, 60)], [running(2, NOW - HOUR)], 0, NOW)
+    assert schedule["next"] == NOW + 60
+
+
+def test_pinned_task_waits_for_its_own_gpus():
+    # GPU 0、1 被占用，2、3 空闲：数量足够，但指定了 GPU 1 的任务不能立即开始
+    running_tasks = [running(2, NOW + HOUR, gpus=[0, 1])]
+    schedule = plan_gpu_schedule([queued("pinned", 1, 30, pin_gpus=[1]), queued("free", 1, 30, pin_gpus=[2])],
+                                 running_tasks, 2, NOW)
+    assert schedule["pinned"] == NOW + HOUR
+    assert schedule["free"] == NOW
+
+
+def test_pinned_reservations_do_not_overlap():
+    first = queued("first", 1, 60, created=NOW - 60, pin_gpus=[3])
+    second = queued("second", 1, 60, pin_gpus=[3])
+    schedule = plan_gpu_schedule([first, second], [], 4, NOW)
+    assert schedule["first"] == NOW
+    assert schedule["second"] == NOW + HOUR
+
+
+def test_default_aging_matches_config_default():
+    yaml = pytest.importorskip("yaml")
+    with open(os.path.join(os.path.dirname(__file__), "..", "configs", "default_config.yaml")) as f:
+        default_config = yaml.safe_load(f)
+    assert default_config["gpu_aging_per_hour"] == common_util.DEFAULT_GPU_AGING_PER_HOUR
+
+
+###############################################
+# 一天的确定性模拟
+###############################################
+NUM_GPUS = 8
+HORIZON = 24 * HOUR
+
+
+def make_jobs(seed=0, num_jobs=120):
+    rng = random.Random(seed)
+    jobs = []
+    for index in range(num_jobs):
+        jobs.append(dict(
+            task_id=f"job{index}",
+            create_timestamp=NOW + rng.uniform(0, 20 * HOUR),
+            want_gpus=rng.choice([1, 1, 1, 2, 2, 4, 8]),
+            estimated_minutes=rng.choice([20, 40, 60, 120, 240]),
+            priority=0,
+        ))
+    return sorted(jobs, key=lambda job: job["create_timestamp"])
+
+
+def pick_backfill(queue, running_jobs, free_gpu_num, now):
+    schedule = plan_gpu_schedule(queue, [running(job["want_gpus"], job["end"]) for job in running_jobs],
+                                 free_gpu_num, now, aging_per_hour=0)
+    return [job for job in queue if schedule[job["task_id"]] <= now]
+
+
+def pick_fifo(queue, running_jobs, free_gpu_num, now):
+    picked = []
+    for job in queue:
+        if job["want_gpus"] > free_gpu_num:
+            break
+        picked.append(job)
+        free_gpu_num -= job["want_gpus"]
+    return picked
+
+
+def simulate(pick, jobs):
+    """
+    事件驱动：每次有任务到达或结束时调度，任务按预计时长准确运行
+    :return: HORIZON 内的GPU利用率, {task_id: 开始时间}
+    """
+    pending = [dict(job) for job in jobs]
+    queue, running_jobs, starts = [], [], {}
+    now = NOW
+    while pending or queue or running_jobs:
+        next_times = [job["create_timestamp"] for job in pending[:1]] + [job["end"] for job in running_jobs]
+        now = min(next_times)
+        running_jobs = [job for job in running_jobs if job["end"] > now]
+        while pending and pending[0]["create_timestamp"] <= now:
+            queue.append(pending.pop(0))
+        free_gpu_num = NUM_GPUS - sum(job["want_gpus"] for job in running_jobs)
+        for job in pick(queue, running_jobs, free_gpu_num, now):
+            queue.remove(job)
+            job["end"] = now + job["estimated_minutes"] * 60
+            running_jobs.append(job)
+            starts[job["task_id"]] = now
+        assert sum(job["want_gpus"] for job in running_jobs) <= NUM_GPUS
+    busy = sum(
+        job["want_gpus"] * max(0.0, min(starts[job["task_id"]] + job["estimated_minutes"] * 60, NOW + HORIZON)
+                               - starts[job["task_id"]])
+        for job in jobs
+    )
+    return busy / (NUM_GPUS * HORIZON), starts
+
+
+def test_day_long_simulation_beats_fifo_utilization():
+    jobs = make_jobs()
+    backfill_utilization, backfill_starts = simulate(pick_backfill, jobs)
+    fifo_utilization, fifo_starts = simulate(pick_fifo, jobs)
+    assert len(backfill_starts) == len(fifo_starts) == len(jobs)
+    assert backfill_utilization > fifo_utilization
+    # 回填让平均等待时间更短
+    wait = lambda starts: sum(starts[job["task_id"]] - job["create_timestamp"] for job in jobs) / len(jobs)
+    assert wait(backfill_starts) < wait(fifo_starts)
+    # 相同输入的模拟结果完全确定
+    assert simulate(pick_backfill, jobs) == (backfill_utilization, backfill_starts)
@@ -0,0 +1,92 @@
+"""
+排队任务的 唤醒 → 确认 → 登记 流程，使用 fakeredis（Lua 脚本需要 lupa），无需 Redis 服务与 GPU
+"""
+import threading
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+common_util = pytest.importorskip("general_files.utils.common_util")
+from omegaconf import OmegaConf
+
+
+def make_config(task_id, gpus):
+    return OmegaConf.create({
+        "task_id": task_id,
+        "visible_cuda": list(gpus),
+        "want_gpu_num": len(gpus),
+        "gpu_confirm_window": 1,
+        "run_notes": "",
+        "comet_name": task_id,
+        "logger_project": "test",
+    })
+
+
+@pytest.fixture
+def server():
+    yield fakeredis.FakeServer()
+    for heartbeat in common_util.LEASE_HEARTBEATS.values():
+        heartbeat.stop()
+    common_util.LEASE_HEARTBEATS.clear()
+
+
+def new_client(server):
+    return common_util.RedisClient(client=fakeredis.FakeRedis(server=server, decode_responses=True), lease_ttl=10)
+
+
+def test_release_wakes_up_waiting_task_which_confirms_and_registers(server):
+    running, waiting = new_client(server), new_client(server)
+    running_config, waiting_config = make_config("running", [0]), make_config("waiting", [0])
+    assert running.register_gpus(running_config) == "running"
+    waiting.join_wait_queue(waiting_config)
+    assert waiting.register_gpus(waiting_config, from_queue=True) is None
+
+    reasons = []
+    waiter = threading.Thread(target=lambda: reasons.append(waiting.wait_for_wake_up(waiting_config, timeout=5)))
+    waiter.start()
+    running.deregister_gpus(running_config)
+    waiter.join()
+    assert reasons == ["gpu_released"]
+
+    available_gpus, min_count = common_util.get_available_gpus(waiting_config, waiting)
+    assert available_gpus == [0] and min_count == 1
+    assert common_util.confirm_gpus_free(waiting_config, waiting, available_gpus)
+    assert waiting.register_gpus(waiting_config, gpus=available_gpus, from_queue=True) == "waiting"
+    assert waiting.get_queue_tasks() == []
+    assert not waiting.client.sismember(common_util.WAIT_QUEUE_IDS_KEY, "waiting")
+    assert waiting.get_self_occupied_gpus() == {0}
+    # 出队后唤醒信号被清除
+    assert not waiting.client.exists(waiting.get_wake_up_key("waiting"))
+
+
+def test_confirm_fails_when_gpu_is_taken_during_window(server):
+    waiting, other = new_client(server), new_client(server)
+    waiting_config = make_config("waiting", [1])
+    waiting.join_wait_queue(waiting_config)
+    timer = threading.Timer(0.3, lambda: other.register_gpus(make_config("other", [1])))
+    timer.start()
+    assert not common_util.confirm_gpus_free(waiting_config, waiting, [1])
+    timer.join()
+    assert waiting.register_gpus(waiting_config, gpus=[1], from_queue=True) is None
+    assert [task["task_id"] for task in waiting.get_queue_tasks()] == ["waiting"]
+
+
+def test_wake_up_signals_do_not_pile_up(server):
+    client = new_client(server)
+    config = make_config("waiting", [0])
+    client.join_wait_queue(config)
+    for reason in ["gpu_free", "queue_pop", "gpu_released"]:
+        client.notify_wait_queue(reason)
+    assert client.wait_for_wake_up(config, timeout=1) == "gpu_released"
+    assert client.wait_for_wake_up(config, timeout=1) is None
+
+
+def test_expired_queue_task_is_no_longer_notified(server):
+    client = new_client(server)
+    config = make_config("crashed", [0])
+    client.join_wait_queue(config)
+    common_util.LEASE_HEARTBEATS.pop("crashed").stop()
+    client.client.delete(client.get_lease_key("crashed"))
+    assert client.get_queue_tasks() == []
+    client.notify_wait_queue("gpu_free")
+    assert not client.client.exists(client.get_wake_up_key("crashed"))
@@ -0,0 +1,47 @@
+"""
+打包训练前对 backbone 是否支持 3 维 attention_mask 的探测
+"""
+import types
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("pytorch_lightning")
+from omegaconf import OmegaConf
+from general_files.models.pl_base_model import BasePLModel
+
+
+class TinyModel(BasePLModel):
+    def __init__(self, backbone):
+        tokenizer = types.SimpleNamespace(pad_token_id=0, bos_token_id=1, eos_token_id=2)
+        super().__init__(OmegaConf.create({}), tokenizer)
+        self.backbone = backbone
+
+
+def test_gpt2_does_not_support_block_attention():
+    config = transformers.GPT2Config(vocab_size=50, n_positions=32, n_embd=32, n_layer=1, n_head=2)
+    assert not TinyModel(transformers.GPT2LMHeadModel(config)).supports_block_attention_mask()
+
+
+def test_bert_decoder_supports_block_attention():
+    config = transformers.BertConfig(vocab_size=50, hidden_size=32, num_hidden_layers=1, num_attention_heads=2,
+                                     intermediate_size=64, is_decoder=True)
+    model = TinyModel(transformers.BertLMHeadModel(config))
+    assert model.supports_block_attention_mask()
+    # 探测不改变模型的训练状态
+    assert model.backbone.training
+
+
+def test_packed_attention_mask_is_block_diagonal_and_causal():
+    model = TinyModel(transformers.GPT2LMHeadModel(transformers.GPT2Config(vocab_size=50, n_layer=1, n_head=2,
+                                                                           n_embd=32)))
+    input_ids = torch.tensor([[5, 6, 7, 8, 0]])
+    segment_ids = torch.tensor([[1, 1, 2, 2, 0]])
+    mask = model.get_packed_attention_mask(input_ids, segment_ids)[0]
+    assert mask.tolist() == [
+        [1, 0, 0, 0, 0],
+        [1, 1, 0, 0, 0],
+        [0, 0, 1, 0, 0],
+        [0, 0, 1, 1, 0],
+        [0, 0, 0, 0, 0],
+    ]
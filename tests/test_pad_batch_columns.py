@@ -0,0 +1,31 @@
+"""
+动态补齐时各列的 pad 值
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+data_util = pytest.importorskip("general_files.utils.data_util")
+
+PAD_TOKEN_ID = 3
+
+
+def test_pad_values_per_column():
+    batch = {
+        "input_ids": [[5, 6, 7], [8]],
+        "labels": [[5, 6, 7], [8]],
+        "position_ids": [[0, 1, 0], [0]],
+        "segment_ids": [[1, 1, 2], [1]],
+    }
+    res = data_util.pad_batch_columns(batch, pad_token_id=PAD_TOKEN_ID)
+    assert res["input_ids"][1].tolist() == [8, PAD_TOKEN_ID, PAD_TOKEN_ID]
+    assert res["labels"][1].tolist() == [8, -100, -100]
+    assert res["position_ids"][1].tolist() == [0, 0, 0]
+    assert res["segment_ids"][1].tolist() == [1, 0, 0]
+
+
+def test_skip_keys_and_custom_pad_values():
+    batch = {"label": [[1], [0]], "decoder_input_ids": [[5], [6, 7]]}
+    res = data_util.pad_batch_columns(batch, pad_token_id=PAD_TOKEN_ID, skip_keys=["label"],
+                                      pad_values={"decoder_input_ids": 9})
+    assert res["label"].tolist() == [[1], [0]]
+    assert res["decoder_input_ids"][0].tolist() == [5, 9]
@@ -0,0 +1,83 @@
+"""
+批量 top_k_top_p_filtering 与逐行实现的一致性测试
+在仓库根目录运行 python -m tests.test_top_k_top_p_filtering 可以得到不同 batch 与词表大小下的耗时
+"""
+import time
+import pytest
+
+torch = pytest.importorskip("torch")
+model_util = pytest.importorskip("general_files.utils.model_util")
+import torch.nn.functional as F
+
+FILTER_VALUE = -10000.0
+
+
+def per_row_filtering(batch_logits, top_k=10, top_p=0.9, filter_value=FILTER_VALUE):
+    """
+    向量化之前的逐行实现
+    """
+    batch_logits = batch_logits.clone()
+    for index in range(batch_logits.shape[0]):
+        logits = batch_logits[index]
+        row_top_k = min(top_k, logits.size(-1))
+        if row_top_k > 0:
+            indices_to_remove = logits < torch.topk(logits, row_top_k)[0][..., -1, None]
+            logits[indices_to_remove] = filter_value
+        if top_p > 0.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+            sorted_indices_to_remove = cumulative_probs > top_p
+            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+            sorted_indices_to_remove[..., 0] = 0
+            logits[sorted_indices[sorted_indices_to_remove]] = filter_value
+        batch_logits[index] = logits
+    return batch_logits
+
+
+@pytest.mark.parametrize("top_k,top_p", [(8, 0.9), (0, 0.5), (20, 0.0), (1, 0.9)])
+def test_matches_per_row_implementation(top_k, top_p):
+    torch.manual_seed(0)
+    logits = torch.randn(16, 300)
+    expected = per_row_filtering(logits, top_k=top_k, top_p=top_p)
+    result = model_util.top_k_top_p_filtering(logits.clone(), top_k=top_k, top_p=top_p, filter_value=FILTER_VALUE)
+    assert torch.equal(result, expected)
+
+
+def test_per_row_parameters():
+    torch.manual_seed(0)
+    logits = torch.randn(2, 100)
+    result = model_util.top_k_top_p_filtering(logits.clone(), top_k=[5, 0], top_p=[0.0, 0.5],
+                                              filter_value=FILTER_VALUE)
+    assert torch.equal(result[:1], per_row_filtering(logits[:1], top_k=5, top_p=0.0))
+    assert torch.equal(result[1:], per_row_filtering(logits[1:], top_k=0, top_p=0.5))
+
+
+def benchmark_top_k_top_p_filtering(
+    batch_sizes=(1, 4, 16, 64, 256),
+    vocab_sizes=(32128, 50257, 250112),
+    top_k=8,
+    top_p=0.9,
+    repeats=10,
+    device="cpu",
+):
+    """
+    top_k_top_p_filtering 的微基准测试，统计不同 batch 大小与词表大小下单次调用以及每行的平均耗时
+    """
+    for vocab_size in vocab_sizes:
+        for batch_size in batch_sizes:
+            logits = torch.randn(batch_size, vocab_size, device=device)
+            # 预热
+            model_util.top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            if "cuda" in str(device):
+                torch.cuda.synchronize()
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                model_util.top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            if "cuda" in str(device):
+                torch.cuda.synchronize()
+            cost = (time.perf_counter() - start_time) / repeats * 1000
+            print(f"batch={batch_size} vocab={vocab_size}: {cost:.3f} ms ({cost / batch_size:.4f} ms/row)")
+
+
+if __name__ == "__main__":
+    benchmark_top_k_top_p_filtering()